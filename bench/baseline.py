@@ -0,0 +1,77 @@
+"""改写前的实现（取自最初的 bot.py，逻辑原样保留），作为 fuzz 和基准的对照。
+
+- clean_ai_time_tags / parse_response：逐个正则替换的旧解析器（user-021 之前）
+- select_context：旧的上下文截断+格式化，每轮对整段记录 insert(0) 选消息、全部重新格式化（user-007 之前）。
+  token 计数和单条格式化由调用方传入，只对照选窗口的算法
+"""
+import re
+from datetime import timedelta
+
+def get_cn_time():
+    raise RuntimeError("调用方需要先替换 baseline.get_cn_time")
+
+def clean_ai_time_tags(text):
+    """清理AI回复中模仿的时间标签"""
+    text = re.sub(r'\[\[\d{1,2}-\d{1,2}\s+\d{1,2}:\d{2}\]\]\s*', '', text)
+    text = re.sub(r'\[\d{1,2}-\d{1,2}\s+\d{1,2}:\d{2}\]\s*', '', text)
+    text = re.sub(r'\[\[\d{1,2}:\d{2}\]\]\s*', '', text)
+    text = re.sub(r'\[\d{4}-\d{1,2}-\d{1,2}\s+\d{1,2}:\d{2}\]\s*', '', text)
+    text = re.sub(r'\[\[\d{4}-\d{1,2}-\d{1,2}\s+\d{1,2}:\d{2}\]\]\s*', '', text)
+    return text
+
+def parse_response(response, user):
+    # 先清理AI模仿的时间标签
+    response = clean_ai_time_tags(response)
+    result = {"reply": response, "raw": response, "chase": None, "chase_delay": 300, "schedules": [], "memories": []}
+    for match in re.finditer(r'\[\[记忆\]\]\s*(.+?)(?=\[\[|$)', response, re.DOTALL):
+        mem = match.group(1).strip()
+        if mem:
+            result["memories"].append(mem)
+    chase_match = re.search(r'\[\[追(?:\s+(\d+)分钟)?\]\]\s*(.+?)(?=\[\[|$)', response, re.DOTALL)
+    if chase_match:
+        if chase_match.group(1):
+            result["chase_delay"] = int(chase_match.group(1)) * 60
+        result["chase"] = chase_match.group(2).strip()
+    for match in re.finditer(r'\[\[定时\s+(?:(\d{4}-\d{1,2}-\d{1,2}|\d{1,2}-\d{1,2})\s+)?(\d{1,2}:\d{2})\s+(.+?)\]\]', response):
+        ds = match.group(1)
+        ts = match.group(2)
+        hint = match.group(3)
+        if not ds:
+            ds = get_cn_time().strftime("%Y-%m-%d")
+        elif len(ds.split("-")) == 2:
+            ds = f"{get_cn_time().year}-{ds}"
+        result["schedules"].append({"type": "定时", "date": ds, "time": ts, "hint": hint})
+    for match in re.finditer(r'\[\[想念\s+(\d{1,2}:\d{2}|\d+小时后)\s+(.+?)\]\]', response):
+        ts = match.group(1)
+        if "小时后" in ts:
+            hours = int(ts.replace("小时后", ""))
+            target = get_cn_time() + timedelta(hours=hours)
+            ds = target.strftime("%Y-%m-%d")
+            ts = target.strftime("%H:%M")
+        else:
+            ds = get_cn_time().strftime("%Y-%m-%d")
+        result["schedules"].append({"type": "想念", "date": ds, "time": ts, "hint": match.group(2)})
+    clean = response
+    clean = re.sub(r'\[\[记忆\]\]\s*.+?(?=\[\[|$)', '', clean, flags=re.DOTALL)
+    clean = re.sub(r'\s*\[\[追(?:\s+\d+分钟)?\]\].*?(?=\[\[|$)', '', clean, flags=re.DOTALL)
+    clean = re.sub(r'\[\[定时\s+(?:(?:\d{4}-\d{1,2}-\d{1,2}|\d{1,2}-\d{1,2})\s+)?\d{1,2}:\d{2}\s+.+?\]\]', '', clean)
+    clean = re.sub(r'\[\[想念\s+(?:\d{1,2}:\d{2}|\d+小时后)\s+.+?\]\]', '', clean)
+    clean = re.sub(r'\[\[不发\]\]', '', clean)
+    result["reply"] = clean.strip()
+    return result
+
+def select_context(history, new_messages, token_limit, round_limit, count_tokens, format_message):
+    history = history.copy()
+    if new_messages:
+        history.extend(new_messages)
+    if round_limit:
+        history = history[-(round_limit * 2):]
+    total_tokens = 0
+    result = []
+    for msg in reversed(history):
+        mt = count_tokens(msg)
+        if total_tokens + mt > token_limit:
+            break
+        result.insert(0, msg)
+        total_tokens += mt
+    return [format_message(msg) for msg in result]
@@ -0,0 +1,156 @@
+"""把 bot.py 的任务队列、租约和定时器部分装成一个个"实例"，共用一个 bench/fakedb.py 内存库。
+
+每个实例是一份独立的 bot.py 全局状态（自己的 INSTANCE_ID、堆、用户队列、DB 线程池），
+上游模型、上下文和 Telegram 换成替身，其余都是 bot.py 里的原函数。
+crash_at=n：这个实例第 n 次副作用（写库或发消息）做完之后"进程被杀"，之后它的任何读写和发送都不再生效。
+"""
+import asyncio
+import heapq
+import os
+import re
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
+
+import fakedb
+from botsrc import load
+
+NOW = datetime(2026, 10, 18, 12, 0, tzinfo=timezone(timedelta(hours=8)))
+WRITES = {"insert_one", "insert_many", "update_one", "update_many", "find_one_and_update", "delete_one", "delete_many"}
+NAMES = [
+    "run_db", "find_all", "DEFAULT_TOKENIZER", "CJK_PATTERN", "IMAGE_DEFAULT_TOKENS", "count_tokens_heuristic",
+    "token_counters", "tokenizers_loading", "get_token_counter", "tokenizer_for", "estimate_tokens", "message_tokens",
+    "append_messages", "ADMIN_ID", "get_user", "update_user", "CHARGE_RECEIPTS", "charge_user", "refund_user", "charge_receipt", "add_memory", "is_admin",
+    "TIME_TAG", "TIME_TAG_PATTERN", "CONTROL_TAG_PATTERN", "clean_ai_time_tags", "scan_reply", "next_date_for", "parse_response",
+    "HELD_TAG_PATTERN", "streamed_parts", "stream_reply", "send_messages",
+    "MAX_CONCURRENT_REPLIES", "MAX_PENDING_JOBS", "user_jobs", "user_workers", "pending_jobs", "dispatch", "user_worker",
+    "LEASE_TTL", "HEARTBEAT_INTERVAL", "held_leases", "lease_deadline", "try_user_lease", "hold_user_lease",
+    "release_user_lease", "renew_leases",
+    "JOB_MAX_ATTEMPTS", "JOB_RELOAD_INTERVAL", "job_heap", "REPLY_QUIET_MIN", "REPLY_QUIET_DEFAULT", "REPLY_QUIET_MAX",
+    "SHORT_MESSAGE_CHARS", "reply_timers", "mark_job", "refund_abandoned", "push_job", "quiet_period",
+    "arm_reply_timer", "fire_reply_timer", "buffer_messages", "schedule_chase", "cancel_chase", "recover_jobs", "due_jobs",
+    "run_job", "run_jobs", "process_and_reply", "utc_ts", "send_chase", "heartbeat",
+    "SCHEDULE_WINDOW", "schedule_heap", "schedule_window_end", "load_schedule_window", "run_scheduler", "run_schedule",
+    "fire_schedule",
+]
+
+class Crash(BaseException):
+    """模拟进程被杀。继承 BaseException：bot.py 里的 except Exception 拦不住，和真的崩溃一样一路退出"""
+
+class Guard:
+    def __init__(self, crash_at=None):
+        self.crash_at = crash_at
+        self.steps = 0
+        self.dead = False
+        self.armed = False
+
+    def check(self):
+        if self.dead:
+            raise Crash()
+
+    def step(self):
+        if not self.armed:
+            return
+        self.steps += 1
+        if self.steps == self.crash_at:
+            self.dead = True
+            raise Crash()
+
+class GuardedCollection:
+    """读写前检查实例是否已死；写完计一步，到点就崩"""
+    def __init__(self, col, guard):
+        self._col = col
+        self._guard = guard
+
+    def __getattr__(self, name):
+        attr = getattr(self._col, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self._guard.check()
+            result = attr(*args, **kwargs)
+            if name == "find":
+                result = list(result)
+            if name in WRITES:
+                self._guard.step()
+            return result
+        return call
+
+class Telegram:
+    """所有实例共用的"用户那一端"，记下每条真正发出去的消息"""
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+class GuardedBot:
+    def __init__(self, telegram, guard):
+        self.telegram = telegram
+        self.guard = guard
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.guard.check()
+        with self.telegram.lock:
+            self.telegram.sent.append((chat_id, text))
+        self.guard.step()
+
+    async def send_chat_action(self, chat_id, action):
+        self.guard.check()
+
+def streaming_model(reply, calls=None):
+    """按几个字一块吐出 reply 的假上游，和真的流式一样把累计文本交给 on_delta"""
+    async def call_main_model(model_key, messages, user, on_delta=None):
+        if calls is not None:
+            calls.append(messages[-1]["content"] if messages else "")
+        if on_delta:
+            for end in range(3, len(reply) + 3, 3):
+                await on_delta(reply[:end])
+                await asyncio.sleep(0)
+        return reply
+    return call_main_model
+
+def load_instance(db, name, telegram, crash_at=None, reply="好", models=None, calls=None, now=None, overrides=None):
+    """返回 (ns, guard)。ns 里是这个实例的全部全局变量，取函数用 ns["name"]。
+    overrides 在载入之后覆盖，用来换掉常量（LEASE_TTL 之类）或某个函数"""
+    guard = Guard(crash_at)
+    ns = {key: GuardedCollection(value, guard) if key.endswith("_col") else value
+          for key, value in fakedb.bot_namespace(db).items()}
+    ns.update({
+        "os": os, "re": re, "asyncio": asyncio, "heapq": heapq, "time": time, "socket": socket, "partial": partial,
+        "deque": deque, "datetime": datetime, "timezone": timezone, "timedelta": timedelta,
+        "db_executor": ThreadPoolExecutor(8, thread_name_prefix=f"db-{name}"),
+        "get_cn_time": now or (lambda: NOW), "DEFAULT_MODEL": "m",
+        "get_models": lambda: models or {"m": {"cost": 2, "vision": True}},
+        "extend_context_cache": lambda user_id, docs: None,
+        "get_context_messages": lambda user, new_messages=None: asyncio.sleep(0, []),
+        "call_main_model": streaming_model(reply, calls),
+        "add_schedule": lambda sched: asyncio.sleep(0),
+    })
+    load(NAMES, ns)
+    ns["INSTANCE_ID"] = name
+    ns["REPLY_QUIET_MIN"] = 0.0
+    ns["job_wakeup"] = asyncio.Event()
+    ns["schedule_wakeup"] = asyncio.Event()
+    ns["reply_slots"] = asyncio.Semaphore(ns["MAX_CONCURRENT_REPLIES"])
+    ns["bot"] = GuardedBot(telegram, guard)
+    ns.update(overrides or {})
+    return ns, guard
+
+def quiet_crashes(loop, context):
+    # 崩掉的实例留下的任务异常就是预期的 Crash，不用打印
+    if not isinstance(context.get("exception"), Crash):
+        loop.default_exception_handler(context)
+
+async def stop(ns, tasks):
+    """停掉这个实例的循环和用户队列，等它们退出后再关线程池"""
+    tasks = list(tasks) + list(ns["user_workers"].values())
+    for task in tasks:
+        task.cancel()
+    for timer in ns["reply_timers"].values():
+        timer["handle"].cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    ns["db_executor"].shutdown(wait=False)
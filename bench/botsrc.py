@@ -0,0 +1,38 @@
+"""从 bot.py 里按名字取出函数和常量单独执行。
+
+不直接 import bot：模块一加载就会连数据库、建 Telegram Bot，跑基准和 fuzz 用不着这些。
+"""
+import ast
+import os
+from functools import lru_cache
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "bot.py")
+
+@lru_cache(maxsize=None)
+def top_level(path):
+    """[(名字, 编译好的代码)]，按源码顺序"""
+    with open(path, encoding="utf-8") as f:
+        src = f.read()
+    defs = []
+    for node in ast.parse(src).body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            name = node.name
+        elif isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+        else:
+            continue
+        defs.append((name, compile(ast.Module([node], []), path, "exec")))
+    return defs
+
+def load(names, ns=None, path=BOT_PATH):
+    """把 names 里的顶层函数/赋值按源码顺序 exec 进 ns，返回 ns。依赖的模块和函数由调用方预先放进 ns"""
+    ns = {} if ns is None else ns
+    found = set()
+    for name, code in top_level(path):
+        if name in names:
+            exec(code, ns)
+            found.add(name)
+    missing = set(names) - found
+    if missing:
+        raise KeyError(f"not found in bot.py: {', '.join(sorted(missing))}")
+    return ns
@@ -0,0 +1,169 @@
+"""上下文窗口（get_context_messages + 前缀和缓存）的等价性检查和基准。
+
+    python bench/context_bench.py [--cases 20000] [--turns 10000] [--seed 1]
+
+用 bot.py 里真正的 get_context_messages / extend_context_cache，聊天记录放在内存里
+（history_page 按同样的 (timestamp, _id) 键翻页，run_db 直接调用）；不取图片、不做文档检索。
+- 等价性：随机的历史长度、token 上限、轮数上限和未入库的新消息，
+  和 bench/baseline.py 的 select_context（旧算法，token 计数和格式化用同一套）逐条比较
+- 基准：--turns 轮对话的记录上，每轮取窗口再追加一问一答，旧算法每轮全量重选重排
+有不一致就打印并以 1 退出。
+"""
+import argparse
+import asyncio
+import os
+import random
+import re
+import sys
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from itertools import chain
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import baseline
+from botsrc import load
+
+TOKENIZER = "heuristic"
+WORDS = ["今天", "天气", "不错", "我们", "出去", "走走吧", "哈哈", "真的吗", "hello", "that's", "so", "cool", "！", "？", "，", "~"]
+
+class Store:
+    """内存里的 messages 集合（单个用户，按 (timestamp, _id) 有序），只实现 history_page 需要的查询"""
+    def __init__(self):
+        self.docs = []
+        self.keys = []
+
+    def extend(self, docs):
+        self.docs.extend(docs)
+        self.keys.extend((d["timestamp"], d["_id"]) for d in docs)
+
+    def history_page(self, user_id, limit, before=None, after=None, newest=False):
+        if before or newest:
+            end = bisect_left(self.keys, before) if before else len(self.keys)
+            page = self.docs[max(0, end - limit):end][::-1]
+        else:
+            start = bisect_right(self.keys, after) if after else 0
+            page = self.docs[start:start + limit]
+        return [dict(d) for d in page]
+
+def load_bot(store, token_limit):
+    async def run_db(fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    async def get_images(image_ids):
+        return {}
+
+    async def retrieve_chunks(*args, **kwargs):
+        return ""
+
+    ns = {
+        "os": os, "re": re, "datetime": datetime, "OrderedDict": OrderedDict, "bisect_left": bisect_left, "chain": chain,
+        "CN_TIMEZONE": timezone(timedelta(hours=8)), "run_db": run_db, "get_images": get_images,
+        "retrieve_chunks": retrieve_chunks, "history_page": store.history_page,
+        "get_models": lambda: {"m": {"max_tokens": token_limit}},
+    }
+    return load([
+        "TIME_TAG", "TIME_TAG_PATTERN", "clean_ai_time_tags", "DEFAULT_TOKENIZER", "CJK_PATTERN", "IMAGE_DEFAULT_TOKENS",
+        "count_tokens_heuristic", "token_counters", "tokenizers_loading", "get_token_counter", "tokenizer_for", "estimate_tokens", "message_tokens",
+        "image_data_url", "CONTEXT_CACHE_USERS", "CONTEXT_CACHE_BYTES", "CONTEXT_LOAD_BATCH",
+        "context_cache", "format_entry", "build_payload", "get_context_cache", "context_cache_bytes", "trim_context_cache",
+        "load_older", "load_newer", "add_entries", "drop_older", "extend_context_cache", "drop_context_cache", "get_context_messages",
+    ], ns)
+
+def make_message(rng, role, ts, seq):
+    text = "".join(rng.choice(WORDS) for _ in range(rng.randint(3, 60)))
+    if role == "assistant" and rng.random() < 0.1:
+        text = f"[[10-18 12:{seq % 60:02d}]] {text}"
+    msg = {"role": role, "content": text, "timestamp": ts, "model": "m"}
+    if role == "user" and rng.random() < 0.05:
+        msg["image_ids"] = [f"img_{seq}"]
+        msg["image_tokens"] = rng.randint(200, 1600)
+    return msg
+
+def stored(msg, seq, bot):
+    """模拟 append_messages 入库：补 _id、tokens、tokenizer"""
+    return dict(msg, _id=f"{seq:08d}", user_id="1", tokens=bot["message_tokens"](msg, TOKENIZER), tokenizer=TOKENIZER)
+
+def old_window(bot, history, new_messages, token_limit, round_limit):
+    return baseline.select_context(
+        history, new_messages, token_limit, round_limit,
+        lambda m: bot["message_tokens"](m, TOKENIZER),
+        lambda m: bot["build_payload"](bot["format_entry"](m, TOKENIZER), {}),
+    )
+
+async def check(cases, seed):
+    rng = random.Random(seed)
+    bad = 0
+    for case in range(cases):
+        store = Store()
+        token_limit = rng.choice([50, 200, 1000, 5000, 190000])
+        bot = load_bot(store, token_limit)
+        round_limit = rng.choice([None, None, 1, 3, 10])
+        n = rng.randint(0, 300)
+        ts = 1_700_000_000.0
+        docs = []
+        for i in range(n):
+            ts += rng.choice([0, 1, 30])
+            docs.append(stored(make_message(rng, "user" if i % 2 == 0 else "assistant", ts, i), i, bot))
+        user = {"_id": "1", "model": "m", "context_token_limit": None, "context_round_limit": round_limit}
+        # 一部分情况先建好缓存再入库几条：本实例追加的走 extend_context_cache，别的实例写的靠 load_newer 补上
+        cut = rng.randint(0, n) if rng.random() < 0.5 else 0
+        if cut:
+            store.extend(docs[:cut])
+            await bot["get_context_messages"](user)
+        store.extend(docs[cut:])
+        if cut and rng.random() < 0.5:
+            bot["extend_context_cache"]("1", docs[cut:])
+        new_messages = [make_message(rng, "user", ts + 60, n + j) for j in range(rng.randint(0, 2))]
+        got = await bot["get_context_messages"](user, new_messages or None)
+        want = old_window(bot, store.docs, new_messages, token_limit, round_limit)
+        if got != want:
+            bad += 1
+            if bad <= 5:
+                print(f"  case {case}: n={n} limit={token_limit} rounds={round_limit} new={len(new_messages)} 新 {len(got)} 条 / 旧 {len(want)} 条")
+    return bad
+
+async def bench(turns, token_limit, seed):
+    rng = random.Random(seed)
+    store = Store()
+    bot = load_bot(store, token_limit)
+    ts = 1_700_000_000.0
+    store.extend([stored(make_message(rng, "user" if i % 2 == 0 else "assistant", ts + i, i), i, bot) for i in range(turns * 2)])
+    ts += turns * 2
+    user = {"_id": "1", "model": "m", "context_token_limit": None, "context_round_limit": None}
+    await bot["get_context_messages"](user)  # 缓存预热，和线上常驻的情况一致
+    rounds = 50
+    new_total = old_total = 0.0
+    for r in range(rounds):
+        seq = turns * 2 + r * 2
+        ts += 1
+        new_msg = make_message(rng, "user", ts, seq)
+        reply = make_message(rng, "assistant", ts + 1, seq + 1)
+        start = time.perf_counter()
+        await bot["get_context_messages"](user, [new_msg])
+        docs = [stored(new_msg, seq, bot), stored(reply, seq + 1, bot)]
+        store.extend(docs)
+        bot["extend_context_cache"]("1", docs)
+        new_total += time.perf_counter() - start
+        start = time.perf_counter()
+        old_window(bot, store.docs[:-2], [new_msg], token_limit, None)
+        old_total += time.perf_counter() - start
+    return old_total / rounds * 1000, new_total / rounds * 1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=20000)
+    parser.add_argument("--turns", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    bad = asyncio.run(check(args.cases, args.seed))
+    print(f"等价性: {args.cases} 组，不一致 {bad}")
+    for limit in (190000, 990000):
+        old_ms, new_ms = asyncio.run(bench(args.turns, limit, args.seed))
+        print(f"{args.turns} 轮记录，{limit} token 上限: 旧 {old_ms:.2f} ms -> 新 {new_ms:.2f} ms / 轮")
+    sys.exit(1 if bad else 0)
+
+if __name__ == "__main__":
+    main()
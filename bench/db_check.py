@@ -0,0 +1,163 @@
+"""不连 Mongo 跑一遍数据访问层：bot.py 里真正的 run_db / find_all 和上面的查询函数，集合换成 bench/fakedb.py。
+
+    python bench/db_check.py [--users 4] [--messages 400] [--seed 1]
+
+run_db 照常走线程池，同一个内存库从多个线程并发访问。检查：
+- 聊天记录翻页：history_page 的 newest/before/after 和 history_pages 按 (timestamp, _id) 的顺序不重不漏，
+  时间戳大量重复、用户之间互不串
+- 批量取图：get_images 去重后一次 $in 补齐缺的，第二次全走缓存不查库
+- 并发扣费：charge_user 的条件 $inc 在并发下不会扣成负数
+- 删记录：delete_history 只删自己的，别人还引用的和消息缓冲里的图片留着，history_epoch +1
+有失败就打印并以 1 退出。
+"""
+import argparse
+import asyncio
+import base64
+import os
+import random
+import re
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import fakedb
+from botsrc import load
+
+NOW = datetime(2026, 10, 18, 12, 0, tzinfo=timezone(timedelta(hours=8)))
+
+def load_bot(db):
+    ns = dict(fakedb.bot_namespace(db))
+    ns.update({
+        "os": os, "asyncio": asyncio, "partial": partial, "re": re, "base64": base64, "OrderedDict": OrderedDict,
+        "datetime": datetime, "timezone": timezone, "db_executor": ThreadPoolExecutor(8, thread_name_prefix="db"),
+        "get_cn_time": lambda: NOW, "DEFAULT_MODEL": "m", "get_models": lambda: {"m": {}},
+        "extend_context_cache": lambda user_id, docs: None, "image_fs": None,
+    })
+    return load([
+        "run_db", "find_all", "DEFAULT_TOKENIZER", "CJK_PATTERN", "IMAGE_DEFAULT_TOKENS", "count_tokens_heuristic",
+        "token_counters", "tokenizers_loading", "get_token_counter", "tokenizer_for", "estimate_tokens", "message_tokens",
+        "append_messages", "history_page", "history_pages", "has_history", "delete_history",
+        "IMAGE_INLINE_MAX", "write_image", "load_image_doc", "IMAGE_CACHE_BYTES", "image_cache", "image_cache_stats",
+        "cache_image", "fetch_images", "get_images", "IMAGE_SWEEP_GRACE", "delete_images", "referenced_images",
+        "delete_unreferenced_images", "get_user", "charge_user",
+    ], ns)
+
+def key(m):
+    return (m["timestamp"], m["_id"])
+
+async def check_history(bot, db, rng, users, count):
+    errors = []
+    ts = {str(u): 1_700_000_000.0 for u in range(users)}
+    # 分批并发写入，时间戳经常重复，顺序只能靠 _id 分开
+    for _ in range(count // 20):
+        batch = []
+        for _ in range(20):
+            uid = str(rng.randrange(users))
+            ts[uid] += rng.choice([0, 0, 1])
+            batch.append((uid, {"role": rng.choice(["user", "assistant"]), "content": "x" * rng.randint(1, 30),
+                                "timestamp": ts[uid], "model": "m"}))
+        await asyncio.gather(*(bot["append_messages"](uid, [m]) for uid, m in batch))
+    for u in range(users):
+        uid = str(u)
+        want = sorted((fakedb.project(d, {"user_id": 0}) for d in db["messages"].docs.values() if d["user_id"] == uid), key=key)
+        got = [m async for page in bot["history_pages"](uid, page_size=7) for m in page]
+        if got != want:
+            errors.append(f"history_pages user {uid}: {len(got)} / {len(want)}")
+        newest = await bot["run_db"](bot["history_page"], uid, 5, newest=True)
+        if newest != want[::-1][:5]:
+            errors.append(f"history_page newest user {uid}")
+        # 从最新往回翻，和 load_older 一样用 before
+        back, before = [], None
+        while True:
+            page = await bot["run_db"](bot["history_page"], uid, 9, before=before, newest=True)
+            back.extend(page)
+            if len(page) < 9:
+                break
+            before = key(page[-1])
+        if back != want[::-1]:
+            errors.append(f"history_page before user {uid}: {len(back)} / {len(want)}")
+        if want and not await bot["has_history"](uid):
+            errors.append(f"has_history user {uid}")
+    return errors
+
+async def check_images(bot, db):
+    errors = []
+    for i in range(6):
+        await bot["run_db"](bot["write_image"], f"img{i}", bytes([i]) * 100, "image/jpeg", 10, 10)
+    bot["image_cache"].clear()
+    ids = ["img0", "img1", "img1", "img2", "missing", "img5"]
+    col = db["images"]
+    ops = col.ops
+    found = await bot["get_images"](ids)
+    if set(found) != {"img0", "img1", "img2", "img5"} or found["img2"] != ("image/jpeg", bytes([2]) * 100):
+        errors.append(f"get_images: {sorted(found)}")
+    if col.ops - ops != 1:
+        errors.append(f"get_images: {col.ops - ops} 次查询，应为 1 次")
+    ops = col.ops
+    await bot["get_images"](["img0", "img1", "img5"])
+    if col.ops != ops:
+        errors.append("get_images: 缓存命中后仍然查库")
+    return errors
+
+async def check_charge(bot, db):
+    await bot["get_user"]("charge")
+    results = await asyncio.gather(*(bot["charge_user"]("charge", "points", 1) for _ in range(50)))
+    points = db["users"].find_one({"_id": "charge"})["points"]
+    if sum(results) != 20 or points != 0:
+        return [f"charge_user: {sum(results)} 次成功，剩余 {points}"]
+    return []
+
+async def check_delete(bot, db):
+    errors = []
+    msgs = db["messages"]
+    await bot["get_user"]("del")
+    await bot["append_messages"]("del", [
+        {"role": "user", "content": "a", "timestamp": 1.0, "model": "m", "image_ids": ["img0", "img1"]},
+        {"role": "user", "content": "b", "timestamp": 2.0, "model": "m", "image_ids": ["img2", "img3"]},
+    ])
+    await bot["append_messages"]("other", [{"role": "user", "content": "c", "timestamp": 1.0, "model": "m", "image_ids": ["img1"]}])
+    db["jobs"].insert_one({"key": "reply:x", "status": "pending", "messages": [{"type": "photo", "image_id": "img2"}]})
+    # 都是一个小时以前存的，不受保护期影响
+    db["images"].update_many({}, {"$set": {"created": NOW.timestamp() - 7200}})
+    others = sum(1 for d in msgs.docs.values() if d["user_id"] != "del")
+    await bot["run_db"](bot["delete_history"], "del")
+    if any(d["user_id"] == "del" for d in msgs.docs.values()):
+        errors.append("delete_history: 还有残留记录")
+    if sum(1 for d in msgs.docs.values() if d["user_id"] != "del") != others:
+        errors.append("delete_history: 删到了别的用户")
+    left = set(db["images"].docs)
+    if "img0" in left or "img3" in left or not {"img1", "img2"} <= left:
+        errors.append(f"delete_history: 剩下的图片 {sorted(left)}")
+    if db["users"].find_one({"_id": "del"}).get("history_epoch") != 1:
+        errors.append("delete_history: history_epoch 没有加一")
+    return errors
+
+async def run(users, count, seed):
+    db = fakedb.FakeDB()
+    bot = load_bot(db)
+    errors = []
+    errors += await check_history(bot, db, random.Random(seed), users, count)
+    errors += await check_images(bot, db)
+    errors += await check_charge(bot, db)
+    errors += await check_delete(bot, db)
+    bot["db_executor"].shutdown()
+    return errors
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--messages", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    errors = asyncio.run(run(args.users, args.messages, args.seed))
+    for e in errors:
+        print(f"  {e}")
+    print(f"数据访问层: 失败 {len(errors)}")
+    sys.exit(1 if errors else 0)
+
+if __name__ == "__main__":
+    main()
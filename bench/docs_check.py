@@ -0,0 +1,207 @@
+"""文档检索（chunk_text / bm25_top / retrieve_chunks）的性质检查。
+
+    python bench/docs_check.py [--cases 2000] [--queries 500] [--seed 1]
+
+切块、建索引和检索用的是 bot.py 里的原函数，doc_chunks 放在 bench/fakedb.py 内存库里。
+- 切块：随机长短的行（空行、首尾空白、正好卡在边界上、远超一块的长行），每块连同开头的重叠
+  不超过 DOC_CHUNK_CHARS；后一块以前一块末尾 DOC_CHUNK_OVERLAP 字开头；去掉重叠后拼回来和原文一字不差
+- 打分：同一个索引上用直接按公式算的 BM25 对照 bm25_top，分数不到 DOC_MIN_SCORE 的不返回，
+  返回的是分数最高的前 k 个，只来自给定的文件；只有停用词的闲聊什么都不返回
+- 窗口：retrieve_chunks 只附 new_doc_ids 和 window_doc_ids 里的文件，本轮新传的文件先给开头几块
+有失败就打印前几条并以 1 退出。
+"""
+import argparse
+import asyncio
+import hashlib
+import math
+import os
+import random
+import re
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import fakedb
+from botsrc import load
+
+CJK = "的一是在不了有人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处理府研队"
+STOPWORD_CHAT = ["在吗", "哈哈 好的", "谢谢 晚安", "hi there", "ok thanks", "你好 在吗 哈哈", ""]
+LINE_LENGTHS = [0, 1, 5, 40, 200, 698, 699, 700, 701, 799, 800, 801, 1500, 3000]
+
+def load_bot(db):
+    ns = dict(fakedb.bot_namespace(db))
+    ns.update({
+        "os": os, "re": re, "math": math, "time": time, "hashlib": hashlib, "asyncio": asyncio, "partial": partial,
+        "OrderedDict": OrderedDict, "db_executor": ThreadPoolExecutor(4, thread_name_prefix="db"),
+    })
+    return load([
+        "run_db", "find_all", "DOC_INLINE_CHARS", "DOC_CHUNK_CHARS", "DOC_CHUNK_OVERLAP", "DOC_PREVIEW_CHARS", "DOC_TOP_K",
+        "DOC_MAX_CHUNKS", "DOC_INDEX_USERS", "DOC_INDEX_TTL", "DOC_MIN_SCORE", "DOC_COMMON_DF", "BM25_K1", "BM25_B",
+        "BM25_STOPWORDS", "BM25_TERM_PATTERN", "doc_indexes", "chunk_text", "bm25_terms", "store_doc_chunks",
+        "index_document", "load_doc_index", "get_doc_index", "bm25_top", "retrieve_chunks",
+    ], ns)
+
+def random_line(rng, words):
+    n = rng.choice(LINE_LENGTHS)
+    out, size = [], 0
+    while size < n:
+        word = rng.choice(words) if rng.random() < 0.3 else "".join(rng.choices(CJK, k=rng.randint(1, 6)))
+        if rng.random() < 0.3:
+            word += " "
+        out.append(word)
+        size += len(word)
+    line = "".join(out)[:n]
+    return rng.choice(["", " ", "\t"]) + line + rng.choice(["", "  "])
+
+def random_text(rng, words, lines):
+    return "\n".join(random_line(rng, words) for _ in range(lines))
+
+def check_chunks(bot, text):
+    size, overlap = bot["DOC_CHUNK_CHARS"], bot["DOC_CHUNK_OVERLAP"]
+    chunks = bot["chunk_text"](text)
+    errors = []
+    rebuilt = []
+    for i, c in enumerate(chunks):
+        if len(c) > size:
+            errors.append(f"第 {i} 块 {len(c)} 字，超过 {size}")
+        if not c:
+            errors.append(f"第 {i} 块是空的")
+        if i:
+            head = chunks[i - 1][-overlap:] + "\n"
+            if not c.startswith(head):
+                errors.append(f"第 {i} 块没有以前一块末尾 {overlap} 字开头")
+            c = c[len(head):]
+        rebuilt.append(c.replace("\n", ""))
+    if "".join(rebuilt) != "".join(line.strip() for line in text.split("\n")):
+        errors.append("去掉重叠拼回来和原文不一致")
+    return errors
+
+def term_counts(bot, index):
+    tfs = []
+    for c in index["chunks"]:
+        tf = {}
+        for t in bot["bm25_terms"](c["text"]):
+            tf[t] = tf.get(t, 0) + 1
+        tfs.append(tf)
+    return tfs
+
+def reference_scores(bot, tfs, query):
+    """不用倒排表，逐块按 BM25 公式直接算，和 bm25_top 一样只给 df 不过半的非停用词计分"""
+    n = len(tfs)
+    avgdl = sum(sum(tf.values()) for tf in tfs) / n
+    scores = [0.0] * n
+    for t in set(bot["bm25_terms"](query)) - bot["BM25_STOPWORDS"]:
+        df = sum(1 for tf in tfs if t in tf)
+        if not df or df > n * bot["DOC_COMMON_DF"]:
+            continue
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        for i, tf in enumerate(tfs):
+            if t in tf:
+                norm = 1 - bot["BM25_B"] + bot["BM25_B"] * sum(tf.values()) / avgdl
+                scores[i] += idf * tf[t] * (bot["BM25_K1"] + 1) / (tf[t] + bot["BM25_K1"] * norm)
+    return scores
+
+def check_top(bot, index, tfs, query, k, doc_ids):
+    got = bot["bm25_top"](index, query, k, doc_ids)
+    scores = reference_scores(bot, tfs, query)
+    eligible = sorted((s for i, s in enumerate(scores) if index["chunks"][i]["doc_id"] in doc_ids and s >= bot["DOC_MIN_SCORE"]),
+                      reverse=True)[:k]
+    errors = []
+    if any(index["chunks"][i]["doc_id"] not in doc_ids for i in got):
+        errors.append("返回了范围外文件的块")
+    if any(scores[i] < bot["DOC_MIN_SCORE"] for i in got):
+        errors.append(f"返回了不到 DOC_MIN_SCORE 的块: {[round(scores[i], 2) for i in got]}")
+    if [round(scores[i], 6) for i in got] != [round(s, 6) for s in eligible]:
+        errors.append(f"分数 {[round(scores[i], 2) for i in got]}，应为 {[round(s, 2) for s in eligible]}")
+    return errors
+
+PICKED = re.compile(r'《(\w+)》第(\d+)段：')
+
+async def check_window(bot, db, rng, docs, words):
+    """docs：{doc_id: (文件名, 这份文件独有的词)}"""
+    errors = []
+    ids = list(docs)
+    for _ in range(50):
+        window = set(rng.sample(ids, rng.randint(0, len(ids))))
+        new = set(rng.sample(ids, rng.randint(0, 1)))
+        target = rng.choice(ids)
+        query = " ".join(rng.sample(docs[target][1], 3) + rng.sample(words, 2))
+        out = await bot["retrieve_chunks"]("u", query, tuple(new), tuple(window))
+        picked = [(name, int(seq)) for name, seq in PICKED.findall(out)]
+        names = {docs[d][0] for d in window | new}
+        if any(name not in names for name, _ in picked):
+            errors.append(f"窗口 {sorted(names)} 外的文件被附上: {picked}")
+        if len(picked) > bot["DOC_TOP_K"]:
+            errors.append(f"附了 {len(picked)} 块")
+        for d in new:
+            name = docs[d][0]
+            count = db["doc_chunks"].count_documents({"doc_id": d})
+            head = [(name, s) for s in range(1, min(count, bot["DOC_TOP_K"]) + 1)]
+            if not set(head) <= set(picked):
+                errors.append(f"新文件 {name} 的开头几块没附上: {picked}")
+        if target in window and not new and not any(name == docs[target][0] for name, _ in picked):
+            errors.append(f"窗口里的 {docs[target][0]} 用独有的词也没检索到")
+    return errors
+
+async def run(cases, queries, seed):
+    rng = random.Random(seed)
+    words = [f"w{i}" for i in range(40)] + ["the", "and", "hello", "okay", "python", "mongo"]
+    failures = []
+
+    db = fakedb.FakeDB()
+    bot = load_bot(db)
+    lengths = []
+    for case in range(cases):
+        text = random_text(rng, words, rng.randint(0, 12))
+        for e in check_chunks(bot, text):
+            failures.append(f"切块 case {case}: {e}")
+        lengths.extend(len(c) for c in bot["chunk_text"](text))
+    print(f"切块: {cases} 篇，{len(lengths)} 块，最长 {max(lengths, default=0)} 字，失败 {len(failures)}")
+
+    # 同一个用户几份文件，每份有自己独有的词
+    docs = {}
+    for d in range(6):
+        own = [f"doc{d}x{j}" for j in range(8)]
+        text = random_text(rng, words + own * 3, rng.randint(10, 40))
+        doc_id, _ = await bot["index_document"]("u", f"file{d}", text)
+        docs[doc_id] = (f"file{d}", own)
+    index = await bot["get_doc_index"]("u", set(docs))
+    tfs = term_counts(bot, index)
+    before = len(failures)
+    ids = list(docs)
+    for q in range(queries):
+        pool = words + [w for _, own in docs.values() for w in own] + list(CJK[:60])
+        query = " ".join(rng.choice(pool) for _ in range(rng.randint(1, 6)))
+        if q % 10 == 0:
+            query = rng.choice(STOPWORD_CHAT)
+        doc_ids = set(rng.sample(ids, rng.randint(1, len(ids))))
+        for e in check_top(bot, index, tfs, query, rng.randint(1, 6), doc_ids):
+            failures.append(f"打分 {query!r}: {e}")
+    for query in STOPWORD_CHAT:
+        if bot["bm25_top"](index, query, 4, set(ids)):
+            failures.append(f"闲聊 {query!r} 也检索出了块")
+    print(f"打分: {len(index['chunks'])} 块上 {queries} 条查询，失败 {len(failures) - before}")
+
+    before = len(failures)
+    failures += [f"窗口: {e}" for e in await check_window(bot, db, rng, docs, words)]
+    print(f"窗口: 失败 {len(failures) - before}")
+    bot["db_executor"].shutdown()
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    failures = asyncio.run(run(args.cases, args.queries, args.seed))
+    for f in failures[:10]:
+        print(f"  {f}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""内存里的 Mongo 替身，bench 脚本拿它换掉 bot.py 里的 *_col，run_db / find_all 照常用。
+
+只实现 bot.py 用到的部分：
+- 查询：字段相等（点路径、数组包含）、$eq/$ne/$lt/$lte/$gt/$gte/$in/$nin/$exists、$or/$and
+- 更新：$set/$unset/$inc/$min/$push（$each/$position/$slice）/$pull/$addToSet/$setOnInsert，upsert
+- find 的 sort/limit、projection（包含或排除）、唯一索引（含 partialFilterExpression）
+所有操作共用一把锁，和真库一样单文档原子，可以从 run_db 的线程池里并发调用。
+聚合管道、GridFS 没有实现，调到会抛 NotImplementedError。
+"""
+import copy
+import itertools
+import threading
+from datetime import datetime
+
+class DuplicateKeyError(Exception):
+    code = 11000
+
+class BulkWriteError(Exception):
+    def __init__(self, details):
+        super().__init__("batch op errors occurred")
+        self.details = details
+
+class ReturnDocument:
+    BEFORE = False
+    AFTER = True
+
+class Result:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+_ids = itertools.count(1)
+
+def new_id():
+    """和 ObjectId 一样按生成顺序递增"""
+    return f"{next(_ids):024x}"
+
+def _rank(v):
+    # 不同类型之间按 Mongo 的 BSON 顺序大致排一下，避免 Python 比较报错
+    if v is None:
+        return (0, 0)
+    if isinstance(v, bool):
+        return (5, v)
+    if isinstance(v, (int, float)):
+        return (1, v)
+    if isinstance(v, str):
+        return (2, v)
+    if isinstance(v, datetime):
+        return (6, v.timestamp())
+    return (3, repr(v))
+
+def get_values(doc, path):
+    """点路径取值，路径上遇到数组就展开；取不到返回 []"""
+    values = [doc]
+    for part in path.split("."):
+        nxt = []
+        for v in values:
+            if isinstance(v, dict):
+                if part in v:
+                    nxt.append(v[part])
+            elif isinstance(v, list):
+                nxt.extend(item[part] for item in v if isinstance(item, dict) and part in item)
+        values = nxt
+    return values
+
+def _flat(values):
+    for v in values:
+        yield v
+        if isinstance(v, list):
+            yield from v
+
+def _eq(values, target):
+    if target is None and not values:
+        return True
+    return any(v == target for v in _flat(values))
+
+def _cmp(values, target, op):
+    for v in _flat(values):
+        if v is None or isinstance(v, list) or _rank(v)[0] != _rank(target)[0]:
+            continue
+        if op(_rank(v), _rank(target)):
+            return True
+    return False
+
+COMPARE = {
+    "$lt": lambda a, b: a < b, "$lte": lambda a, b: a <= b,
+    "$gt": lambda a, b: a > b, "$gte": lambda a, b: a >= b,
+}
+
+def match_cond(values, cond):
+    if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+        for op, arg in cond.items():
+            if op == "$exists":
+                ok = bool(values) == bool(arg)
+            elif op == "$eq":
+                ok = _eq(values, arg)
+            elif op == "$ne":
+                ok = not _eq(values, arg)
+            elif op == "$in":
+                ok = any(_eq(values, x) for x in arg)
+            elif op == "$nin":
+                ok = not any(_eq(values, x) for x in arg)
+            elif op in COMPARE:
+                ok = _cmp(values, arg, COMPARE[op])
+            else:
+                raise NotImplementedError(op)
+            if not ok:
+                return False
+        return True
+    return _eq(values, cond)
+
+def matches(doc, query):
+    for key, cond in query.items():
+        if key == "$or":
+            if not any(matches(doc, q) for q in cond):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, q) for q in cond):
+                return False
+        elif key.startswith("$"):
+            raise NotImplementedError(key)
+        elif not match_cond(get_values(doc, key), cond):
+            return False
+    return True
+
+def _parent(doc, path, create):
+    parts = path.split(".")
+    for part in parts[:-1]:
+        if part not in doc:
+            if not create:
+                return None, parts[-1]
+            doc[part] = {}
+        doc = doc[part]
+    return doc, parts[-1]
+
+def _get(doc, path, default=None):
+    parent, key = _parent(doc, path, False)
+    return parent.get(key, default) if isinstance(parent, dict) else default
+
+def _set(doc, path, value):
+    parent, key = _parent(doc, path, True)
+    parent[key] = value
+
+def apply_update(doc, update, inserting=False):
+    if isinstance(update, list):
+        raise NotImplementedError("aggregation pipeline update")
+    for op, fields in update.items():
+        if op == "$setOnInsert":
+            if inserting:
+                for path, value in fields.items():
+                    _set(doc, path, copy.deepcopy(value))
+            continue
+        for path, value in fields.items():
+            value = copy.deepcopy(value)
+            if op == "$set":
+                _set(doc, path, value)
+            elif op == "$unset":
+                parent, key = _parent(doc, path, False)
+                if isinstance(parent, dict):
+                    parent.pop(key, None)
+            elif op == "$inc":
+                _set(doc, path, _get(doc, path, 0) + value)
+            elif op == "$min":
+                cur = _get(doc, path)
+                if cur is None or value < cur:
+                    _set(doc, path, value)
+            elif op in ("$push", "$addToSet"):
+                arr = list(_get(doc, path, None) or [])
+                each = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                if op == "$addToSet":
+                    each = [v for v in each if v not in arr]
+                    arr.extend(each)
+                else:
+                    pos = value.get("$position", len(arr)) if isinstance(value, dict) else len(arr)
+                    arr[pos:pos] = each
+                    if isinstance(value, dict) and "$slice" in value:
+                        n = value["$slice"]
+                        arr = arr[n:] if n < 0 else arr[:n]
+                _set(doc, path, arr)
+            elif op == "$pull":
+                arr = _get(doc, path, None)
+                if isinstance(arr, list):
+                    if isinstance(value, dict):
+                        keep = [v for v in arr if not (isinstance(v, dict) and matches(v, value))]
+                    else:
+                        keep = [v for v in arr if v != value]
+                    _set(doc, path, keep)
+            else:
+                raise NotImplementedError(op)
+
+def project(doc, projection):
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    include = {k for k, v in projection.items() if v}
+    if include - {"_id"}:
+        out = {k.split(".")[0]: doc[k.split(".")[0]] for k in include if k.split(".")[0] in doc}
+        if projection.get("_id", 1) and "_id" in doc:
+            out["_id"] = doc["_id"]
+        return out
+    if include == {"_id"} and len(projection) == 1:
+        return {"_id": doc["_id"]}
+    for k, v in projection.items():
+        if not v:
+            doc.pop(k, None)
+    return doc
+
+def sort_docs(docs, spec):
+    if isinstance(spec, str):
+        spec = [(spec, 1)]
+    for field, direction in reversed(list(spec)):
+        docs.sort(key=lambda d: _rank((get_values(d, field) or [None])[0]), reverse=direction < 0)
+    return docs
+
+class Cursor:
+    def __init__(self, col, query, projection):
+        self.col, self.query, self.projection = col, query, projection
+        self._sort = None
+        self._limit = 0
+
+    def sort(self, spec, direction=None):
+        self._sort = [(spec, direction)] if direction is not None else spec
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def __iter__(self):
+        with self.col.db.lock:
+            docs = [d for d in self.col.docs.values() if matches(d, self.query)]
+            if self._sort:
+                sort_docs(docs, self._sort)
+            if self._limit:
+                docs = docs[:self._limit]
+            return iter([project(d, self.projection) for d in docs])
+
+class Collection:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        self.docs = {}
+        self.unique = []  # [(字段列表, partialFilterExpression)]
+        self.ops = 0
+
+    # ---------- 索引 ----------
+    def create_index(self, keys, unique=False, partialFilterExpression=None, **kwargs):
+        fields = [keys] if isinstance(keys, str) else [k for k, _ in keys]
+        if unique:
+            self.unique.append((fields, partialFilterExpression or {}))
+        return "_".join(f"{f}_1" for f in fields)
+
+    def index_information(self):
+        return {}
+
+    def drop_index(self, name):
+        pass
+
+    def _check_unique(self, doc):
+        for fields, partial in self.unique:
+            if not matches(doc, partial):
+                continue
+            key = tuple((get_values(doc, f) or [None])[0] for f in fields)
+            for other in self.docs.values():
+                if other["_id"] != doc["_id"] and matches(other, partial) \
+                        and tuple((get_values(other, f) or [None])[0] for f in fields) == key:
+                    raise DuplicateKeyError(f"E11000 duplicate key {self.name} {fields}={key}")
+
+    # ---------- 读 ----------
+    def find(self, query=None, projection=None):
+        self.ops += 1
+        return Cursor(self, query or {}, projection)
+
+    def find_one(self, query=None, projection=None):
+        for doc in self.find(query, projection).limit(1):
+            return doc
+        return None
+
+    def count_documents(self, query):
+        with self.db.lock:
+            self.ops += 1
+            return sum(1 for d in self.docs.values() if matches(d, query))
+
+    def distinct(self, field, query=None):
+        with self.db.lock:
+            self.ops += 1
+            out = []
+            for d in self.docs.values():
+                if matches(d, query or {}):
+                    for v in _flat(get_values(d, field)):
+                        if not isinstance(v, list) and v not in out:
+                            out.append(v)
+            return out
+
+    def aggregate(self, pipeline):
+        raise NotImplementedError("aggregate")
+
+    # ---------- 写 ----------
+    def _insert(self, doc):
+        doc.setdefault("_id", new_id())
+        if doc["_id"] in self.docs:
+            raise DuplicateKeyError(f"E11000 duplicate key {self.name} _id={doc['_id']}")
+        stored = copy.deepcopy(doc)
+        self._check_unique(stored)
+        self.docs[stored["_id"]] = stored
+        return stored
+
+    def insert_one(self, doc):
+        with self.db.lock:
+            self.ops += 1
+            return Result(inserted_id=self._insert(doc)["_id"])
+
+    def insert_many(self, docs, ordered=True):
+        with self.db.lock:
+            self.ops += 1
+            errors, ids = [], []
+            for i, doc in enumerate(docs):
+                try:
+                    ids.append(self._insert(doc)["_id"])
+                except DuplicateKeyError as e:
+                    errors.append({"index": i, "code": 11000, "errmsg": str(e)})
+                    if ordered:
+                        break
+            if errors:
+                raise BulkWriteError({"writeErrors": errors})
+            return Result(inserted_ids=ids)
+
+    def _update(self, query, update, upsert, many):
+        """返回 (改之前, 改之后, matched, modified, upserted_id)，改之后只有第一条"""
+        matched = modified = 0
+        before = after = None
+        for doc in list(self.docs.values()):
+            if not matches(doc, query):
+                continue
+            matched += 1
+            new = copy.deepcopy(doc)
+            apply_update(new, update)
+            if new != doc:
+                self._check_unique(new)
+                self.docs[doc["_id"]] = new
+                modified += 1
+            if before is None:
+                before, after = doc, new
+            if not many:
+                break
+        if matched or not upsert:
+            return before, after, matched, modified, None
+        new = {k: copy.deepcopy(v) for k, v in query.items()
+               if not k.startswith("$") and not (isinstance(v, dict) and any(op.startswith("$") for op in v))}
+        apply_update(new, update, inserting=True)
+        stored = self._insert(new)
+        return None, stored, 0, 0, stored["_id"]
+
+    def update_one(self, query, update, upsert=False):
+        with self.db.lock:
+            self.ops += 1
+            _, _, matched, modified, upserted = self._update(query, update, upsert, False)
+            return Result(matched_count=matched, modified_count=modified, upserted_id=upserted)
+
+    def update_many(self, query, update, upsert=False):
+        with self.db.lock:
+            self.ops += 1
+            _, _, matched, modified, upserted = self._update(query, update, upsert, True)
+            return Result(matched_count=matched, modified_count=modified, upserted_id=upserted)
+
+    def find_one_and_update(self, query, update, projection=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE, sort=None):
+        with self.db.lock:
+            self.ops += 1
+            if sort:
+                first = next(iter(self.find(query, {"_id": 1}).sort(sort).limit(1)), None)
+                if first:
+                    query = {"_id": first["_id"]}
+            before, after, _, _, _ = self._update(query, update, upsert, False)
+            doc = after if return_document else before
+            return project(doc, projection) if doc is not None else None
+
+    def delete_one(self, query):
+        with self.db.lock:
+            self.ops += 1
+            for doc in self.docs.values():
+                if matches(doc, query):
+                    del self.docs[doc["_id"]]
+                    return Result(deleted_count=1)
+            return Result(deleted_count=0)
+
+    def delete_many(self, query):
+        with self.db.lock:
+            self.ops += 1
+            ids = [d["_id"] for d in self.docs.values() if matches(d, query)]
+            for i in ids:
+                del self.docs[i]
+            return Result(deleted_count=len(ids))
+
+class FakeDB:
+    """db["name"] 取集合，同一个 FakeDB 的所有集合共用一把锁"""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.cols = {}
+
+    def __getitem__(self, name):
+        if name not in self.cols:
+            self.cols[name] = Collection(self, name)
+        return self.cols[name]
+
+    def ops(self):
+        return sum(c.ops for c in self.cols.values())
+
+def bot_namespace(db):
+    """bot.py 里各个 *_col 全局变量和 pymongo 名字的替身，合并进 botsrc.load 的 ns"""
+    return {
+        "db": db, "users_col": db["users"], "schedules_col": db["schedules"], "images_col": db["images"],
+        "config_col": db["config"], "messages_col": db["messages"], "jobs_col": db["jobs"],
+        "leases_col": db["leases"], "extracts_col": db["extracts"], "doc_chunks_col": db["doc_chunks"],
+        "DuplicateKeyError": DuplicateKeyError, "BulkWriteError": BulkWriteError, "ReturnDocument": ReturnDocument,
+        "Binary": bytes,
+    }
@@ -0,0 +1,146 @@
+"""延迟任务队列的崩溃恢复检查：任务存在内存库里（bench/fakedb.py），跑的是 bot.py 里真正的
+buffer_messages / run_jobs / recover_jobs / run_job / process_and_reply / send_chase。
+
+    python bench/jobs_check.py [--double]
+
+先不崩跑一遍，数出一个回复任务和一个追问任务一共有多少步副作用（写库、发消息）；
+然后在每一步之后"杀掉进程"，用同一个 INSTANCE_ID 重启（recover_jobs(startup=True) 再跑 run_jobs）。
+--double 还会在重试时的每一步再崩一次（超过 JOB_MAX_ATTEMPTS，任务被放弃）。每种崩法都检查：
+- 每段回复、每条追问最多发一次，聊天记录里最多一份
+- 最多扣一次费；什么都没发出去的最终不扣费
+- 任务最后都清掉了
+崩在"记进度"和"做这一步"之间时这一步会少做（宁可少发不重复），单独计数，不算失败。
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import fakedb
+from botenv import Telegram, load_instance, quiet_crashes, stop
+
+UID = 1001
+CHAT = 5001
+COST = 2
+REPLY = "第一段|||第二段|||第三段"
+PARTS = REPLY.split("|||")
+CHASE = "人呢？"
+
+async def settle(ns, guard, timeout=10):
+    """跑 run_jobs 直到任务都处理完或者这个实例崩了"""
+    tasks = [asyncio.ensure_future(ns["run_jobs"](ns["bot"]))]
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    db = ns["jobs_col"]._col
+    while not guard.dead and (db.docs or ns["user_workers"]) and loop.time() < deadline:
+        await asyncio.sleep(0.005)
+    await stop(ns, tasks)
+    return not guard.dead and not db.docs
+
+async def scenario(kind, crashes):
+    """crashes：依次启动的实例各自在第几步崩（None 不崩）。返回 (结果, 每个实例做了几步)"""
+    db = fakedb.FakeDB()
+    telegram = Telegram()
+    steps = []
+    for i, crash_at in enumerate(list(crashes) + [None]):
+        ns, guard = load_instance(db, "worker", telegram, crash_at, reply=REPLY)
+        if i == 0:
+            await ns["get_user"](UID)
+            if kind == "reply":
+                await ns["buffer_messages"](UID, CHAT, [{"type": "text", "content": "在吗", "timestamp": 1.0}])
+            else:
+                await ns["schedule_chase"](UID, CHAT, CHASE, 0)
+        else:
+            # 重启：收回上次留下的 running 任务，重新载入待执行的
+            await ns["run_db"](ns["recover_jobs"], startup=True)
+        guard.armed = True
+        done = await settle(ns, guard)
+        steps.append(guard.steps)
+        if done:
+            break
+    return outcome(db, telegram), steps
+
+def outcome(db, telegram):
+    sent = [text for chat, text in telegram.sent if chat == CHAT]
+    user = db["users"].find_one({"_id": str(UID)})
+    history = [m["content"] for m in db["messages"].find({"user_id": str(UID)})]
+    return {
+        "sent": sent,
+        "charged": 20 - user["points"],
+        "history": history,
+        "jobs": len(db["jobs"].docs),
+    }
+
+def problems(kind, result):
+    out = []
+    expected = PARTS if kind == "reply" else [CHASE]
+    for text in set(result["sent"]):
+        if result["sent"].count(text) > 1:
+            out.append(f"重复发送 {text!r}")
+    if any(text not in expected for text in result["sent"]):
+        out.append(f"多余的消息 {result['sent']}")
+    for text in set(result["history"]):
+        if result["history"].count(text) > 1:
+            out.append(f"聊天记录重复 {text!r}")
+    if kind == "reply":
+        if result["charged"] not in (0, COST):
+            out.append(f"扣费 {result['charged']}")
+        if not result["sent"] and result["charged"]:
+            out.append("什么都没发出去却扣了费")
+    if result["jobs"]:
+        out.append(f"还剩 {result['jobs']} 个任务")
+    return out
+
+def complete(kind, result):
+    if kind == "reply":
+        return result["sent"] == PARTS and result["charged"] == COST and len(result["history"]) == 2
+    return result["sent"] == [CHASE] and result["history"] == [CHASE]
+
+async def run(double):
+    asyncio.get_running_loop().set_exception_handler(quiet_crashes)
+    total_failures = 0
+    for kind in ("reply", "chase"):
+        failures = 0
+        clean, steps = await scenario(kind, [])
+        if problems(kind, clean) or not complete(kind, clean):
+            print(f"  {kind} 不崩也没跑对: {clean}")
+            failures += 1
+            continue
+        total = steps[0]
+        plans = [[k] for k in range(1, total + 1)]
+        runs = partial_runs = 0
+        for plan in plans:
+            result, steps = await scenario(kind, plan)
+            runs += 1
+            bad = problems(kind, result)
+            if bad:
+                failures += 1
+                print(f"  {kind} 第 {plan} 步崩: {'; '.join(bad)}")
+            elif not complete(kind, result):
+                partial_runs += 1
+            if double:
+                # 重试的那个实例再在每一步崩一次
+                for j in range(1, steps[1] + 1):
+                    result, _ = await scenario(kind, plan + [j])
+                    runs += 1
+                    bad = problems(kind, result)
+                    if bad:
+                        failures += 1
+                        print(f"  {kind} 第 {plan + [j]} 步崩: {'; '.join(bad)}")
+                    elif not complete(kind, result):
+                        partial_runs += 1
+        print(f"{kind}: {total} 步副作用，{runs} 种崩法，不一致 {failures}，少做一步 {partial_runs}")
+        total_failures += failures
+    return total_failures
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--double", action="store_true")
+    args = parser.parse_args()
+    failures = asyncio.run(run(args.double))
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
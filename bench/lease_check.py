@@ -0,0 +1,227 @@
+"""多实例检查：两个实例（各自的 INSTANCE_ID、堆、用户队列、DB 线程池）共用一个内存库（bench/fakedb.py），
+跑的是 bot.py 里真正的 buffer_messages / run_jobs / run_scheduler / fire_schedule / heartbeat 和用户租约。
+
+    python bench/lease_check.py [--users 6] [--messages 60] [--schedules 30] [--seed 1]
+
+租约时间缩短到 LEASE_TTL=1 秒，几秒就能跑完。
+- 并发：消息随机打到两个实例上，定时随机到期。同一用户同一时刻只能有一个实例在调模型，
+  每条消息正好回复一次，每个定时正好发一次，扣费和回复次数对得上，最后任务、定时、租约都清空
+- 接管：A 正在回复一个用户、正在发另一个用户的定时时挂掉。B 要等 A 的租约过期才接手，
+  回复和定时都由 B 补上且只发一次，A 扣过的费不再重扣
+有失败就打印并以 1 退出。
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import fakedb
+from botenv import Telegram, load_instance, quiet_crashes, stop
+
+COST = 2
+CHAT = 5000
+FAST = {
+    "LEASE_TTL": 1, "HEARTBEAT_INTERVAL": 0.3, "JOB_RELOAD_INTERVAL": 0.5, "SCHEDULE_WINDOW": 1,
+    "REPLY_QUIET_DEFAULT": 0.05, "REPLY_QUIET_MAX": 0.2,
+}
+
+class Upstream:
+    """两个实例共用的假上游：记下谁在什么时候给哪个用户调模型，同一用户的调用重叠就记一次冲突"""
+    def __init__(self, rng):
+        self.rng = rng
+        self.active = {}
+        self.calls = []
+        self.overlaps = []
+        self.hang = {}  # (实例, uid) -> Event：这次调用开始后挂住不返回，模拟实例卡死
+
+    def model(self, name):
+        async def call_main_model(model_key, messages, user, on_delta=None):
+            uid = user["_id"]
+            if uid in self.active:
+                self.overlaps.append((uid, self.active[uid], name))
+            self.active[uid] = name
+            self.calls.append((name, uid, datetime.now(timezone.utc)))
+            try:
+                started = self.hang.get((name, uid))
+                if started:
+                    started.set()
+                    await asyncio.Event().wait()
+                await asyncio.sleep(self.rng.uniform(0.002, 0.02))
+            finally:
+                if self.active.get(uid) == name:
+                    del self.active[uid]
+            content = messages[-1]["content"]
+            if "提示是：" in content:
+                return "提醒 " + content.split("提示是：")[1].split("\n")[0]
+            return "收到 " + content.replace("|||", " ")
+        return call_main_model
+
+def start(db, name, telegram, upstream):
+    ns, guard = load_instance(db, name, telegram, models={"m": {"cost": COST}}, overrides=dict(
+        FAST, call_main_model=upstream.model(name),
+        get_context_messages=lambda user, new_messages=None: asyncio.sleep(0, list(new_messages or [])),
+    ))
+    bot = ns["bot"]
+    tasks = [asyncio.ensure_future(ns["run_jobs"](bot)), asyncio.ensure_future(ns["run_scheduler"](bot)),
+             asyncio.ensure_future(ns["heartbeat"]())]
+    return ns, guard, tasks
+
+async def add_users(ns, db, uids):
+    for uid in uids:
+        await ns["get_user"](uid)
+    db["users"].update_many({}, {"$set": {"points": 1000}})
+
+def add_schedule(db, uid, hint, due_ts):
+    db["schedules"].insert_one({"user_id": str(uid), "chat_id": CHAT + uid, "type": "定时", "hint": hint,
+                                "due_at": datetime.fromtimestamp(due_ts, timezone.utc)})
+
+async def settle(db, instances, done, timeout):
+    """等到 done() 成立、任务和定时都清空、各实例的用户队列都跑完"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        if done() and not db["jobs"].docs and not db["schedules"].docs and not any(ns["user_workers"] for ns in instances):
+            return True
+        await asyncio.sleep(0.02)
+    return False
+
+def sent_to(telegram, uid):
+    return [text for chat, text in telegram.sent if chat == CHAT + uid]
+
+def once(errors, label, texts, token):
+    count = sum(text.split()[1:].count(token) for text in texts)
+    if count != 1:
+        errors.append(f"{label} {token}: 发了 {count} 次")
+
+async def concurrent(users, count, schedules, seed):
+    rng = random.Random(seed)
+    db = fakedb.FakeDB()
+    telegram = Telegram()
+    upstream = Upstream(rng)
+    a, _, a_tasks = start(db, "A", telegram, upstream)
+    b, _, b_tasks = start(db, "B", telegram, upstream)
+    uids = list(range(1, users + 1))
+    await add_users(a, db, uids)
+    now = time.time()
+    for i in range(schedules):
+        add_schedule(db, rng.choice(uids), f"s{i}", now + rng.uniform(-1, 2))
+    msgs = {uid: [] for uid in uids}
+    for i in range(count):
+        uid = rng.choice(uids)
+        text = f"u{uid}-m{i}"
+        msgs[uid].append(text)
+        ns = rng.choice([a, b])
+        await ns["buffer_messages"](uid, CHAT + uid, [{"type": "text", "content": text, "timestamp": float(i)}])
+        await asyncio.sleep(rng.uniform(0, 0.03))
+    # 最后一条消息的安静期过了以后，所有消息都该回过了
+    total = count + schedules
+    settled = await settle(db, [a, b], lambda: sum(len(t.split()) - 1 for _, t in telegram.sent) >= total, 20)
+    await stop(a, a_tasks)
+    await stop(b, b_tasks)
+
+    errors = [] if settled else ["20 秒内没跑完"]
+    for uid, other, name in upstream.overlaps:
+        errors.append(f"用户 {uid}: {other} 还没回完 {name} 就开始调模型")
+    for uid in uids:
+        sent = sent_to(telegram, uid)
+        replies = [t for t in sent if t.startswith("收到")]
+        for text in msgs[uid]:
+            once(errors, "回复", replies, text)
+        history = [part for m in db["messages"].find({"user_id": str(uid), "role": "user"}) for part in m["content"].split("|||")]
+        if sorted(history) != sorted(msgs[uid]):
+            errors.append(f"用户 {uid} 聊天记录: {len(history)} / {len(msgs[uid])} 条")
+        charged = 1000 - db["users"].find_one({"_id": str(uid)})["points"]
+        if charged != COST * len(replies):
+            errors.append(f"用户 {uid}: 回复 {len(replies)} 次，扣了 {charged}")
+    reminders = [t for _, t in telegram.sent if t.startswith("提醒")]
+    for i in range(schedules):
+        once(errors, "定时", reminders, f"s{i}")
+    if db["leases"].docs:
+        errors.append(f"还剩租约 {sorted(db['leases'].docs)}")
+    holders = {}
+    for name, uid, _ in upstream.calls:
+        holders.setdefault(name, set()).add(uid)
+    return errors, f"{len(upstream.calls)} 次调模型，A 处理 {len(holders.get('A', ()))} 个用户、B 处理 {len(holders.get('B', ()))} 个"
+
+async def takeover():
+    db = fakedb.FakeDB()
+    telegram = Telegram()
+    upstream = Upstream(random.Random(0))
+    victim, other = 1, 2
+    replying, firing = asyncio.Event(), asyncio.Event()
+    upstream.hang = {("A", str(victim)): replying, ("A", str(other)): firing}
+    a, a_guard, a_tasks = start(db, "A", telegram, upstream)
+    await add_users(a, db, [victim, other])
+    await a["buffer_messages"](victim, CHAT + victim, [{"type": "text", "content": "在吗", "timestamp": 1.0}])
+    add_schedule(db, other, "s0", time.time())
+    errors = []
+    try:
+        await asyncio.wait_for(asyncio.gather(replying.wait(), firing.wait()), 5)
+    except asyncio.TimeoutError:
+        errors.append("A 没有开始回复或发定时")
+    b, _, b_tasks = start(db, "B", telegram, upstream)
+    await asyncio.sleep(0.5)
+    # A 挂掉：之后它的读写都不生效，租约、任务、定时的领取都留在库里等过期
+    a_guard.dead = True
+    await stop(a, a_tasks)
+    expires = {uid: db["leases"].find_one({"_id": str(uid)}) for uid in (victim, other)}
+    job = db["jobs"].find_one({"user_id": str(victim)})
+    sched = db["schedules"].find_one({"user_id": str(other)})
+    settled = await settle(db, [b], lambda: len(telegram.sent) >= 2, 10)
+    await stop(b, b_tasks)
+
+    if not settled:
+        errors.append("B 10 秒内没接手完")
+    for uid, other_name, name in upstream.overlaps:
+        errors.append(f"用户 {uid}: {other_name} 还没回完 {name} 就开始调模型")
+    for uid, claim, label in ((victim, job, "回复任务"), (other, sched, "定时")):
+        lease = expires[uid]
+        if not lease or lease["owner"] != "A" or not claim or claim.get("owner", claim.get("claimed_by")) != "A":
+            errors.append(f"A 挂掉时没拿着用户 {uid} 的租约和{label}")
+            continue
+        calls = [at for name, called, at in upstream.calls if name == "B" and called == str(uid)]
+        expired = max(lease["expires"], claim["lease_until"])
+        if len(calls) != 1:
+            errors.append(f"用户 {uid}: B 调了 {len(calls)} 次模型")
+        elif calls[0] < expired:
+            errors.append(f"用户 {uid}: A 的租约 {expired:%S.%f} 过期前 B 就在 {calls[0]:%S.%f} 接手了")
+    once(errors, "接手的回复", sent_to(telegram, victim), "在吗")
+    once(errors, "接手的定时", sent_to(telegram, other), "s0")
+    charged = 1000 - db["users"].find_one({"_id": str(victim)})["points"]
+    if charged != COST:
+        errors.append(f"接手的回复扣了 {charged}")
+    if db["leases"].docs:
+        errors.append(f"还剩租约 {sorted(db['leases'].docs)}")
+    return errors
+
+async def run(users, count, schedules, seed):
+    asyncio.get_running_loop().set_exception_handler(quiet_crashes)
+    failures = 0
+    errors, summary = await concurrent(users, count, schedules, seed)
+    for e in errors:
+        print(f"  {e}")
+    print(f"并发: {summary}，失败 {len(errors)}")
+    failures += len(errors)
+    errors = await takeover()
+    for e in errors:
+        print(f"  {e}")
+    print(f"接管: 失败 {len(errors)}")
+    return failures + len(errors)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=6)
+    parser.add_argument("--messages", type=int, default=60)
+    parser.add_argument("--schedules", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    failures = asyncio.run(run(args.users, args.messages, args.schedules, args.seed))
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
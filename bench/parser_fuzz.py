@@ -0,0 +1,107 @@
+"""回复解析器（scan_reply / parse_response）的等价性 fuzz 和基准。
+
+    python bench/parser_fuzz.py [--cases 30000] [--seed 1]
+
+和 bench/baseline.py 里的旧解析器逐条比较 reply/raw/chase/chase_delay/schedules/memories，
+[[不发]] 对照旧代码的子串判断。输入有两部分：
+- bench/replies.jsonl：手写的真实风格回复（每行一个 JSON 字符串）
+- 用真实标签形状随机拼出来的回复，--cases 条（已知差异的两种形状只放在语料里，不参与随机拼接）
+有不一致就打印前几条并以 1 退出。
+
+已知的有意差异单独计数，不算不一致：
+- [[YYYY-MM-DD HH:MM]]：旧代码先删了里层的单括号形式，留下一个 "[]"
+- 内容为空的 [[追]]/[[记忆]]：旧正则的 (.+?) 至少吃一个字符，会把下一个 [[标签]] 当成内容吞掉（或把标签留在正文里）
+时间固定在 2026-10-18 00:00（北京时间）：不带日期的 HH:MM 新代码过了点会顺延到明天，
+零点时所有 HH:MM 都还没到，和旧代码一致。
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import baseline
+from botsrc import load
+
+NOW = datetime(2026, 10, 18, 0, 0, tzinfo=timezone(timedelta(hours=8)))
+KEYS = ("reply", "raw", "chase", "chase_delay", "schedules", "memories")
+KNOWN_DIFFERENCES = [
+    ("[[YYYY-MM-DD HH:MM]] 旧代码留下 []", re.compile(r'\[\[\d{4}-\d{1,2}-\d{1,2}\s+\d{1,2}:\d{2}\]\]')),
+    ("空的 [[追]]/[[记忆]] 旧代码吞掉下一个标签", re.compile(r'\[\[(?:追(?:\s+\d+分钟)?|记忆)\]\]\s*(?:\[\[|$)')),
+]
+TAG_TOKENS = [
+    "你好呀", "今天怎么样？", "哈哈哈", " ", "|||", "|||", "\n", "嗯嗯~", "好的！", "[图片]", "a[0]", "[链接]",
+    "[[记忆]] 用户喜欢猫", "[[记忆]]用户叫小明\n", "[[追 5分钟]] 人呢？", "[[追]] 在吗",
+    "[[定时 12:30 提醒吃饭]]", "[[定时 10-19 08:00 叫起床]]", "[[定时 2026-10-20 09:00 周一了]]",
+    "[[想念 2小时后 想你了]]", "[[想念 18:00 下班没]]", "[[不发]]",
+    "[[10-18 12:30]] ", "[10-18 12:30] ", "[[12:30]]", "[2026-10-18 12:30] ",
+    "[[未知标签]]",
+]
+
+def load_new():
+    ns = {"re": re, "datetime": datetime, "timedelta": timedelta, "get_cn_time": lambda: NOW}
+    return load(["TIME_TAG", "TIME_TAG_PATTERN", "CONTROL_TAG_PATTERN", "clean_ai_time_tags", "scan_reply",
+                 "next_date_for", "parse_response"], ns)
+
+def load_corpus():
+    with open(os.path.join(HERE, "replies.jsonl"), encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def random_replies(n, seed):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(TAG_TOKENS) for _ in range(rng.randint(1, 14))) for _ in range(n)]
+
+def compare(new, texts):
+    mismatches, known = [], 0
+    for text in texts:
+        a = baseline.parse_response(text, {})
+        b = new["parse_response"](text, {})
+        diff = [k for k in KEYS if a[k] != b[k]]
+        if b["suppress"] != ("[[不发]]" in baseline.clean_ai_time_tags(text)):
+            diff.append("suppress")
+        if not diff:
+            continue
+        if any(p.search(text) for _, p in KNOWN_DIFFERENCES):
+            known += 1
+        else:
+            mismatches.append((text, {k: (a.get(k), b.get(k)) for k in diff}))
+    return mismatches, known
+
+def per_call_us(fn, texts, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            fn(text, {})
+    return (time.perf_counter() - start) / (repeat * len(texts)) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cases", type=int, default=30000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    baseline.get_cn_time = lambda: NOW
+    new = load_new()
+    corpus = load_corpus()
+    fuzz = random_replies(args.cases, args.seed)
+    failed = False
+    for name, texts in (("corpus", corpus), ("fuzz", fuzz)):
+        mismatches, known = compare(new, texts)
+        print(f"{name}: {len(texts)} 条，不一致 {len(mismatches)}，已知差异 {known}")
+        for text, diff in mismatches[:5]:
+            print(f"  {text!r}")
+            for k, (old, cur) in diff.items():
+                print(f"    {k}: 旧 {old!r} / 新 {cur!r}")
+        failed = failed or bool(mismatches)
+    for name, texts, repeat in (("corpus", corpus, 200), ("fuzz", fuzz[:3000], 5)):
+        old_us = per_call_us(baseline.parse_response, texts, repeat)
+        new_us = per_call_us(new["parse_response"], texts, repeat)
+        print(f"{name}: 旧 {old_us:.1f} us -> 新 {new_us:.1f} us / 次")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -4,14 +4,40 @@ import asyncio
 import random
 import re
 import threading
-import queue
+import signal
+import atexit
+import sys
 import io
 import base64
+import time
+import heapq
+import math
+import hashlib
+import gzip
+import html
+import tempfile
+import socket
+from collections import deque, OrderedDict
+from itertools import chain, islice
+from bisect import bisect_left
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 from datetime import datetime, timezone, timedelta
 from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.request import HTTPXRequest
 import httpx
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from bson import Binary
+import gridfs
+
+try:
+    import h2  # noqa: F401
+    HAS_H2 = True
+except ImportError:
+    HAS_H2 = False
 
 # ============== 时区 ==============
 
@@ -23,14 +49,48 @@ def get_cn_time():
 # ============== MongoDB ==============
 
 MONGO_URI = os.environ.get("MONGO_URI")
-mongo_client = MongoClient(MONGO_URI)
+# 第一次操作时才连接：文档解析子进程也会导入本模块，但用不到数据库
+mongo_client = MongoClient(MONGO_URI, connect=False)
 db = mongo_client["chatbot"]
 users_col = db["users"]
 schedules_col = db["schedules"]
 images_col = db["images"]
 config_col = db["config"]
+messages_col = db["messages"]
+jobs_col = db["jobs"]
+leases_col = db["leases"]
+extracts_col = db["extracts"]
+doc_chunks_col = db["doc_chunks"]
+image_fs = gridfs.GridFS(db, collection="image_files")
+
+# pymongo 是同步驱动：事件循环里的数据库操作都放到线程池执行，一个慢查询不会卡住其他用户
+DB_THREADS = int(os.environ.get("DB_THREADS", "16"))
+db_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+
+async def run_db(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(db_executor, partial(fn, *args, **kwargs))
+
+def find_all(col, query, projection=None, sort=None, limit=0):
+    cursor = col.find(query, projection)
+    if sort:
+        cursor = cursor.sort(sort)
+    if limit:
+        cursor = cursor.limit(limit)
+    return list(cursor)
 
 def init_db():
+    messages_col.create_index([("user_id", 1), ("timestamp", 1), ("_id", 1)])
+    init_image_indexes()
+    migrate_schedules()
+    users_col.create_index("last_activity", sparse=True)
+    jobs_col.create_index([("status", 1), ("due_at", 1)])
+    jobs_col.create_index("key", unique=True, partialFilterExpression={"status": "pending"})
+    jobs_col.create_index([("status", 1), ("lease_until", 1)])
+    recover_jobs(startup=True)
+    init_extract_cache()
+    doc_chunks_col.create_index([("user_id", 1), ("created", 1), ("seq", 1)])
+    doc_chunks_col.create_index([("user_id", 1), ("doc_id", 1)])
+    schedules_col.create_index([("due_at", 1), ("_id", 1)])
     if not config_col.find_one({"_id": "apis"}):
         default_apis = {
             "小鸡农场": {"url": os.environ.get("API_URL_1", ""), "key": os.environ.get("API_KEY_1", ""), "display_user": "API 1"},
@@ -48,44 +108,347 @@ def init_db():
             "4.5o": {"api": "ekan8", "model": "福利-claude-opus-4-5", "cost": 2, "admin_only": False, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Opus 4.5", "vision": True},
             "按量4.5o": {"api": "ekan8", "model": "按量-claude-opus-4-5-20251101", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Opus 4.5", "vision": True},
             "code 4.5h": {"api": "呆呆鸟", "model": "[code]claude-haiku-4-5-20251001", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Haiku 4.5", "vision": True},
-            "code 4.5s": {"api": "呆呆鸟", "model": "[code]claude-sonnet-4-5-20250929", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Sonnet 4.5", "vision": True},
+            "code 4.5s": {"api": "呆呆鸟", "model": "[code]claude-sonnet-4-5-20250929", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Sonnet 4.5", "vision": True, "fallbacks": ["kiro 4.5s", "aws 4.5s", "福利4.5s"]},
             "code 4.5o": {"api": "呆呆鸟", "model": "[code]claude-opus-4-5-20251101", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Opus 4.5", "vision": True},
             "啾啾4.5s": {"api": "呆呆鸟", "model": "[啾啾]claude-sonnet-4-5-20250929", "cost": 5, "admin_only": False, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Sonnet 4.5", "vision": True},
             "啾啾4.5o": {"api": "呆呆鸟", "model": "[啾啾]claude-opus-4-5-20251101", "cost": 10, "admin_only": False, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Opus 4.5", "vision": True},
             "awsq 4.5h": {"api": "Youth", "model": "(awsq)claude-haiku-4-5-20251001", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Haiku 4.5", "vision": True},
             "awsq 4.5st": {"api": "Youth", "model": "(awsq)claude-sonnet-4-5-20250929-thinking", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Sonnet 4.5", "vision": True},
             "kiro 4.5h": {"api": "Youth", "model": "(kiro)claude-haiku-4-5-20251001", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Haiku 4.5", "vision": True},
-            "kiro 4.5s": {"api": "Youth", "model": "(kiro)claude-sonnet-4-5-20250929", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Sonnet 4.5", "vision": True},
+            "kiro 4.5s": {"api": "Youth", "model": "(kiro)claude-sonnet-4-5-20250929", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Sonnet 4.5", "vision": True, "fallbacks": ["aws 4.5s", "code 4.5s", "福利4.5s"]},
             "kiro 4.5o": {"api": "Youth", "model": "(kiro)claude-opus-4-5-20251101", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Opus 4.5", "vision": True},
-            "aws 4.5s": {"api": "Youth", "model": "[aws]claude-sonnet-4-5-20250929", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Sonnet 4.5", "vision": True},
+            "aws 4.5s": {"api": "Youth", "model": "[aws]claude-sonnet-4-5-20250929", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Sonnet 4.5", "vision": True, "fallbacks": ["kiro 4.5s", "code 4.5s", "福利4.5s"]},
             "aws 4.5o": {"api": "Youth", "model": "[aws]claude-opus-4-5-20251101", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Opus 4.5", "vision": True},
             "福利4s": {"api": "福利Youth", "model": "claude-4-sonnet-cs", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Sonnet 4", "vision": True},
-            "福利4.5s": {"api": "福利Youth", "model": "claude-4.5-sonnet-cs", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Sonnet 4.5", "vision": True},
+            "福利4.5s": {"api": "福利Youth", "model": "claude-4.5-sonnet-cs", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Sonnet 4.5", "vision": True, "fallbacks": ["code 4.5s", "kiro 4.5s", "aws 4.5s"]},
             "福利4.1o": {"api": "福利Youth", "model": "claude-opus-4.1-cs", "cost": 0, "admin_only": True, "max_tokens": 190000, "ai_name": "Claude", "model_name": "Claude Opus 4.1", "vision": True},
         }
         config_col.insert_one({"_id": "models", "data": default_models})
+    get_apis()
+    get_models()
+    load_token_counters()
+    moved = migrate_history()
+    if moved:
+        print(f"[DB] Migrated {moved} history messages")
+
+# ============== 配置缓存 ==============
+
+# 配置文档带 version 字段，每次保存 +1。读配置只走内存；
+# 后台每 CONFIG_CHECK_INTERVAL 秒只查一次 version，别的实例改过才重新拉
+CONFIG_CHECK_INTERVAL = int(os.environ.get("CONFIG_CHECK_INTERVAL", "30"))
+config_cache = {}
+config_stats = {"hits": 0, "misses": 0, "checks": 0}
+
+def copy_config(data):
+    """配置是两层结构（名字 -> 字段），逐层复制。调用方改返回值不会动到缓存，缓存只在写库成功后替换"""
+    return {k: {f: list(x) if isinstance(x, list) else x for f, x in v.items()} if isinstance(v, dict) else v
+            for k, v in data.items()}
+
+def load_config(name):
+    entry = config_cache.get(name)
+    if entry:
+        config_stats["hits"] += 1
+        return copy_config(entry["data"])
+    config_stats["misses"] += 1
+    doc = config_col.find_one({"_id": name})
+    config_cache[name] = {"data": doc["data"] if doc else {}, "version": doc.get("version", 0) if doc else 0}
+    return copy_config(config_cache[name]["data"])
+
+def refresh_config():
+    for name, entry in list(config_cache.items()):
+        config_stats["checks"] += 1
+        doc = config_col.find_one({"_id": name}, {"version": 1})
+        if doc and doc.get("version", 0) != entry["version"]:
+            config_stats["misses"] += 1
+            doc = config_col.find_one({"_id": name})
+            config_cache[name] = {"data": doc["data"], "version": doc.get("version", 0)}
+
+def store_config(name, data):
+    doc = config_col.find_one_and_update(
+        {"_id": name}, {"$set": {"data": data}, "$inc": {"version": 1}},
+        projection={"version": 1}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    config_cache[name] = {"data": copy_config(data), "version": doc["version"]}
 
 def get_apis():
-    doc = config_col.find_one({"_id": "apis"})
-    return doc["data"] if doc else {}
+    return load_config("apis")
 
-def save_apis(apis):
-    config_col.update_one({"_id": "apis"}, {"$set": {"data": apis}}, upsert=True)
+async def save_apis(apis):
+    await run_db(store_config, "apis", apis)
 
 def get_models():
-    doc = config_col.find_one({"_id": "models"})
-    return doc["data"] if doc else {}
+    return load_config("models")
+
+async def save_models(models):
+    await run_db(store_config, "models", models)
+
+# ============== 聊天记录 ==============
+
+# 聊天记录单独存在 messages 集合，一条消息一个文档，按 (user_id, timestamp) 索引
+
+async def append_messages(user_id, msgs):
+    docs = []
+    for m in msgs:
+        tokenizer = tokenizer_for(m.get("model"))
+        docs.append(dict(m, user_id=str(user_id), tokens=message_tokens(m, tokenizer), tokenizer=tokenizer))
+    await run_db(messages_col.insert_many, docs)
+    extend_context_cache(user_id, docs)
+
+def history_page(user_id, limit, before=None, after=None, newest=False):
+    """按 (timestamp, _id) 翻页。before=(ts, id)：取它之前最近的 limit 条，新的在前；after：取它之后的 limit 条，旧的在前。
+    都不给时默认从最早的开始；newest=True 则从最新的往前取"""
+    query = {"user_id": str(user_id)}
+    order = -1 if before or newest else 1
+    key = before or after
+    if key:
+        op = "$lt" if before else "$gt"
+        query["$or"] = [{"timestamp": {op: key[0]}}, {"timestamp": key[0], "_id": {op: key[1]}}]
+    return find_all(messages_col, query, {"user_id": 0}, sort=[("timestamp", order), ("_id", order)], limit=limit)
+
+async def history_pages(user_id, page_size=500):
+    """按时间顺序一页一页读聊天记录"""
+    after = None
+    while True:
+        page = await run_db(history_page, user_id, page_size, after=after)
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        after = (page[-1]["timestamp"], page[-1]["_id"])
+
+async def has_history(user_id):
+    return await run_db(messages_col.find_one, {"user_id": str(user_id)}, {"_id": 1}) is not None
+
+def delete_history(user_id):
+    image_ids = messages_col.distinct("image_ids", {"user_id": str(user_id)})
+    messages_col.delete_many({"user_id": str(user_id)})
+    doc_chunks_col.delete_many({"user_id": str(user_id)})
+    # 其他实例看到版本号变了就扔掉自己的上下文缓存
+    users_col.update_one({"_id": str(user_id)}, {"$inc": {"history_epoch": 1}})
+    delete_unreferenced_images(image_ids)
+
+async def clear_history(user_id):
+    await run_db(delete_history, user_id)
+    drop_context_cache(user_id)
+    doc_indexes.pop(str(user_id), None)
+
+def migrate_history():
+    """把旧版 users 文档里的 history 数组搬到 messages 集合。可重复执行：_id 固定，已搬过的跳过。
+    没有时间戳的旧消息会和前一条同一个 timestamp，顺序靠 _id 决定，所以序号补零到定长"""
+    moved = 0
+    for doc in users_col.find({"history": {"$exists": True}}, {"history": 1}):
+        uid = doc["_id"]
+        docs = []
+        last_ts = 0
+        for i, m in enumerate(doc.get("history") or []):
+            last_ts = m.get("timestamp") or last_ts
+            tokenizer = tokenizer_for(m.get("model"))
+            docs.append(dict(m, _id=f"{uid}:{i:08d}", user_id=uid, timestamp=last_ts, tokens=message_tokens(m, tokenizer), tokenizer=tokenizer))
+        if docs:
+            try:
+                messages_col.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                    raise
+        users_col.update_one({"_id": uid}, {"$unset": {"history": ""}})
+        moved += len(docs)
+    return moved
+
+# ============== 图片存储 ==============
+
+# 图片入库前缩到长边 IMAGE_MAX_EDGE 以内、重新压成 JPEG，以二进制存储；
+# 超过 IMAGE_INLINE_MAX 的放 GridFS。发给模型时才转成 data URL
+IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", "1568"))
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "85"))
+IMAGE_INLINE_MAX = 4 * 1024 * 1024
+
+def prepare_image(raw):
+    """返回 (data, mime, width, height)；没装 Pillow 或解码失败就原样保存，宽高为 None"""
+    try:
+        from PIL import Image, ImageOps
+        img = ImageOps.exif_transpose(Image.open(io.BytesIO(raw)))
+        resized = max(img.size) > IMAGE_MAX_EDGE
+        if resized:
+            img.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=IMAGE_QUALITY, optimize=True)
+        data = out.getvalue()
+        if not resized and len(data) >= len(raw):
+            data = raw
+        return data, "image/jpeg", img.width, img.height
+    except Exception as e:
+        print(f"[Image] Prepare error: {e}")
+        return raw, "image/jpeg", None, None
 
-def save_models(models):
-    config_col.update_one({"_id": "models"}, {"$set": {"data": models}}, upsert=True)
+def write_image(image_id, data, mime, width, height):
+    doc = {"mime": mime, "size": len(data), "width": width, "height": height, "created": get_cn_time().timestamp(), "created_at": datetime.now(timezone.utc)}
+    if len(data) > IMAGE_INLINE_MAX:
+        doc["file_id"] = image_fs.put(data, filename=image_id, contentType=mime)
+    else:
+        doc["data"] = Binary(data)
+    images_col.update_one({"_id": image_id}, {"$set": doc}, upsert=True)
 
-def save_image(image_id, base64_data):
-    images_col.update_one({"_id": image_id}, {"$set": {"data": base64_data, "created": get_cn_time().timestamp()}}, upsert=True)
+async def save_image(image_id, data, mime="image/jpeg", width=None, height=None):
+    await run_db(write_image, image_id, data, mime, width, height)
+    cache_image(image_id, (mime, data))
     return image_id
 
-def get_image(image_id):
-    doc = images_col.find_one({"_id": image_id})
-    return doc["data"] if doc else None
+def load_image_doc(doc):
+    if doc.get("file_id"):
+        return doc.get("mime", "image/jpeg"), image_fs.get(doc["file_id"]).read()
+    data = doc.get("data")
+    if isinstance(data, str):
+        # 旧版存的是 base64 字符串
+        return "image/jpeg", base64.b64decode(data)
+    return doc.get("mime", "image/jpeg"), bytes(data)
+
+def image_data_url(image):
+    mime, data = image
+    return f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+
+# 图片内容的 LRU 缓存，按字节数限制大小，值为 (mime, bytes)
+IMAGE_CACHE_BYTES = int(os.environ.get("IMAGE_CACHE_MB", "64")) * 1024 * 1024
+image_cache = OrderedDict()
+image_cache_stats = {"hits": 0, "misses": 0, "bytes": 0}
+
+def cache_image(image_id, image):
+    size = len(image[1])
+    if size > IMAGE_CACHE_BYTES:
+        return
+    old = image_cache.pop(image_id, None)
+    if old is not None:
+        image_cache_stats["bytes"] -= len(old[1])
+    image_cache[image_id] = image
+    image_cache_stats["bytes"] += size
+    while image_cache_stats["bytes"] > IMAGE_CACHE_BYTES:
+        _, evicted = image_cache.popitem(last=False)
+        image_cache_stats["bytes"] -= len(evicted[1])
+
+def fetch_images(image_ids):
+    found = {}
+    for doc in images_col.find({"_id": {"$in": image_ids}}):
+        try:
+            found[doc["_id"]] = load_image_doc(doc)
+        except Exception as e:
+            print(f"[Image] Load error {doc['_id']}: {e}")
+    return found
+
+async def get_images(image_ids):
+    """批量取图：先查缓存，没命中的一次 $in 查询补齐。返回 {id: (mime, bytes)}"""
+    found = {}
+    missing = []
+    for image_id in image_ids:
+        if image_id in found:
+            continue
+        image = image_cache.get(image_id)
+        if image is not None:
+            image_cache.move_to_end(image_id)
+            image_cache_stats["hits"] += 1
+            found[image_id] = image
+        else:
+            missing.append(image_id)
+    if missing:
+        image_cache_stats["misses"] += len(missing)
+        for image_id, image in (await run_db(fetch_images, missing)).items():
+            found[image_id] = image
+            cache_image(image_id, image)
+    return found
+
+# ============== 图片清理 ==============
+
+# created_at 上有 TTL 索引，超过 IMAGE_RETENTION_DAYS 天的图片由 Mongo 自动删（0 表示不过期）；
+# 另外定期扫一遍，删掉没有任何聊天记录引用的图片和 GridFS 里的孤儿文件。
+# 刚上传还在消息缓冲里的图片有 IMAGE_SWEEP_GRACE 秒保护期
+IMAGE_RETENTION_DAYS = int(os.environ.get("IMAGE_RETENTION_DAYS", "30"))
+IMAGE_SWEEP_INTERVAL = int(os.environ.get("IMAGE_SWEEP_HOURS", "6")) * 3600
+IMAGE_SWEEP_GRACE = 3600
+IMAGE_SWEEP_BATCH = 500
+
+def init_image_indexes():
+    messages_col.create_index("image_ids", sparse=True)
+    # 旧图片只有 float 的 created，补上 TTL 需要的日期字段
+    images_col.update_many(
+        {"created_at": {"$exists": False}, "created": {"$exists": True}},
+        [{"$set": {"created_at": {"$toDate": {"$multiply": ["$created", 1000]}}}}]
+    )
+    if IMAGE_RETENTION_DAYS > 0:
+        ttl = IMAGE_RETENTION_DAYS * 86400
+        try:
+            images_col.create_index("created_at", expireAfterSeconds=ttl)
+        except OperationFailure:
+            db.command("collMod", images_col.name, index={"keyPattern": {"created_at": 1}, "expireAfterSeconds": ttl})
+    elif "created_at_1" in images_col.index_information():
+        images_col.drop_index("created_at_1")
+
+def delete_images(image_ids):
+    if not image_ids:
+        return
+    files = [d["file_id"] for d in images_col.find({"_id": {"$in": image_ids}, "file_id": {"$exists": True}}, {"file_id": 1})]
+    images_col.delete_many({"_id": {"$in": image_ids}})
+    for f in files:
+        image_fs.delete(f)
+
+def referenced_images(image_ids):
+    """还有聊天记录或消息缓冲（待回复的 reply 任务）引用着的图片。图片 id 按 file_unique_id 跨用户共用"""
+    referenced = set(messages_col.distinct("image_ids", {"image_ids": {"$in": image_ids}}))
+    referenced.update(jobs_col.distinct("messages.image_id", {"messages.image_id": {"$in": image_ids}}))
+    return referenced
+
+def delete_unreferenced_images(image_ids):
+    """只删没人引用的；和定期清理一样，IMAGE_SWEEP_GRACE 秒内刚存或刚复用的不删"""
+    if not image_ids:
+        return
+    referenced = referenced_images(image_ids)
+    cutoff = get_cn_time().timestamp() - IMAGE_SWEEP_GRACE
+    referenced.update(d["_id"] for d in images_col.find({"_id": {"$in": image_ids}, "created": {"$gte": cutoff}}, {"_id": 1}))
+    delete_images([i for i in image_ids if i not in referenced])
+
+def sweep_images(dry_run=True):
+    """清理孤儿图片，返回统计。dry_run 时只统计不删除"""
+    report = {"images": 0, "image_bytes": 0, "files": 0, "file_bytes": 0}
+    cutoff = get_cn_time().timestamp() - IMAGE_SWEEP_GRACE
+
+    def flush_images(batch):
+        referenced = referenced_images([d["_id"] for d in batch])
+        orphans = [d for d in batch if d["_id"] not in referenced]
+        report["images"] += len(orphans)
+        report["image_bytes"] += sum(d.get("size") or 0 for d in orphans)
+        if not dry_run:
+            delete_images([d["_id"] for d in orphans])
+
+    batch = []
+    for doc in images_col.aggregate([
+        {"$match": {"created": {"$lt": cutoff}}},
+        {"$project": {"size": {"$ifNull": ["$size", {"$cond": [{"$eq": [{"$type": "$data"}, "string"]}, {"$strLenBytes": "$data"}, 0]}]}}},
+    ]):
+        batch.append(doc)
+        if len(batch) >= IMAGE_SWEEP_BATCH:
+            flush_images(batch)
+            batch = []
+    if batch:
+        flush_images(batch)
+
+    # 图片文档被 TTL 删了以后，GridFS 里的内容不会跟着删
+    def flush_files(batch):
+        alive = {d["_id"] for d in images_col.find({"_id": {"$in": [f["filename"] for f in batch]}}, {"_id": 1})}
+        orphans = [f for f in batch if f["filename"] not in alive]
+        report["files"] += len(orphans)
+        report["file_bytes"] += sum(f.get("length", 0) for f in orphans)
+        if not dry_run:
+            for f in orphans:
+                image_fs.delete(f["_id"])
+
+    batch = []
+    for f in db["image_files.files"].find({"uploadDate": {"$lt": datetime.now(timezone.utc) - timedelta(seconds=IMAGE_SWEEP_GRACE)}}, {"filename": 1, "length": 1}):
+        batch.append(f)
+        if len(batch) >= IMAGE_SWEEP_BATCH:
+            flush_files(batch)
+            batch = []
+    if batch:
+        flush_files(batch)
+    return report
 
 # ============== 配置 ==============
 
@@ -156,7 +519,7 @@ def get_system_prompt(model_key, memories=None):
    多用！话题能继续就追问！
 
 2. 定时消息：[[定时 HH:MM 提示内容]] 或 [[定时 MM-DD HH:MM 提示内容]] 或 [[定时 YYYY-MM-DD HH:MM 提示内容]]
-   不写日期默认当天。
+   不写日期：今天这个点还没到就是今天，已经过了就是明天。
    用户说要做什么事，设定时问结果
    例如：用户说明天考试 → [[定时 01-20 18:00 问考试结果]]
    定时消息触发时你也可以设追问！
@@ -237,232 +600,1113 @@ def get_system_prompt(model_key, memories=None):
 
 # ============== 用户数据 ==============
 
-def get_user(user_id):
+async def get_user(user_id):
     user_id_str = str(user_id)
     today = get_cn_time().strftime("%Y-%m-%d")
-    doc = users_col.find_one({"_id": user_id_str})
+    doc = await run_db(users_col.find_one, {"_id": user_id_str}, {"history": 0})
     if not doc:
         doc = {
             "_id": user_id_str, "points": 20, "default_uses": 100, "last_reset": today,
-            "model": DEFAULT_MODEL, "history": [], "memories": [],
+            "model": DEFAULT_MODEL, "memories": [],
             "context_token_limit": None, "context_round_limit": None,
             "last_activity": None, "chat_id": None,
             "user_name": "用户", "ai_name": "AI"
         }
-        users_col.insert_one(doc)
-    for key in ["memories", "user_name", "ai_name", "history"]:
+        try:
+            await run_db(users_col.insert_one, doc)
+        except DuplicateKeyError:
+            doc = await run_db(users_col.find_one, {"_id": user_id_str}, {"history": 0})
+    for key in ["memories", "user_name", "ai_name"]:
         if key not in doc:
-            doc[key] = [] if key in ["memories", "history"] else ("用户" if key == "user_name" else "AI")
+            doc[key] = [] if key == "memories" else ("用户" if key == "user_name" else "AI")
     if doc.get("last_reset") != today:
         doc["points"] = 20
         doc["default_uses"] = 100
         doc["last_reset"] = today
-        users_col.update_one({"_id": user_id_str}, {"$set": {"points": 20, "default_uses": 100, "last_reset": today}})
+        await run_db(users_col.update_one, {"_id": user_id_str, "last_reset": {"$ne": today}}, {"$set": {"points": 20, "default_uses": 100, "last_reset": today}})
     return doc
 
-def save_user(user_id, user):
-    user_copy = {k: v for k, v in user.items() if k != "_id"}
-    users_col.update_one({"_id": str(user_id)}, {"$set": user_copy}, upsert=True)
+# 写用户只改变动的字段，不整篇覆盖，避免并发的追问/定时任务互相覆盖
+
+async def update_user(user_id, fields):
+    await run_db(users_col.update_one, {"_id": str(user_id)}, {"$set": fields})
+
+# 扣费回执：任务触发的扣费在同一次更新里往 charges 记一条 {job, field, amount}，
+# 同一个任务重试时不会再扣，退款也只退一次（带回执的退款连回执一起删）
+CHARGE_RECEIPTS = 20
+
+async def charge_user(user_id, field, amount, receipt=None):
+    """余额够才原子扣减，返回是否扣成功"""
+    query = {"_id": str(user_id), field: {"$gte": amount}}
+    update = {"$inc": {field: -amount}}
+    if receipt:
+        query["charges.job"] = {"$ne": receipt}
+        update["$push"] = {"charges": {"$each": [{"job": receipt, "field": field, "amount": amount}], "$slice": -CHARGE_RECEIPTS}}
+    res = await run_db(users_col.update_one, query, update)
+    return res.modified_count == 1
+
+async def refund_user(user_id, field, amount, receipt=None):
+    query = {"_id": str(user_id)}
+    update = {"$inc": {field: amount}}
+    if receipt:
+        query["charges.job"] = receipt
+        update["$pull"] = {"charges": {"job": receipt}}
+    await run_db(users_col.update_one, query, update)
+
+def charge_receipt(user, receipt):
+    return next((c for c in user.get("charges") or [] if c["job"] == receipt), None) if receipt else None
+
+async def add_memory(user_id, memory):
+    await run_db(users_col.update_one, {"_id": str(user_id)}, {"$push": {"memories": memory}})
+
+async def remove_memory(user_id, memory):
+    await run_db(users_col.update_one, {"_id": str(user_id)}, {"$pull": {"memories": memory}})
 
 def is_admin(user_id):
     return user_id == ADMIN_ID
 
-# ============== 清理AI输出中的时间标签 ==============
+# ============== 控制标签解析 ==============
+
+# AI 模仿的时间标签：[[12-01 12:30]] [12-01 12:30] [[12:30]] [2025-12-01 12:30] [[2025-12-01 12:30]]
+TIME_TAG = r'\[\[(?:\d{4}-)?\d{1,2}-\d{1,2}\s+\d{1,2}:\d{2}\]\]\s*|\[(?:\d{4}-)?\d{1,2}-\d{1,2}\s+\d{1,2}:\d{2}\]\s*|\[\[\d{1,2}:\d{2}\]\]\s*'
+TIME_TAG_PATTERN = re.compile(TIME_TAG)
+
+# 回复里所有控制标签一次扫完：时间标签直接删；[[记忆]]/[[追]] 吞掉后面的内容直到下一个 [[；
+# [[定时]]/[[想念]] 记下后删掉；[[不发]] 只做标记。不认识的 [[ 原样保留，但也会结束记忆/追问的内容
+CONTROL_TAG_PATTERN = re.compile(
+    rf'(?P<time>{TIME_TAG})'
+    r'|(?P<memory>\[\[记忆\]\])'
+    r'|(?P<chase>\s*\[\[追(?:\s+(?P<chase_min>\d+)分钟)?\]\])'
+    r'|(?P<timer>\[\[定时\s+(?:(?P<timer_date>\d{4}-\d{1,2}-\d{1,2}|\d{1,2}-\d{1,2})\s+)?(?P<timer_at>\d{1,2}:\d{2})\s+(?P<timer_hint>.+?)\]\])'
+    r'|(?P<miss>\[\[想念\s+(?P<miss_at>\d{1,2}:\d{2}|\d+小时后)\s+(?P<miss_hint>.+?)\]\])'
+    r'|(?P<skip>\[\[不发\]\])'
+    r'|(?P<open>\[\[)'
+)
 
 def clean_ai_time_tags(text):
     """清理AI回复中模仿的时间标签"""
-    text = re.sub(r'\[\[\d{1,2}-\d{1,2}\s+\d{1,2}:\d{2}\]\]\s*', '', text)
-    text = re.sub(r'\[\d{1,2}-\d{1,2}\s+\d{1,2}:\d{2}\]\s*', '', text)
-    text = re.sub(r'\[\[\d{1,2}:\d{2}\]\]\s*', '', text)
-    text = re.sub(r'\[\d{4}-\d{1,2}-\d{1,2}\s+\d{1,2}:\d{2}\]\s*', '', text)
-    text = re.sub(r'\[\[\d{4}-\d{1,2}-\d{1,2}\s+\d{1,2}:\d{2}\]\]\s*', '', text)
-    return text
+    return TIME_TAG_PATTERN.sub('', text)
+
+def scan_reply(text):
+    """一次扫描拆出正文和控制标签。
+    reply：去掉所有控制标签后的正文；raw：只去掉时间标签（存进聊天记录的版本）"""
+    result = {"reply": text, "raw": text, "memories": [], "chase": None, "chase_delay": 300, "timers": [], "misses": [], "suppress": False}
+    if "[" not in text:
+        return result  # 大部分回复没有任何标签
+    reply, raw = [], []
+    body = None  # 正在收集内容的 [[记忆]] / [[追]]：[类型, 片段列表, 分钟]
+    pos = 0
+    mark = 0  # [[追]] 会吃掉紧挨着它的空白，但不越过前面的 [[定时]] 等标签
+
+    def close_body():
+        content = "".join(body[1]).strip()
+        if not content:
+            return
+        if body[0] == "memory":
+            result["memories"].append(content)
+        elif result["chase"] is None:
+            result["chase"] = content
+            if body[2]:
+                result["chase_delay"] = int(body[2]) * 60
+
+    for m in CONTROL_TAG_PATTERN.finditer(text):
+        chunk = text[pos:m.start()]
+        raw.append(chunk)
+        (body[1] if body else reply).append(chunk)
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == "time":
+            continue
+        raw.append(m.group())
+        if body:
+            close_body()
+            body = None
+        if kind == "memory":
+            body = ["memory", [], None]
+        elif kind == "chase":
+            while len(reply) > mark and not reply[-1].strip():
+                reply.pop()
+            if len(reply) > mark:
+                reply[-1] = reply[-1].rstrip()
+            body = ["chase", [], m.group("chase_min")]
+        elif kind == "timer":
+            result["timers"].append((m.group("timer_date"), m.group("timer_at"), m.group("timer_hint")))
+        elif kind == "miss":
+            result["misses"].append((m.group("miss_at"), m.group("miss_hint")))
+        elif kind == "skip":
+            result["suppress"] = True
+        else:
+            reply.append(m.group())
+        if kind not in ("memory", "chase"):
+            mark = len(reply)
+    chunk = text[pos:]
+    raw.append(chunk)
+    (body[1] if body else reply).append(chunk)
+    if body:
+        close_body()
+    result["reply"] = "".join(reply)
+    result["raw"] = "".join(raw)
+    return result
 
 # ============== 文件处理 ==============
 
-async def extract_file_content(bot, file_id, file_name):
+# 文档解析放在子进程池里：不卡事件循环，解析器卡死或吃爆内存也只影响子进程。
+# 每个任务有超时（SIGALRM）和内存上限（RLIMIT_AS），PDF/PPT 按页、Excel 按行、全文按字数截断。
+# 子进程用 forkserver 起：主进程里有数据库线程池、事件循环、Flask 等线程，直接 fork 可能把别的线程持有的锁带进子进程卡死。
+# 子进程会重新导入本模块，所以启动代码都放在 __main__ 里
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", "2"))
+EXTRACT_TIMEOUT = int(os.environ.get("EXTRACT_TIMEOUT", "30"))
+EXTRACT_MEMORY_MB = int(os.environ.get("EXTRACT_MEMORY_MB", "512"))
+EXTRACT_MAX_BYTES = 20 * 1024 * 1024  # 机器人本来也只能下载 20MB 以内的文件
+EXTRACT_MAX_PAGES = int(os.environ.get("EXTRACT_MAX_PAGES", "100"))
+EXTRACT_MAX_ROWS = int(os.environ.get("EXTRACT_MAX_ROWS", "2000"))
+EXTRACT_MAX_CHARS = int(os.environ.get("EXTRACT_MAX_CHARS", "100000"))
+EXTRACT_ERRORS = {"pdf": "[无法读取PDF]", "doc": "[无法读取Word]", "docx": "[无法读取Word]", "xls": "[无法读取Excel]",
+                  "xlsx": "[无法读取Excel]", "ppt": "[无法读取PPT]", "pptx": "[无法读取PPT]"}
+extract_pool = None
+extract_slots = None
+
+def extract_worker_init():
+    def on_alarm(*_):
+        raise TimeoutError()
+    signal.signal(signal.SIGALRM, on_alarm)
     try:
-        file = await bot.get_file(file_id)
-        file_bytes = await file.download_as_bytearray()
+        import resource
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+        cap = current + EXTRACT_MEMORY_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (cap, cap))
+    except Exception as e:
+        print(f"[Extract] No memory limit: {e}")
+
+def new_extract_pool():
+    return ProcessPoolExecutor(max_workers=EXTRACT_WORKERS, mp_context=multiprocessing.get_context("forkserver"), initializer=extract_worker_init)
+
+def start_extract_pool():
+    global extract_pool
+    extract_pool = new_extract_pool()
+    # 先跑一个空任务：forkserver 和子进程在启动时就建好，导入出错也能马上发现
+    extract_pool.submit(int).result()
+
+def clip_text(text):
+    if len(text) <= EXTRACT_MAX_CHARS:
+        return text
+    return text[:EXTRACT_MAX_CHARS] + f"\n[内容过长，只保留了前 {EXTRACT_MAX_CHARS} 字]"
+
+def parse_document(data, ext):
+    if ext == 'pdf':
+        import PyPDF2
+        pages = PyPDF2.PdfReader(io.BytesIO(data)).pages
+        parts = [p.extract_text() or "" for p in islice(pages, EXTRACT_MAX_PAGES)]
+        if len(pages) > EXTRACT_MAX_PAGES:
+            parts.append(f"\n[共 {len(pages)} 页，只读取了前 {EXTRACT_MAX_PAGES} 页]")
+        return "".join(parts)
+    if ext in ['doc', 'docx']:
+        from docx import Document
+        return "\n".join(p.text for p in Document(io.BytesIO(data)).paragraphs)
+    if ext in ['xls', 'xlsx']:
+        import openpyxl
+        wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            lines = []
+            for sheet in wb.worksheets:
+                for row in sheet.iter_rows(values_only=True):
+                    if len(lines) >= EXTRACT_MAX_ROWS:
+                        lines.append(f"[表格太长，只读取了前 {EXTRACT_MAX_ROWS} 行]")
+                        return "\n".join(lines)
+                    lines.append(" | ".join("" if c is None else str(c) for c in row))
+            return "\n".join(lines)
+        finally:
+            wb.close()
+    if ext in ['ppt', 'pptx']:
+        from pptx import Presentation
+        slides = Presentation(io.BytesIO(data)).slides
+        parts = [shape.text for slide in islice(slides, EXTRACT_MAX_PAGES) for shape in slide.shapes if hasattr(shape, "text")]
+        if len(slides) > EXTRACT_MAX_PAGES:
+            parts.append(f"[共 {len(slides)} 页，只读取了前 {EXTRACT_MAX_PAGES} 页]")
+        return "\n".join(parts)
+    return f"[不支持: {ext}]"
+
+def extract_document(data, ext):
+    """在子进程里执行，返回 (文本, 是否成功)"""
+    signal.alarm(EXTRACT_TIMEOUT)
+    try:
+        return clip_text(parse_document(data, ext)), True
+    except TimeoutError:
+        return f"[文件太复杂，{EXTRACT_TIMEOUT} 秒内没读完]", False
+    except MemoryError:
+        return "[文件太大，读取时内存不够]", False
+    except Exception:
+        return EXTRACT_ERRORS.get(ext, "[无法读取文件]"), False
+    finally:
+        signal.alarm(0)
+
+async def extract_file_content(bot, file_id, file_name, file_size=None, file_unique_id=None):
+    global extract_pool
+    try:
+        if file_size and file_size > EXTRACT_MAX_BYTES:
+            return f"[文件太大，最多支持 {EXTRACT_MAX_BYTES // 1024 // 1024}MB]"
         ext = file_name.lower().split('.')[-1] if '.' in file_name else ''
-        if ext in ['txt', 'md']:
-            return file_bytes.decode('utf-8', errors='ignore')
-        elif ext == 'pdf':
-            try:
-                import PyPDF2
-                reader = PyPDF2.PdfReader(io.BytesIO(file_bytes))
-                return "".join([p.extract_text() or "" for p in reader.pages])
-            except:
-                return "[无法读取PDF]"
-        elif ext in ['doc', 'docx']:
-            try:
-                from docx import Document
-                doc = Document(io.BytesIO(file_bytes))
-                return "\n".join([p.text for p in doc.paragraphs])
-            except:
-                return "[无法读取Word]"
-        elif ext in ['xls', 'xlsx']:
-            try:
-                import openpyxl
-                wb = openpyxl.load_workbook(io.BytesIO(file_bytes))
-                text = ""
-                for sheet in wb.worksheets:
-                    for row in sheet.iter_rows(values_only=True):
-                        text += " | ".join([str(c) if c else "" for c in row]) + "\n"
-                return text
-            except:
-                return "[无法读取Excel]"
-        elif ext in ['ppt', 'pptx']:
-            try:
-                from pptx import Presentation
-                prs = Presentation(io.BytesIO(file_bytes))
-                text = ""
-                for slide in prs.slides:
-                    for shape in slide.shapes:
-                        if hasattr(shape, "text"):
-                            text += shape.text + "\n"
+        if ext not in EXTRACT_ERRORS and ext not in ['txt', 'md']:
+            return f"[不支持: {ext}]"
+        if file_unique_id:
+            text = await cached_extract(ext, file_unique_id=file_unique_id)
+            if text is not None:
+                file_cache_stats["bytes_saved"] += file_size or 0
                 return text
-            except:
-                return "[无法读取PPT]"
-        return f"[不支持: {ext}]"
+        file = await bot.get_file(file_id)
+        file_bytes = bytes(await file.download_as_bytearray())
+        digest = hashlib.sha256(file_bytes).hexdigest()
+        text = await cached_extract(ext, digest=digest, file_unique_id=file_unique_id)
+        if text is not None:
+            return text
+        if ext in ['txt', 'md']:
+            text, ok = clip_text(file_bytes.decode('utf-8', errors='ignore')), True
+        else:
+            async with extract_slots:
+                pool = extract_pool
+                try:
+                    text, ok = await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(pool, extract_document, file_bytes, ext), EXTRACT_TIMEOUT + 10)
+                except BrokenProcessPool:
+                    # 子进程被杀（超内存等），换一个新池子，旧的不等它收尾
+                    if extract_pool is pool:
+                        extract_pool = new_extract_pool()
+                        pool.shutdown(wait=False, cancel_futures=True)
+                    return EXTRACT_ERRORS[ext]
+        if ok:
+            await run_db(store_extract, ext, digest, file_unique_id, text)
+        return text
+    except asyncio.TimeoutError:
+        return f"[文件太复杂，{EXTRACT_TIMEOUT} 秒内没读完]"
     except Exception as e:
         return f"[文件错误: {e}]"
 
+# ============== 文件缓存 ==============
+
+# 解析过的文档按 "扩展名:sha256" 存进 extracts 集合，并记下 Telegram 的 file_unique_id：
+# 同一个文件再发（不管谁发）先按 file_unique_id 命中，连下载都省了；换了 id 但内容一样按哈希命中，省掉解析。
+# last_used 上有 TTL 索引（EXTRACT_CACHE_DAYS 天没用过就过期），总大小超过 EXTRACT_CACHE_MB 时从最久没用的删起。
+# 图片直接用 img_<file_unique_id> 做 id，重复发的图不再下载、压缩、另存一份
+EXTRACT_CACHE_DAYS = int(os.environ.get("EXTRACT_CACHE_DAYS", "30"))
+EXTRACT_CACHE_BYTES = int(os.environ.get("EXTRACT_CACHE_MB", "200")) * 1024 * 1024
+EXTRACT_TRIM_INTERVAL = 3600
+file_cache_stats = {"doc_hits": 0, "doc_misses": 0, "image_hits": 0, "image_misses": 0, "bytes_saved": 0}
+
+def init_extract_cache():
+    extracts_col.create_index("file_ids")
+    try:
+        extracts_col.create_index("last_used", expireAfterSeconds=EXTRACT_CACHE_DAYS * 86400)
+    except OperationFailure:
+        db.command("collMod", extracts_col.name, index={"keyPattern": {"last_used": 1}, "expireAfterSeconds": EXTRACT_CACHE_DAYS * 86400})
+
+async def cached_extract(ext, digest=None, file_unique_id=None):
+    if digest:
+        query = {"_id": f"{ext}:{digest}"}
+        update = {"$set": {"last_used": datetime.now(timezone.utc)}}
+        if file_unique_id:
+            update["$addToSet"] = {"file_ids": file_unique_id}
+    else:
+        query = {"file_ids": file_unique_id, "ext": ext}
+        update = {"$set": {"last_used": datetime.now(timezone.utc)}}
+    doc = await run_db(extracts_col.find_one_and_update, query, update, projection={"text": 1})
+    if doc:
+        file_cache_stats["doc_hits"] += 1
+        return doc["text"]
+    if digest:
+        file_cache_stats["doc_misses"] += 1  # 按 file_unique_id 没找到时还会再按哈希查一次，只在这里记未命中
+    return None
+
+def store_extract(ext, digest, file_unique_id, text):
+    now = datetime.now(timezone.utc)
+    extracts_col.update_one(
+        {"_id": f"{ext}:{digest}"},
+        {"$set": {"ext": ext, "text": text, "size": len(text.encode("utf-8")), "last_used": now},
+         "$addToSet": {"file_ids": {"$each": [file_unique_id] if file_unique_id else []}}, "$setOnInsert": {"created_at": now}},
+        upsert=True
+    )
+
+def trim_extract_cache():
+    """总大小超过上限时从最久没用的删起，返回删除条数"""
+    total = next(extracts_col.aggregate([{"$group": {"_id": None, "bytes": {"$sum": "$size"}}}]), {}).get("bytes", 0)
+    if total <= EXTRACT_CACHE_BYTES:
+        return 0
+    victims = []
+    for doc in extracts_col.find({}, {"size": 1}).sort("last_used", 1):
+        victims.append(doc["_id"])
+        total -= doc.get("size") or 0
+        if total <= EXTRACT_CACHE_BYTES:
+            break
+    extracts_col.delete_many({"_id": {"$in": victims}})
+    return len(victims)
+
+def reuse_image(image_id):
+    """图片已经存过就刷新时间（免得被 TTL/清理删掉），返回 (宽, 高, 字节数)；没存过返回 None"""
+    doc = images_col.find_one_and_update(
+        {"_id": image_id},
+        {"$set": {"created": get_cn_time().timestamp(), "created_at": datetime.now(timezone.utc)}},
+        projection={"width": 1, "height": 1, "size": 1}
+    )
+    if not doc:
+        return None
+    return doc.get("width"), doc.get("height"), doc.get("size") or 0
+
 # ============== API 调用 ==============
 
-async def call_api(url, key, model, messages):
+# 每个API一个长连接客户端，API配置里可选 timeout / max_connections / http2（需要装 h2）
+http_clients = {}
+
+def get_http_client(api_name, ac):
+    timeout = ac.get("timeout", 120)
+    max_conn = ac.get("max_connections", 20)
+    http2 = bool(ac.get("http2")) and HAS_H2
+    sig = (ac.get("url"), timeout, max_conn, http2)
+    entry = http_clients.get(api_name)
+    if entry and entry[0] == sig:
+        return entry[1]
+    if entry:
+        # 配置改了：旧客户端等在途请求结束后再关
+        asyncio.ensure_future(close_client_later(entry[1], timeout))
+    client = httpx.AsyncClient(
+        timeout=httpx.Timeout(timeout, connect=15),
+        limits=httpx.Limits(max_connections=max_conn, max_keepalive_connections=max_conn, keepalive_expiry=120),
+        http2=http2,
+    )
+    http_clients[api_name] = (sig, client)
+    return client
+
+async def close_client_later(client, delay):
+    await asyncio.sleep(delay)
+    await client.aclose()
+
+async def close_http_clients():
+    for _, client in list(http_clients.values()):
+        try:
+            await client.aclose()
+        except Exception as e:
+            print(f"[HTTP] Close error: {e}")
+    http_clients.clear()
+
+# ============== 上游限流 ==============
+
+# API配置可选 "rpm"（每分钟请求数，令牌桶，"burst" 为桶容量）和 "max_concurrent"（在途请求上限，默认同 max_connections）。
+# 排队的请求按用户轮转放行，一个人连发不会把别人挤到后面；上游回 429 时按 Retry-After 暂停放行并重试一次
+upstream_limiters = {}
+
+def get_limiter(api_name, ac):
+    lim = upstream_limiters.get(api_name)
+    if lim is None:
+        lim = upstream_limiters[api_name] = {"active": 0, "tokens": None, "updated": time.monotonic(), "paused_until": 0, "waiters": OrderedDict(), "timer": None}
+    rpm = ac.get("rpm")
+    lim["rate"] = rpm / 60 if rpm else None
+    lim["burst"] = ac.get("burst", max(1, rpm // 10)) if rpm else None
+    lim["max_concurrent"] = ac.get("max_concurrent", ac.get("max_connections", 20))
+    return lim
+
+def refill_tokens(lim):
+    now = time.monotonic()
+    if lim["tokens"] is None:
+        lim["tokens"] = lim["burst"]
+    lim["tokens"] = min(lim["burst"], lim["tokens"] + (now - lim["updated"]) * lim["rate"])
+    lim["updated"] = now
+
+def pump_limiter(lim):
+    waiters = lim["waiters"]
+    while waiters and lim["active"] < lim["max_concurrent"]:
+        delay = lim["paused_until"] - time.monotonic()
+        if lim["rate"]:
+            refill_tokens(lim)
+            if lim["tokens"] < 1:
+                delay = max(delay, (1 - lim["tokens"]) / lim["rate"])
+        if delay > 0:
+            if not lim["timer"]:
+                lim["timer"] = asyncio.get_running_loop().call_later(delay, wake_limiter, lim)
+            return
+        uid, queue = next(iter(waiters.items()))
+        fut = queue.popleft()
+        if queue:
+            waiters.move_to_end(uid)
+        else:
+            del waiters[uid]
+        if fut.done():
+            continue  # 排队时已取消
+        fut.set_result(None)
+        lim["active"] += 1
+        if lim["rate"]:
+            lim["tokens"] -= 1
+
+def wake_limiter(lim):
+    lim["timer"] = None
+    pump_limiter(lim)
+
+async def acquire_upstream(lim, uid):
+    fut = asyncio.get_running_loop().create_future()
+    lim["waiters"].setdefault(uid, deque()).append(fut)
+    pump_limiter(lim)
+    try:
+        await fut
+    except asyncio.CancelledError:
+        if fut.done() and not fut.cancelled():
+            release_upstream(lim)  # 名额已经给了才被取消，要还回去
+        raise
+
+def release_upstream(lim):
+    lim["active"] -= 1
+    pump_limiter(lim)
+
+def retry_after(resp):
+    try:
+        return min(float(resp.headers.get("retry-after", 5)), 60)
+    except ValueError:
+        return 5
+
+async def call_api(api_name, ac, model, messages, on_delta=None, uid=None):
+    """传了 on_delta 就用 SSE 流式请求，每收到一块都把目前为止的全文交给它；API 配置 "stream": false 可关掉"""
+    url, key = ac.get("url"), ac.get("key")
     if not url or not key:
         raise Exception("API not configured")
-    async with httpx.AsyncClient(timeout=120) as client:
-        resp = await client.post(
-            f"{url}/v1/chat/completions",
-            headers={"Authorization": f"Bearer {key}", "Content-Type": "application/json"},
-            json={"model": model, "messages": messages}
-        )
+    lim = get_limiter(api_name, ac)
+    for attempt in range(2):
+        await acquire_upstream(lim, uid)
+        try:
+            return await post_completion(api_name, ac, model, messages, on_delta)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 429:
+                raise
+            lim["paused_until"] = max(lim["paused_until"], time.monotonic() + retry_after(e.response))
+            if attempt:
+                raise
+        finally:
+            release_upstream(lim)
+
+async def post_completion(api_name, ac, model, messages, on_delta):
+    url = ac["url"]
+    client = get_http_client(api_name, ac)
+    headers = {"Authorization": f"Bearer {ac['key']}", "Content-Type": "application/json"}
+    payload = {"model": model, "messages": messages}
+    if on_delta is None or not ac.get("stream", True):
+        resp = await client.post(f"{url}/v1/chat/completions", headers=headers, json=payload)
         resp.raise_for_status()
         return resp.json()["choices"][0]["message"]["content"]
+    payload["stream"] = True
+    async with client.stream("POST", f"{url}/v1/chat/completions", headers=headers, json=payload) as resp:
+        resp.raise_for_status()
+        if "text/event-stream" not in resp.headers.get("content-type", ""):
+            # 上游忽略了 stream 参数，按普通响应处理
+            await resp.aread()
+            return resp.json()["choices"][0]["message"]["content"]
+        text = ""
+        async for line in resp.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            choices = json.loads(data).get("choices") or []
+            delta = (choices[0].get("delta") or {}).get("content") if choices else None
+            if delta:
+                text += delta
+                await on_delta(text)
+        return text
+
+# ============== 上游健康与故障转移 ==============
+
+# 模型配置可选：
+#   "fallbacks": ["模型key", ...]  同一个模型在其他上游的条目，首选失败时按顺序换
+#   "route": "fastest"            不按配置顺序，按各上游 EWMA 延迟从快到慢试
+# 每个API记 EWMA 延迟和错误率；连续失败 CIRCUIT_FAILS 次熔断 CIRCUIT_COOLDOWN 秒，熔断中的排到最后。
+# 非流式请求在首选迟迟不回时并行再发一个备用（hedge），先成功的算数
+HEALTH_ALPHA = 0.2
+CIRCUIT_FAILS = int(os.environ.get("CIRCUIT_FAILS", "3"))
+CIRCUIT_COOLDOWN = int(os.environ.get("CIRCUIT_COOLDOWN", "60"))
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "20"))
+api_health = {}
+
+def get_health(api_name):
+    return api_health.setdefault(api_name, {"latency": None, "error_rate": 0.0, "fails": 0, "open_until": 0, "calls": 0})
+
+def record_result(api_name, ok, latency=None):
+    h = get_health(api_name)
+    h["calls"] += 1
+    h["error_rate"] += HEALTH_ALPHA * ((0.0 if ok else 1.0) - h["error_rate"])
+    if ok:
+        h["fails"] = 0
+        h["latency"] = latency if h["latency"] is None else h["latency"] + HEALTH_ALPHA * (latency - h["latency"])
+    else:
+        h["fails"] += 1
+        if h["fails"] >= CIRCUIT_FAILS:
+            h["open_until"] = time.monotonic() + CIRCUIT_COOLDOWN
 
-async def call_main_model(model_key, messages, user):
+def circuit_open(api_name):
+    return get_health(api_name)["open_until"] > time.monotonic()
+
+def model_candidates(model_key, admin, needs_vision):
+    """首选 + 可用的备用，返回 [(模型key, 模型配置)]"""
     models = get_models()
     apis = get_apis()
-    mc = models[model_key]
-    ac = apis[mc["api"]]
+    primary = models[model_key]
+    cands = [(model_key, primary)]
+    for k in primary.get("fallbacks", []):
+        mc = models.get(k)
+        if k == model_key or not mc or mc.get("api") not in apis:
+            continue
+        if (mc.get("admin_only") and not admin) or (needs_vision and not mc.get("vision")):
+            continue
+        cands.append((k, mc))
+    if primary.get("route") == "fastest":
+        cands.sort(key=lambda c: get_health(c[1]["api"])["latency"] or 0)
+    # 熔断中的不去掉：全都熔断时还是要试
+    cands.sort(key=lambda c: circuit_open(c[1]["api"]))
+    return cands
+
+async def call_endpoint(mc, messages, on_delta=None, uid=None):
+    start = time.monotonic()
+    try:
+        result = await call_api(mc["api"], get_apis()[mc["api"]], mc["model"], messages, on_delta, uid)
+    except Exception:
+        record_result(mc["api"], False)
+        raise
+    record_result(mc["api"], True, time.monotonic() - start)
+    return result
+
+def hedge_delay(api_name):
+    latency = get_health(api_name)["latency"]
+    return max(HEDGE_MIN_DELAY, latency * 1.5) if latency else HEDGE_MIN_DELAY
+
+async def call_hedged(cands, messages, uid=None):
+    cands = list(cands)
+    tasks = set()
+    last_error = None
+    def launch():
+        key, mc = cands.pop(0)
+        tasks.add(asyncio.ensure_future(call_endpoint(mc, messages, uid=uid)))
+        return mc["api"]
+    api_name = launch()
+    try:
+        while tasks:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay(api_name) if cands else None, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                tasks.discard(t)
+                if t.exception() is None:
+                    return t.result()
+                last_error = t.exception()
+                print(f"[Route] Error: {last_error}")
+            # 失败了马上换下一个；超时则再并行一个（最多同时两个）
+            if cands and (done or len(tasks) < 2):
+                api_name = launch()
+    finally:
+        for t in tasks:
+            t.cancel()
+    raise last_error
+
+async def call_main_model(model_key, messages, user, on_delta=None):
     now = get_cn_time()
     weekdays = ['周一','周二','周三','周四','周五','周六','周日']
     time_info = f"\n\n【当前时间】{now.strftime('%Y年%m月%d日 %H:%M:%S')}（{weekdays[now.weekday()]}）"
     sp = get_system_prompt(model_key, user.get("memories", []))
     full = [{"role": "system", "content": sp + time_info}] + messages
-    return await call_api(ac["url"], ac["key"], mc["model"], full)
+    needs_vision = any(isinstance(m.get("content"), list) for m in messages)
+    cands = model_candidates(model_key, is_admin(int(user["_id"])), needs_vision)
+    if on_delta is None:
+        return await call_hedged(cands, full, user["_id"])
+    # on_delta 返回 True 表示已经有段发给用户了；只收到 token 还没发出去时仍可换上游
+    streamed = []
+    async def track(text):
+        if await on_delta(text) and not streamed:
+            streamed.append(True)
+    last_error = None
+    for key, mc in cands:
+        try:
+            return await call_endpoint(mc, full, track, user["_id"])
+        except Exception as e:
+            last_error = e
+            print(f"[Route] {key} error: {e}")
+            # 已经发出去一部分了，换上游会重复发
+            if streamed:
+                raise
+    raise last_error
 
 # ============== Token 估算与上下文 ==============
 
-def estimate_tokens(content):
+# 模型配置里可选 "tokenizer"：
+#   "heuristic"（默认）：离线估算，中日韩字符按1.5个token，其余约3.5个字符1个token
+#   "tiktoken:<编码名>"：装了 tiktoken 时用。编码在启动时（或第一次用到时在线程池里）加载，
+#     没加载好之前和加载失败都按 heuristic 算。BPE 文件缓存在 TIKTOKEN_CACHE_DIR，
+#     默认是代码旁边的 tiktoken_cache/，把文件放进去就完全离线
+DEFAULT_TOKENIZER = "heuristic"
+CJK_PATTERN = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+IMAGE_DEFAULT_TOKENS = 1000
+
+def count_tokens_heuristic(text):
+    cjk = len(CJK_PATTERN.findall(text))
+    return int(cjk * 1.5 + (len(text) - cjk) / 3.5) + 1
+
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tiktoken_cache"))
+token_counters = {"heuristic": count_tokens_heuristic}
+tokenizers_loading = set()
+
+def load_token_counter(name):
+    """同步加载，可能读盘或下载，只在启动时或线程池里调用"""
+    counter = count_tokens_heuristic
+    try:
+        import tiktoken
+        enc = tiktoken.get_encoding(name[len("tiktoken:"):])
+        counter = lambda text: len(enc.encode(text, disallowed_special=()))
+    except Exception as e:
+        print(f"[Tokens] {name} unavailable, using heuristic: {e}")
+    token_counters[name] = counter
+
+def load_token_counters():
+    for mc in get_models().values():
+        name = mc.get("tokenizer", DEFAULT_TOKENIZER)
+        if name.startswith("tiktoken:") and name not in token_counters:
+            load_token_counter(name)
+
+def get_token_counter(name):
+    """不阻塞：还没加载的编码先交给线程池，这次按 heuristic 算"""
+    counter = token_counters.get(name)
+    if counter:
+        return counter
+    if name.startswith("tiktoken:") and name not in tokenizers_loading:
+        tokenizers_loading.add(name)
+        db_executor.submit(load_token_counter, name)
+    return count_tokens_heuristic
+
+def tokenizer_for(model_key):
+    """编码还没加载好就记成 heuristic，入库的 tokens 不会挂着一个名不副实的分词器"""
+    name = get_models().get(model_key, {}).get("tokenizer", DEFAULT_TOKENIZER)
+    get_token_counter(name)
+    return name if name in token_counters else DEFAULT_TOKENIZER
+
+def image_tokens(width, height):
+    """按长边缩到1568以内后 宽*高/750 估算，和 Claude 的计费方式一致"""
+    scale = min(1.0, 1568 / max(width, height, 1))
+    return int(width * scale * height * scale / 750) + 1
+
+def estimate_tokens(content, tokenizer=DEFAULT_TOKENIZER):
+    count = get_token_counter(tokenizer)
     if isinstance(content, str):
-        return len(content) * 2
+        return count(content)
     elif isinstance(content, list):
         t = 0
         for item in content:
             if item.get("type") == "text":
-                t += len(item["text"]) * 2
+                t += count(item["text"])
             elif item.get("type") == "image_url":
-                t += 1000
+                t += IMAGE_DEFAULT_TOKENS
         return t
     return 100
 
-def get_context_messages(user, new_messages=None):
+def message_tokens(msg, tokenizer):
+    """入库时算好的 tokens 直接用；分词器不同（换了模型）才重新算"""
+    if msg.get("tokenizer") == tokenizer and "tokens" in msg:
+        return msg["tokens"]
+    t = estimate_tokens(msg.get("content", ""), tokenizer)
+    if msg.get("image_ids"):
+        t += msg.get("image_tokens") or IMAGE_DEFAULT_TOKENS * len(msg["image_ids"])
+    return t
+
+# 每个用户缓存最近一段已格式化好的上下文和 token 前缀和：
+# 新消息只格式化新增的那几条，按 token 上限截断用二分查找。
+# 总大小按字节限制（百万 token 窗口的模型一个用户就能占几十MB），超了从最久没用的用户删起
+CONTEXT_CACHE_USERS = int(os.environ.get("CONTEXT_CACHE_USERS", "200"))
+CONTEXT_CACHE_BYTES = int(os.environ.get("CONTEXT_CACHE_MB", "48")) * 1024 * 1024
+CONTEXT_LOAD_BATCH = 200
+context_cache = OrderedDict()
+
+def format_entry(msg, tokenizer):
+    role = msg["role"]
+    content = msg.get("content", "")
+    entry = {"tokens": message_tokens(msg, tokenizer), "key": (msg.get("timestamp"), msg.get("_id"))}
+    if msg.get("doc_ids"):
+        entry["doc_ids"] = msg["doc_ids"]
+    if msg.get("image_ids") and role == "user":
+        tc = content if isinstance(content, str) else ""
+        if msg.get("timestamp"):
+            t = datetime.fromtimestamp(msg["timestamp"], CN_TIMEZONE)
+            tc = f"[[{t.strftime('%m-%d %H:%M')}]] {tc}"
+        entry["role"] = role
+        entry["text"] = tc
+        entry["image_ids"] = msg["image_ids"]
+    elif role == "assistant":
+        # AI的输出保持原始（含[[追]]等），但清掉AI模仿的时间标签
+        c = clean_ai_time_tags(content) if isinstance(content, str) else content
+        entry["payload"] = {"role": role, "content": c}
+    else:
+        if isinstance(content, str) and msg.get("timestamp"):
+            t = datetime.fromtimestamp(msg["timestamp"], CN_TIMEZONE)
+            entry["payload"] = {"role": role, "content": f"[[{t.strftime('%m-%d %H:%M')}]] {content}"}
+        else:
+            entry["payload"] = {"role": role, "content": content}
+    # 粗估常驻内存：字符串按每字符2字节，另加字典本身的开销
+    body = entry["text"] if "text" in entry else entry["payload"]["content"]
+    entry["bytes"] = 2 * len(body if isinstance(body, str) else str(body)) + 300
+    return entry
+
+def build_payload(entry, images):
+    if "payload" in entry:
+        return entry["payload"]
+    parts = []
+    if entry["text"]:
+        parts.append({"type": "text", "text": entry["text"]})
+    for img_id in entry["image_ids"]:
+        ib = images.get(img_id)
+        if ib:
+            parts.append({"type": "image_url", "image_url": {"url": image_data_url(ib)}})
+    return {"role": entry["role"], "content": parts if parts else entry["text"]}
+
+def get_context_cache(user_id, tokenizer, epoch=0):
+    cache = context_cache.get(user_id)
+    if cache and cache["tokenizer"] == tokenizer and cache["epoch"] == epoch:
+        context_cache.move_to_end(user_id)
+        return cache
+    cache = {"tokenizer": tokenizer, "entries": [], "prefix": [0], "complete": False, "bytes": 0, "epoch": epoch}
+    context_cache[user_id] = cache
+    context_cache.move_to_end(user_id)
+    while len(context_cache) > CONTEXT_CACHE_USERS:
+        context_cache.popitem(last=False)
+    return cache
+
+def context_cache_bytes():
+    return sum(c["bytes"] for c in context_cache.values())
+
+def trim_context_cache():
+    """按 LRU 删到字节上限以内。刚用过的用户在最后，单个用户本身就超限时也会被删（下次从库里重读）"""
+    total = context_cache_bytes()
+    while total > CONTEXT_CACHE_BYTES and context_cache:
+        _, evicted = context_cache.popitem(last=False)
+        total -= evicted["bytes"]
+
+async def load_older(cache, user_id):
+    """往前多读一批更早的消息。前插要重建前缀和，但只在窗口不够时发生"""
+    before = cache["entries"][0]["key"] if cache["entries"] else None
+    batch = await run_db(history_page, user_id, CONTEXT_LOAD_BATCH, before=before, newest=True)
+    if len(batch) < CONTEXT_LOAD_BATCH:
+        cache["complete"] = True
+    if not batch:
+        return
+    older = [format_entry(m, cache["tokenizer"]) for m in reversed(batch)]
+    cache["entries"] = older + cache["entries"]
+    cache["bytes"] += sum(e["bytes"] for e in older)
+    prefix = [0]
+    for e in cache["entries"]:
+        prefix.append(prefix[-1] + e["tokens"])
+    cache["prefix"] = prefix
+
+async def load_newer(cache, user_id):
+    """别的实例可能替这个用户回复过：把缓存最后一条之后入库的消息补上。通常是一次查不到东西的索引查询"""
+    if not cache["entries"] and not cache["complete"]:
+        return
+    after = cache["entries"][-1]["key"] if cache["entries"] else None
+    while True:
+        batch = await run_db(history_page, user_id, CONTEXT_LOAD_BATCH, after=after)
+        add_entries(cache, batch)
+        if len(batch) < CONTEXT_LOAD_BATCH:
+            return
+        after = (batch[-1]["timestamp"], batch[-1]["_id"])
+
+def add_entries(cache, docs):
+    recent = {e["key"] for e in cache["entries"][-CONTEXT_LOAD_BATCH:]}
+    for d in docs:
+        e = format_entry(d, cache["tokenizer"])
+        if e["key"] in recent:
+            continue
+        cache["entries"].append(e)
+        cache["prefix"].append(cache["prefix"][-1] + e["tokens"])
+        cache["bytes"] += e["bytes"]
+
+def drop_older(cache, count):
+    """丢掉最早的 count 条（已经滑出窗口的），要重建前缀和"""
+    base = cache["prefix"][count]
+    cache["bytes"] -= sum(e["bytes"] for e in cache["entries"][:count])
+    cache["entries"] = cache["entries"][count:]
+    cache["prefix"] = [p - base for p in cache["prefix"][count:]]
+    cache["complete"] = False
+
+def extend_context_cache(user_id, docs):
+    cache = context_cache.get(str(user_id))
+    if not cache:
+        return
+    add_entries(cache, docs)
+    trim_context_cache()
+
+def drop_context_cache(user_id):
+    context_cache.pop(str(user_id), None)
+
+async def get_context_messages(user, new_messages=None):
     models = get_models()
     mc = models.get(user["model"], {})
     token_limit = user.get("context_token_limit") or mc.get("max_tokens", 190000)
     round_limit = user.get("context_round_limit")
-    history = user.get("history", []).copy()
+    max_count = round_limit * 2 if round_limit else None
+    cache = get_context_cache(user["_id"], tokenizer_for(user["model"]), user.get("history_epoch", 0))
+    await load_newer(cache, user["_id"])
+    while not cache["complete"] and cache["prefix"][-1] < token_limit and (max_count is None or len(cache["entries"]) < max_count):
+        await load_older(cache, user["_id"])
     if new_messages:
-        history.extend(new_messages)
-    if round_limit:
-        history = history[-(round_limit * 2):]
-    total_tokens = 0
-    result = []
-    for msg in reversed(history):
-        mt = estimate_tokens(msg.get("content", ""))
-        if total_tokens + mt > token_limit:
+        # 检索到的文件片段只拼进这一轮发给模型的内容，不进聊天记录
+        last = new_messages[-1]
+        if isinstance(last.get("content"), str):
+            # 窗口里还有哪些文件：按整个预算粗算，新消息占掉的那点不扣
+            entries = cache["entries"][bisect_left(cache["prefix"], cache["prefix"][-1] - token_limit):]
+            if max_count is not None:
+                entries = entries[-max_count:]
+            window_doc_ids = {d for e in entries for d in e.get("doc_ids", ())}
+            retrieved = await retrieve_chunks(user["_id"], last["content"], last.get("doc_ids", ()), window_doc_ids)
+            if retrieved:
+                new_messages = new_messages[:-1] + [dict(last, content=f"{retrieved}\n\n{last['content']}")]
+    # 还没入库的新消息先放（从新到旧），剩下的预算再给历史
+    budget = token_limit
+    tail = []
+    full = False
+    for msg in reversed(new_messages or []):
+        e = format_entry(msg, cache["tokenizer"])
+        if (max_count is not None and len(tail) >= max_count) or e["tokens"] > budget:
+            full = True
             break
-        result.insert(0, msg)
-        total_tokens += mt
-    formatted = []
-    for msg in result:
-        role = msg["role"]
-        content = msg.get("content", "")
-        if msg.get("image_ids") and role == "user":
-            parts = []
-            tc = content if isinstance(content, str) else ""
-            if msg.get("timestamp"):
-                t = datetime.fromtimestamp(msg["timestamp"], CN_TIMEZONE)
-                tc = f"[[{t.strftime('%m-%d %H:%M')}]] {tc}"
-            if tc:
-                parts.append({"type": "text", "text": tc})
-            for img_id in msg["image_ids"]:
-                ib = get_image(img_id)
-                if ib:
-                    parts.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{ib}"}})
-            formatted.append({"role": role, "content": parts if parts else tc})
-        elif role == "assistant":
-            # AI的输出保持原始（含[[追]]等），但清掉AI模仿的时间标签
-            c = clean_ai_time_tags(content) if isinstance(content, str) else content
-            formatted.append({"role": role, "content": c})
+        tail.append(e)
+        budget -= e["tokens"]
+    tail.reverse()
+    window = []
+    if not full:
+        entries, prefix = cache["entries"], cache["prefix"]
+        n = len(entries)
+        # 最小的 start 使 prefix[n] - prefix[start] <= budget
+        start = bisect_left(prefix, prefix[n] - budget)
+        if max_count is not None:
+            start = max(start, n - (max_count - len(tail)))
+        window = entries[start:]
+        # 窗口之前的消息以后也用不到（新消息只会把窗口往后推），攒够一批再删，摊薄重建前缀和的开销
+        if start >= CONTEXT_LOAD_BATCH:
+            drop_older(cache, start)
+    trim_context_cache()
+    images = await get_images([i for e in chain(window, tail) for i in e.get("image_ids", ())])
+    return [build_payload(e, images) for e in chain(window, tail)]
+
+# ============== 文档检索 ==============
+
+# 长文件不再整篇塞进消息：切成最多 DOC_CHUNK_CHARS 字的块存进 doc_chunks，聊天记录里只留一个带预览的占位。
+# 每轮回复时用本轮用户消息做 BM25 检索（英文按词、中日韩按二字组），取前 DOC_TOP_K 块附在本轮消息前面；
+# 本轮刚上传的文件先给开头几块。
+# 只在占位消息还在上下文窗口里的文件中找；停用词和一半以上的块都有的词不算分，
+# 总分不到 DOC_MIN_SCORE 的不附（闲聊时一般什么都不附）
+DOC_INLINE_CHARS = int(os.environ.get("DOC_INLINE_CHARS", "4000"))
+DOC_CHUNK_CHARS = 800
+DOC_CHUNK_OVERLAP = 100
+DOC_PREVIEW_CHARS = 500
+DOC_TOP_K = int(os.environ.get("DOC_TOP_K", "4"))
+DOC_MAX_CHUNKS = int(os.environ.get("DOC_MAX_CHUNKS", "3000"))
+DOC_INDEX_USERS = 50
+DOC_INDEX_TTL = 300
+DOC_MIN_SCORE = float(os.environ.get("DOC_MIN_SCORE", "2"))
+DOC_COMMON_DF = 0.5
+BM25_K1 = 1.2
+BM25_B = 0.75
+BM25_STOPWORDS = set(
+    "a an the and or but if so of to in on at by for with from as is am are was were be been being do does did done "
+    "have has had i me my you your he she it we they them this that these those what which who whom how why when where "
+    "can could will would should shall may might must not no yes ok okay hi hello hey thanks thank please just really very "
+    "too also about there here then than now today tonight tomorrow yesterday lol haha".split()
+    + "你好 我们 你们 他们 什么 怎么 为什么 这个 那个 这样 那样 一下 一个 可以 就是 还是 但是 因为 所以 如果 然后 现在 今天 明天 昨天 "
+      "知道 觉得 感觉 没有 不是 真的 哈哈 嗯嗯 好的 谢谢 晚安 早安 在吗 干嘛 吃了 了吗 是不 不是 有没 的话".split()
+)
+BM25_TERM_PATTERN = re.compile(r'[a-z0-9]+|[\u3040-\u30ff\u4e00-\u9fff\uac00-\ud7af]+')
+doc_indexes = OrderedDict()
+
+def chunk_text(text):
+    """按行拼块，超长的行硬切；新块开头带上一块末尾 DOC_CHUNK_OVERLAP 字，连同重叠每块不超过 DOC_CHUNK_CHARS 字"""
+    # 硬切的一段要给开头的重叠和换行留位置；段与段之间不另外重叠，拼块时带的重叠就是上一段的结尾
+    piece_chars = DOC_CHUNK_CHARS - DOC_CHUNK_OVERLAP - 1
+    pieces = []
+    for para in text.split("\n"):
+        para = para.strip()
+        while len(para) > piece_chars:
+            pieces.append(para[:piece_chars])
+            para = para[piece_chars:]
+        if para:
+            pieces.append(para)
+    # size：当前块的长度再加上拼下一段要用的换行
+    chunks, cur, size = [], [], 0
+    for p in pieces:
+        if cur and size + len(p) > DOC_CHUNK_CHARS:
+            chunks.append("\n".join(cur))
+            overlap = chunks[-1][-DOC_CHUNK_OVERLAP:]
+            cur, size = [overlap], len(overlap) + 1
+        cur.append(p)
+        size += len(p) + 1
+    if cur:
+        chunks.append("\n".join(cur))
+    return chunks
+
+def bm25_terms(text):
+    terms = []
+    for w in BM25_TERM_PATTERN.findall(text.lower()):
+        if w.isascii() and w.isalpha() and len(w) == 1:
+            continue  # let's / i'm 拆出来的单个字母
+        if w.isascii() or len(w) == 1:
+            terms.append(w)
         else:
-            if isinstance(content, str) and msg.get("timestamp"):
-                t = datetime.fromtimestamp(msg["timestamp"], CN_TIMEZONE)
-                formatted.append({"role": role, "content": f"[[{t.strftime('%m-%d %H:%M')}]] {content}"})
-            else:
-                formatted.append({"role": role, "content": content})
-    return formatted
+            terms.extend(w[i:i + 2] for i in range(len(w) - 1))
+    return terms
+
+def store_doc_chunks(user_id, file_name, text):
+    """切块入库，返回 (doc_id, 块数)。同一用户重复发同一份内容不重复存"""
+    user_id = str(user_id)
+    doc_id = hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+    existing = doc_chunks_col.count_documents({"user_id": user_id, "doc_id": doc_id})
+    if existing:
+        return doc_id, existing
+    chunks = chunk_text(text)
+    now = time.time()
+    doc_chunks_col.insert_many([{"user_id": user_id, "doc_id": doc_id, "file_name": file_name, "seq": i, "text": c, "created": now}
+                                for i, c in enumerate(chunks)])
+    total = doc_chunks_col.count_documents({"user_id": user_id})
+    if total > DOC_MAX_CHUNKS:
+        # 超过上限从最早的文件删起
+        for d in doc_chunks_col.aggregate([{"$match": {"user_id": user_id}},
+                                           {"$group": {"_id": "$doc_id", "n": {"$sum": 1}, "created": {"$min": "$created"}}},
+                                           {"$sort": {"created": 1}}]):
+            if total <= DOC_MAX_CHUNKS or d["_id"] == doc_id:
+                break
+            doc_chunks_col.delete_many({"user_id": user_id, "doc_id": d["_id"]})
+            total -= d["n"]
+    return doc_id, len(chunks)
+
+async def index_document(user_id, file_name, text):
+    doc_id, count = await run_db(store_doc_chunks, user_id, file_name, text)
+    doc_indexes.pop(str(user_id), None)
+    return doc_id, count
+
+def load_doc_index(user_id):
+    chunks = find_all(doc_chunks_col, {"user_id": user_id}, {"doc_id": 1, "file_name": 1, "seq": 1, "text": 1}, sort=[("created", 1), ("seq", 1)])
+    postings, lengths = {}, []
+    for i, c in enumerate(chunks):
+        tf = {}
+        for t in bm25_terms(c["text"]):
+            tf[t] = tf.get(t, 0) + 1
+        lengths.append(sum(tf.values()))
+        for t, n in tf.items():
+            postings.setdefault(t, []).append((i, n))
+    return {"chunks": chunks, "postings": postings, "lengths": lengths, "avgdl": sum(lengths) / len(lengths) if lengths else 0,
+            "doc_ids": {c["doc_id"] for c in chunks}, "loaded": time.monotonic()}
+
+async def get_doc_index(user_id, doc_ids=()):
+    index = doc_indexes.get(user_id)
+    # 别的实例可能加了文件：过了 TTL 或者本轮提到的文件不在索引里就重新载入
+    if index is None or time.monotonic() - index["loaded"] > DOC_INDEX_TTL or not index["doc_ids"].issuperset(doc_ids):
+        index = await run_db(load_doc_index, user_id)
+        doc_indexes[user_id] = index
+        while len(doc_indexes) > DOC_INDEX_USERS:
+            doc_indexes.popitem(last=False)
+    doc_indexes.move_to_end(user_id)
+    return index
+
+def bm25_top(index, query, k, doc_ids):
+    """doc_ids 里的块按 BM25 排序，返回分数够 DOC_MIN_SCORE 的前 k 个"""
+    chunks = index["chunks"]
+    n = len(chunks)
+    scores = {}
+    for t in set(bm25_terms(query)) - BM25_STOPWORDS:
+        posting = index["postings"].get(t)
+        if not posting or len(posting) > n * DOC_COMMON_DF:
+            continue
+        idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+        for i, tf in posting:
+            if chunks[i]["doc_id"] not in doc_ids:
+                continue
+            norm = 1 - BM25_B + BM25_B * index["lengths"][i] / index["avgdl"]
+            scores[i] = scores.get(i, 0) + idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+    return sorted((i for i, s in scores.items() if s >= DOC_MIN_SCORE), key=scores.get, reverse=True)[:k]
+
+async def retrieve_chunks(user_id, query, new_doc_ids=(), window_doc_ids=()):
+    """new_doc_ids：本轮刚上传的文件；window_doc_ids：占位消息还在上下文窗口里的文件"""
+    allowed = set(new_doc_ids) | set(window_doc_ids)
+    if not allowed:
+        return ""
+    index = await get_doc_index(str(user_id), allowed)
+    if not index["chunks"]:
+        return ""
+    picked = [i for i, c in enumerate(index["chunks"]) if c["doc_id"] in new_doc_ids][:DOC_TOP_K]
+    for i in bm25_top(index, query, DOC_TOP_K, allowed):
+        if len(picked) >= DOC_TOP_K:
+            break
+        if i not in picked:
+            picked.append(i)
+    if not picked:
+        return ""
+    parts = [f"《{index['chunks'][i]['file_name']}》第{index['chunks'][i]['seq'] + 1}段：\n{index['chunks'][i]['text']}" for i in sorted(picked)]
+    return "[相关文件片段（按本轮消息检索，不是全文）]\n" + "\n\n".join(parts)
 
 # ============== 解析回复 ==============
 
+def next_date_for(time_str):
+    """只写了 HH:MM 的定时/想念：今天这个点还没到就是今天，已经过了就是明天"""
+    now = get_cn_time()
+    try:
+        t = datetime.strptime(time_str, "%H:%M")
+    except ValueError:
+        return now.strftime("%Y-%m-%d")
+    if (t.hour, t.minute) <= (now.hour, now.minute):
+        now += timedelta(days=1)
+    return now.strftime("%Y-%m-%d")
+
 def parse_response(response, user):
-    # 先清理AI模仿的时间标签
-    response = clean_ai_time_tags(response)
-    result = {"reply": response, "raw": response, "chase": None, "chase_delay": 300, "schedules": [], "memories": []}
-    for match in re.finditer(r'\[\[记忆\]\]\s*(.+?)(?=\[\[|$)', response, re.DOTALL):
-        mem = match.group(1).strip()
-        if mem:
-            result["memories"].append(mem)
-    chase_match = re.search(r'\[\[追(?:\s+(\d+)分钟)?\]\]\s*(.+?)(?=\[\[|$)', response, re.DOTALL)
-    if chase_match:
-        if chase_match.group(1):
-            result["chase_delay"] = int(chase_match.group(1)) * 60
-        result["chase"] = chase_match.group(2).strip()
-    for match in re.finditer(r'\[\[定时\s+(?:(\d{4}-\d{1,2}-\d{1,2}|\d{1,2}-\d{1,2})\s+)?(\d{1,2}:\d{2})\s+(.+?)\]\]', response):
-        ds = match.group(1)
-        ts = match.group(2)
-        hint = match.group(3)
+    scan = scan_reply(response)
+    result = {"reply": scan["reply"].strip(), "raw": scan["raw"], "chase": scan["chase"], "chase_delay": scan["chase_delay"],
+              "schedules": [], "memories": scan["memories"], "suppress": scan["suppress"]}
+    for ds, ts, hint in scan["timers"]:
         if not ds:
-            ds = get_cn_time().strftime("%Y-%m-%d")
+            ds = next_date_for(ts)
         elif len(ds.split("-")) == 2:
             ds = f"{get_cn_time().year}-{ds}"
         result["schedules"].append({"type": "定时", "date": ds, "time": ts, "hint": hint})
-    for match in re.finditer(r'\[\[想念\s+(\d{1,2}:\d{2}|\d+小时后)\s+(.+?)\]\]', response):
-        ts = match.group(1)
+    for ts, hint in scan["misses"]:
         if "小时后" in ts:
             hours = int(ts.replace("小时后", ""))
             target = get_cn_time() + timedelta(hours=hours)
             ds = target.strftime("%Y-%m-%d")
             ts = target.strftime("%H:%M")
         else:
-            ds = get_cn_time().strftime("%Y-%m-%d")
-        result["schedules"].append({"type": "想念", "date": ds, "time": ts, "hint": match.group(2)})
-    clean = response
-    clean = re.sub(r'\[\[记忆\]\]\s*.+?(?=\[\[|$)', '', clean, flags=re.DOTALL)
-    clean = re.sub(r'\s*\[\[追(?:\s+\d+分钟)?\]\].*?(?=\[\[|$)', '', clean, flags=re.DOTALL)
-    clean = re.sub(r'\[\[定时\s+(?:(?:\d{4}-\d{1,2}-\d{1,2}|\d{1,2}-\d{1,2})\s+)?\d{1,2}:\d{2}\s+.+?\]\]', '', clean)
-    clean = re.sub(r'\[\[想念\s+(?:\d{1,2}:\d{2}|\d+小时后)\s+.+?\]\]', '', clean)
-    clean = re.sub(r'\[\[不发\]\]', '', clean)
-    result["reply"] = clean.strip()
+            ds = next_date_for(ts)
+        result["schedules"].append({"type": "想念", "date": ds, "time": ts, "hint": hint})
     return result
 
 # ============== 发送消息 ==============
 
-async def send_messages(bot, chat_id, response):
-    parts = response.split("|||")
+# 流式回复：每凑齐一段 ||| 就先发出去。[[记忆]]/[[追]] 之后的内容全部扣住，
+# [[定时]]/[[想念]] 闭合后删掉，没闭合的 [[ 先等着；最后由 parse_response 定稿，只补发剩下的段
+HELD_TAG_PATTERN = re.compile(r'\[\[(?:记忆|追)')
+
+def streamed_parts(text):
+    """已经写完、之后不会再变的段（最后一段可能还在生成，不算在内）"""
+    held = HELD_TAG_PATTERN.search(text)
+    if held:
+        text = text[:held.start()]
+    open_at = text.rfind("[[")
+    if open_at != -1 and "]]" not in text[open_at:]:
+        text = text[:open_at]
+    return scan_reply(text)["reply"].split("|||")[:-1]
+
+async def stream_reply(bot, chat_id, state, text):
+    """返回是否已经有内容真正发给了用户"""
+    parts = streamed_parts(text)
+    if len(parts) > state["sent"]:
+        new_parts = parts[state["sent"]:]
+        state["sent"] = len(parts)
+        for part in new_parts:
+            part = part.strip()
+            if part:
+                if not state.get("delivered"):
+                    await mark_job(state.get("job"), sent=True)
+                state["delivered"] = True
+                await bot.send_message(chat_id=chat_id, text=part)
+    # 前面只有空段时不记数：换了上游从头生成，不能跳过新回复的段
+    if not state.get("delivered"):
+        state["sent"] = 0
+    return state.get("delivered", False)
+
+async def send_messages(bot, chat_id, response, skip=0):
+    """skip: 流式阶段已经发出去的段数"""
+    parts = response.split("|||")[skip:]
     for part in parts:
         part = part.strip()
         if part:
@@ -472,58 +1716,337 @@ async def send_messages(bot, chat_id, response):
 
 # ============== 全局状态 ==============
 
-message_buffers = {}
-pending_responses = {}
 wizard_states = {}
 
+# ============== 任务调度 ==============
+
+MAX_CONCURRENT_REPLIES = int(os.environ.get("MAX_CONCURRENT_REPLIES", "8"))
+MAX_PENDING_JOBS = int(os.environ.get("MAX_PENDING_JOBS", "200"))
+
+user_jobs = {}
+user_workers = {}
+reply_slots = None
+
+def pending_jobs():
+    return sum(len(q) for q in user_jobs.values())
+
+def dispatch(uid, job, heavy=False):
+    """同一用户的任务按顺序执行，不同用户并发；heavy任务（调模型）占全局名额。队列满返回False"""
+    if pending_jobs() >= MAX_PENDING_JOBS:
+        return False
+    user_jobs.setdefault(uid, deque()).append((job, heavy))
+    if uid not in user_workers:
+        user_workers[uid] = asyncio.ensure_future(user_worker(uid))
+    return True
+
+async def user_worker(uid):
+    jobs = user_jobs[uid]
+    try:
+        while jobs:
+            job, heavy = jobs.popleft()
+            try:
+                if heavy:
+                    await hold_user_lease(uid)
+                    try:
+                        async with reply_slots:
+                            await job()
+                    finally:
+                        await run_db(release_user_lease, uid)
+                else:
+                    await job()
+            except Exception as e:
+                print(f"[Worker] Error: {e}")
+    finally:
+        user_workers.pop(uid, None)
+        user_jobs.pop(uid, None)
+
+# ============== 多实例 ==============
+
+# 可以同时跑多个实例：
+#   用户租约：调模型的任务先在 leases 集合里抢 "<uid>" 的租约，同一用户同一时刻只有一个实例在回复
+#   任务/定时：领取时写上 owner 和 lease_until，心跳续期；实例挂了，租约过期后别的实例接手
+INSTANCE_ID = os.environ.get("RENDER_INSTANCE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+LEASE_TTL = int(os.environ.get("LEASE_TTL", "60"))
+HEARTBEAT_INTERVAL = LEASE_TTL / 3
+held_leases = set()
+
+def lease_deadline():
+    return datetime.now(timezone.utc) + timedelta(seconds=LEASE_TTL)
+
+def try_user_lease(uid):
+    now = datetime.now(timezone.utc)
+    try:
+        leases_col.update_one(
+            {"_id": str(uid), "$or": [{"owner": INSTANCE_ID}, {"expires": {"$lt": now}}]},
+            {"$set": {"owner": INSTANCE_ID, "expires": lease_deadline()}}, upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False  # 别的实例拿着，且没过期
+
+async def hold_user_lease(uid):
+    while not await run_db(try_user_lease, uid):
+        await asyncio.sleep(1)
+    held_leases.add(str(uid))
+
+def release_user_lease(uid):
+    held_leases.discard(str(uid))
+    leases_col.delete_one({"_id": str(uid), "owner": INSTANCE_ID})
+
+def renew_leases():
+    deadline = lease_deadline()
+    if held_leases:
+        leases_col.update_many({"_id": {"$in": list(held_leases)}, "owner": INSTANCE_ID}, {"$set": {"expires": deadline}})
+    jobs_col.update_many({"status": "running", "owner": INSTANCE_ID}, {"$set": {"lease_until": deadline}})
+    schedules_col.update_many({"claimed_by": INSTANCE_ID}, {"$set": {"lease_until": deadline}})
+
+async def heartbeat():
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        try:
+            await run_db(renew_leases)
+            await run_db(recover_jobs)
+        except Exception as e:
+            print(f"[Lease] Error: {e}")
+
+# ============== 延迟任务 ==============
+
+# 消息缓冲（攒够安静期再回复）和追问都存在 jobs 集合里，重启/重新部署不会丢。
+#   reply: key="reply:<uid>"，status=pending 时新消息 $push 进去并顺延 due_at
+#   chase: key="chase:<uid>"，每个用户最多一条，用户一说话就取消
+# 到点后用 pending->running 的原子更新领取（带 owner/lease_until），跑完删除；
+# 实例崩溃后租约过期，running 的任务由心跳（或下次启动）重新排队。
+# 进度记在任务文档上（response/recorded/sent/replied），每步副作用之前先写：
+# 重试时跳过已经记过的步骤，崩在记录和副作用之间最多少做一次，不会发两遍。
+# 扣费用用户文档上的回执（见 charge_user），和扣减是同一次原子更新。没完整发出去的回复不收费
+JOB_MAX_ATTEMPTS = 2
+JOB_RELOAD_INTERVAL = 60
+job_heap = []
+job_wakeup = None
+
+# 回复前的安静期：每个用户一个 call_later 定时器，新消息进来就重置，安静期一结束才放进堆里领取。
+# Bot API 收不到“正在输入”，就看发消息的节奏：单条短句很快回；连着发时按两条的间隔多等一会
+REPLY_QUIET_MIN = float(os.environ.get("REPLY_QUIET_MIN", "3"))
+REPLY_QUIET_DEFAULT = float(os.environ.get("REPLY_QUIET_DEFAULT", "8"))
+REPLY_QUIET_MAX = float(os.environ.get("REPLY_QUIET_MAX", "20"))
+SHORT_MESSAGE_CHARS = 20
+reply_timers = {}
+
+async def mark_job(job, **steps):
+    if job is None:
+        return
+    job.update(steps)
+    await run_db(jobs_col.update_one, {"_id": job["_id"]}, {"$set": steps})
+
+def refund_abandoned(job):
+    """放弃一个回复任务时，回复没完整发出去就按回执退款"""
+    if job["type"] != "reply" or job.get("replied"):
+        return
+    receipt = str(job["_id"])
+    user = users_col.find_one({"_id": job["user_id"], "charges.job": receipt}, {"charges": 1})
+    charged = charge_receipt(user, receipt) if user else None
+    if charged:
+        users_col.update_one({"_id": job["user_id"], "charges.job": receipt},
+                             {"$inc": {charged["field"]: charged["amount"]}, "$pull": {"charges": {"job": receipt}}})
+
+def push_job(due_ts, job_id):
+    heapq.heappush(job_heap, (due_ts, job_id))
+    if job_wakeup:
+        job_wakeup.set()
+
+def quiet_period(uid, msgs, now):
+    timer = reply_timers.get(uid)
+    if timer:
+        return min(REPLY_QUIET_MAX, max(REPLY_QUIET_DEFAULT, (now - timer["last"]) * 1.5 + 2))
+    if len(msgs) == 1 and msgs[0]["type"] == "text" and len(msgs[0].get("content") or "") <= SHORT_MESSAGE_CHARS:
+        return REPLY_QUIET_MIN
+    return REPLY_QUIET_DEFAULT
+
+def arm_reply_timer(uid, job_id, due_ts, now):
+    timer = reply_timers.pop(uid, None)
+    if timer:
+        timer["handle"].cancel()
+    handle = asyncio.get_running_loop().call_later(max(due_ts - time.time(), 0), fire_reply_timer, uid)
+    reply_timers[uid] = {"handle": handle, "job_id": job_id, "due": due_ts, "last": now}
+
+def fire_reply_timer(uid):
+    timer = reply_timers.pop(uid, None)
+    if timer:
+        push_job(timer["due"], timer["job_id"])
+
+async def buffer_messages(uid, chat_id, msgs):
+    now = time.time()
+    due_ts = now + quiet_period(uid, msgs, now)
+    due = datetime.fromtimestamp(due_ts, timezone.utc)
+    upsert = partial(
+        jobs_col.find_one_and_update,
+        {"key": f"reply:{uid}", "status": "pending"},
+        {"$push": {"messages": {"$each": msgs}}, "$set": {"due_at": due, "chat_id": chat_id},
+         "$setOnInsert": {"type": "reply", "user_id": str(uid), "attempts": 0}},
+        projection={"_id": 1}, upsert=True, return_document=ReturnDocument.AFTER
+    )
+    try:
+        doc = await run_db(upsert)
+    except DuplicateKeyError:
+        # 并发 upsert 撞上唯一索引，重试一次就会命中已有的文档
+        doc = await run_db(upsert)
+    arm_reply_timer(uid, doc["_id"], due_ts, now)
+
+async def schedule_chase(uid, chat_id, text, delay):
+    await cancel_chase(uid)
+    due_ts = time.time() + delay
+    job = {"key": f"chase:{uid}", "type": "chase", "status": "pending", "user_id": str(uid), "chat_id": chat_id,
+           "chase": text, "due_at": datetime.fromtimestamp(due_ts, timezone.utc), "attempts": 0}
+    await run_db(jobs_col.insert_one, job)
+    push_job(due_ts, job["_id"])
+
+async def cancel_chase(uid):
+    await run_db(jobs_col.delete_many, {"key": f"chase:{uid}", "status": "pending"})
+
+def recover_jobs(startup=False):
+    """租约过期的 running 任务放回队列；启动时还会收回本实例上次留下的，并载入所有待执行任务"""
+    stale = [{"lease_until": {"$lt": datetime.now(timezone.utc)}}, {"lease_until": {"$exists": False}}]
+    if startup:
+        stale.append({"owner": INSTANCE_ID})
+    for job in jobs_col.find({"status": "running", "$or": stale}):
+        if job.get("attempts", 0) + 1 >= JOB_MAX_ATTEMPTS:
+            refund_abandoned(job)
+            jobs_col.delete_one({"_id": job["_id"]})
+            continue
+        try:
+            jobs_col.update_one({"_id": job["_id"], "status": "running"}, {"$set": {"status": "pending"}, "$unset": {"owner": "", "lease_until": ""}, "$inc": {"attempts": 1}})
+        except DuplicateKeyError:
+            # 同一用户已经有新的待执行任务：没完整回复的先退费；还没开始发的旧消息并到前面由新任务一起回复，
+            # 已经开始发的和旧追问直接作废
+            refund_abandoned(job)
+            if job["type"] == "reply" and not job.get("sent"):
+                jobs_col.update_one({"key": job["key"], "status": "pending"}, {"$push": {"messages": {"$each": job.get("messages", []), "$position": 0}}})
+            jobs_col.delete_one({"_id": job["_id"]})
+    if startup:
+        for due_ts, job_id in due_jobs(None):
+            heapq.heappush(job_heap, (due_ts, job_id))
+
+def due_jobs(horizon):
+    query = {"status": "pending"}
+    if horizon:
+        query["due_at"] = {"$lt": datetime.fromtimestamp(horizon, timezone.utc)}
+    return [(utc_ts(job["due_at"]), job["_id"]) for job in jobs_col.find(query, {"due_at": 1})]
+
+async def run_job(bot, job):
+    try:
+        if job["type"] == "reply":
+            await process_and_reply(bot, int(job["user_id"]), job["chat_id"], job.get("messages", []), job)
+        elif job["type"] == "chase":
+            await send_chase(bot, int(job["user_id"]), job)
+    finally:
+        await run_db(jobs_col.delete_one, {"_id": job["_id"]})
+
+async def run_jobs(bot):
+    next_reload = time.time() + JOB_RELOAD_INTERVAL
+    while True:
+        try:
+            now = time.time()
+            if now >= next_reload:
+                # 顺便捡起别的实例写进来的任务；重复的堆项领取时会自然失败
+                next_reload = now + JOB_RELOAD_INTERVAL
+                timed = {t["job_id"] for t in reply_timers.values()}
+                for item in await run_db(due_jobs, next_reload):
+                    if item[1] not in timed:
+                        heapq.heappush(job_heap, item)
+            while job_heap and job_heap[0][0] <= now and pending_jobs() < MAX_PENDING_JOBS:
+                _, jid = heapq.heappop(job_heap)
+                # 改期了（due_at 变晚）或已取消/已被领取的，这里领取不到，直接跳过
+                job = await run_db(
+                    jobs_col.find_one_and_update,
+                    {"_id": jid, "status": "pending", "due_at": {"$lte": datetime.now(timezone.utc)}},
+                    {"$set": {"status": "running", "claimed_at": datetime.now(timezone.utc), "owner": INSTANCE_ID, "lease_until": lease_deadline()}}
+                )
+                # 领取要等数据库，这期间队列可能被别的协程占满：分发失败就退回 pending，等有空位再领
+                if job and not dispatch(int(job["user_id"]), partial(run_job, bot, job), heavy=job["type"] == "reply"):
+                    await run_db(jobs_col.update_one, {"_id": jid, "owner": INSTANCE_ID},
+                                 {"$set": {"status": "pending"}, "$unset": {"owner": "", "lease_until": "", "claimed_at": ""}})
+                    heapq.heappush(job_heap, (utc_ts(job["due_at"]), jid))
+            wake_at = next_reload
+            if job_heap:
+                wake_at = min(wake_at, job_heap[0][0])
+            timeout = max(wake_at - time.time(), 1 if job_heap and pending_jobs() >= MAX_PENDING_JOBS else 0)
+            try:
+                await asyncio.wait_for(job_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            job_wakeup.clear()
+        except Exception as e:
+            print(f"[Jobs] Error: {e}")
+            await asyncio.sleep(5)
+
 # ============== 处理回复 ==============
 
-async def process_and_reply(bot, user_id, chat_id):
-    user = get_user(user_id)
+async def process_and_reply(bot, user_id, chat_id, buffered, job=None):
+    """job：来自任务队列时按上面记下的进度续跑"""
+    if not buffered:
+        return
+    done = dict(job or {})
+    receipt = str(job["_id"]) if job else None
+    user = await get_user(user_id)
+    prior = charge_receipt(user, receipt)
+    if done.get("sent") and "response" not in done:
+        # 上次流式发到一半崩了：发出去的收不回，也没有完整回复可以记录，扣的费退回
+        if prior:
+            await refund_user(user_id, prior["field"], prior["amount"], receipt)
+        return
     admin = is_admin(user_id)
     models = get_models()
-    buffer = message_buffers.get(user_id, {"messages": []})
-    if not buffer["messages"]:
-        return
     text_parts = []
+    doc_ids = []
     image_ids = []
+    img_tokens = 0
     has_image = False
-    for m in buffer["messages"]:
+    for m in buffered:
         if m.get("type") == "photo":
             has_image = True
             if m.get("image_id"):
                 image_ids.append(m["image_id"])
+                img_tokens += m.get("tokens", IMAGE_DEFAULT_TOKENS)
         else:
             text_parts.append(m["content"])
-    timestamp = buffer["messages"][-1].get("timestamp", get_cn_time().timestamp())
+            if m.get("doc_id"):
+                doc_ids.append(m["doc_id"])
+    timestamp = buffered[-1].get("timestamp", get_cn_time().timestamp())
     model_key = user["model"]
     if model_key not in models:
         model_key = DEFAULT_MODEL
         user["model"] = DEFAULT_MODEL
+        await update_user(user_id, {"model": DEFAULT_MODEL})
     mc = models[model_key]
     if has_image and not mc.get("vision", False):
         await bot.send_message(chat_id=chat_id, text="当前模型不支持看图，请用 /model 切换")
-        message_buffers[user_id] = {"messages": []}
         return
     if mc.get("admin_only") and not admin:
         user["model"] = DEFAULT_MODEL
+        await update_user(user_id, {"model": DEFAULT_MODEL})
         model_key = DEFAULT_MODEL
         mc = models[model_key]
-    if not admin:
+    # 先扣后调：调用失败再退回，出错的回复不花积分
+    charged = None
+    if prior:
+        # 上次执行已经扣过
+        charged = (prior["field"], prior["amount"])
+        if charged[0] == "default_uses":
+            model_key = DEFAULT_MODEL
+    elif not admin:
         cost = mc.get("cost", 0)
-        if cost > 0 and user["points"] >= cost:
-            user["points"] -= cost
-        elif model_key == DEFAULT_MODEL and user["default_uses"] > 0:
-            user["default_uses"] -= 1
-        elif model_key != DEFAULT_MODEL and user["default_uses"] > 0:
+        if cost > 0 and await charge_user(user_id, "points", cost, receipt):
+            charged = ("points", cost)
+        elif model_key == DEFAULT_MODEL and await charge_user(user_id, "default_uses", 1, receipt):
+            charged = ("default_uses", 1)
+        elif model_key != DEFAULT_MODEL and await charge_user(user_id, "default_uses", 1, receipt):
+            charged = ("default_uses", 1)
             user["model"] = DEFAULT_MODEL
-            user["default_uses"] -= 1
-            await bot.send_message(chat_id=chat_id, text=f"积分不足，已切换默认模型 ({user['default_uses']}次)")
+            await update_user(user_id, {"model": DEFAULT_MODEL})
+            await bot.send_message(chat_id=chat_id, text=f"积分不足，已切换默认模型 ({max(user['default_uses'] - 1, 0)}次)")
             model_key = DEFAULT_MODEL
         else:
             await bot.send_message(chat_id=chat_id, text="积分用完啦，明天再来~")
-            message_buffers[user_id] = {"messages": []}
-            save_user(user_id, user)
             return
     combined = "|||".join(text_parts) if text_parts else ""
     if has_image and not combined:
@@ -531,37 +2054,50 @@ async def process_and_reply(bot, user_id, chat_id):
     new_msg = {"role": "user", "content": combined, "timestamp": timestamp, "model": model_key}
     if image_ids:
         new_msg["image_ids"] = image_ids
-    messages = get_context_messages(user, [new_msg])
+        new_msg["image_tokens"] = img_tokens
+    if doc_ids:
+        new_msg["doc_ids"] = doc_ids
     try:
-        await bot.send_chat_action(chat_id=chat_id, action="typing")
-        response = await call_main_model(model_key, messages, user)
+        streamed = {"sent": 0, "job": job}
+        if "response" in done:
+            response = done["response"]
+        else:
+            # 扣费之后到拿到回复之前，哪一步出错都退回
+            try:
+                messages = await get_context_messages(user, [new_msg])
+                await bot.send_chat_action(chat_id=chat_id, action="typing")
+                response = await call_main_model(model_key, messages, user, partial(stream_reply, bot, chat_id, streamed))
+            except Exception:
+                if charged:
+                    await refund_user(user_id, *charged, receipt)
+                raise
+            # 流式阶段发完的段数一起记下，重试时只补发剩下的
+            await mark_job(job, response=response, streamed=streamed["sent"])
         parsed = parse_response(response, user)
-        user["history"].append(new_msg)
-        user["history"].append({"role": "assistant", "content": parsed["raw"], "timestamp": get_cn_time().timestamp(), "model": model_key})
-        user["last_activity"] = get_cn_time().timestamp()
-        user["chat_id"] = chat_id
-        if parsed["memories"]:
-            today = get_cn_time().strftime("%Y-%m-%d")
-            if "memories" not in user:
-                user["memories"] = []
-            for mem in parsed["memories"]:
+        if not done.get("recorded"):
+            await mark_job(job, recorded=True)
+            await append_messages(user_id, [new_msg, {"role": "assistant", "content": parsed["raw"], "timestamp": get_cn_time().timestamp(), "model": model_key}])
+            await update_user(user_id, {"last_activity": get_cn_time().timestamp(), "chat_id": chat_id})
+            if parsed["memories"]:
+                today = get_cn_time().strftime("%Y-%m-%d")
                 total_len = sum(len(m["content"]) for m in user["memories"])
-                if total_len + len(mem) <= 2000:
-                    user["memories"].append({"date": today, "content": mem})
-        if parsed["schedules"]:
-            for sched in parsed["schedules"]:
-                sched["chat_id"] = chat_id
-                sched["user_id"] = str(user_id)
-                schedules_col.insert_one(sched)
-        if parsed["chase"]:
-            pending_responses[user_id] = {"chase": parsed["chase"], "time": get_cn_time().timestamp(), "delay": parsed["chase_delay"], "chat_id": chat_id}
-        save_user(user_id, user)
-        if parsed["reply"]:
-            await send_messages(bot, chat_id, parsed["reply"])
+                for mem in parsed["memories"]:
+                    if total_len + len(mem) <= 2000:
+                        await add_memory(user_id, {"date": today, "content": mem})
+                        total_len += len(mem)
+            if parsed["schedules"]:
+                for sched in parsed["schedules"]:
+                    sched["chat_id"] = chat_id
+                    sched["user_id"] = str(user_id)
+                    await add_schedule(sched)
+            if parsed["chase"]:
+                await schedule_chase(user_id, chat_id, parsed["chase"], parsed["chase_delay"])
+        if parsed["reply"] and not done.get("replied"):
+            await mark_job(job, sent=True, replied=True)
+            await send_messages(bot, chat_id, parsed["reply"], done["streamed"] if "response" in done else streamed["sent"])
     except Exception as e:
         await bot.send_message(chat_id=chat_id, text=f"Error: {e}")
         print(f"[Reply] Error: {e}")
-    message_buffers[user_id] = {"messages": []}
 
 # ============== 命令处理 ==============
 
@@ -570,9 +2106,9 @@ async def start_command(update, bot):
 
 async def help_command(update, bot):
     admin = is_admin(update.effective_user.id)
-    text = "🤖 命令：\n\n/model - 切换模型\n/points - 查积分\n/reset - 清聊天记录（保留记忆）\n/memory - 查看/删除记忆\n/name <用户名> <AI名> - 改导出名字\n/context - 上下文设置\n/export - 导出聊天记录\n\n支持：文字、图片、txt、md、docx、xlsx、pptx、pdf 📎"
+    text = "🤖 命令：\n\n/model - 切换模型\n/points - 查积分\n/reset - 清聊天记录（保留记忆）\n/memory - 查看/删除记忆\n/name <用户名> <AI名> - 改导出名字\n/context - 上下文设置\n/export [txt|jsonl|html] [gz] - 导出聊天记录\n\n支持：文字、图片、txt、md、docx、xlsx、pptx、pdf 📎"
     if admin:
-        text += "\n\n🔧 管理员命令：\n/addmodel - 添加模型\n/delmodel - 删除模型\n/listmodels - 列出所有模型\n/addapi - 添加API\n/delapi - 删除API\n/listapis - 列出所有API"
+        text += "\n\n🔧 管理员命令：\n/addmodel - 添加模型\n/delmodel - 删除模型\n/listmodels - 列出所有模型\n/addapi - 添加API\n/delapi - 删除API\n/listapis - 列出所有API\n/stats - 运行状态\n/gcimages - 清理无用图片"
     await bot.send_message(chat_id=update.effective_chat.id, text=text)
 
 async def points_command(update, bot):
@@ -580,19 +2116,17 @@ async def points_command(update, bot):
     if is_admin(uid):
         await bot.send_message(chat_id=update.effective_chat.id, text="管理员无限积分 ∞ ✨")
         return
-    user = get_user(uid)
+    user = await get_user(uid)
     await bot.send_message(chat_id=update.effective_chat.id, text=f"💰 积分: {user['points']}/20\n默认次数: {user['default_uses']}/100\n模型: {user['model']}")
 
 async def reset_command(update, bot):
     uid = update.effective_user.id
-    user = get_user(uid)
-    user["history"] = []
-    save_user(uid, user)
+    await clear_history(uid)
     await bot.send_message(chat_id=update.effective_chat.id, text="聊天记录已清除！（记忆保留）🧹✨")
 
 async def memory_command(update, bot, text):
     uid = update.effective_user.id
-    user = get_user(uid)
+    user = await get_user(uid)
     parts = text.split()
     if len(parts) == 1:
         if not user.get("memories"):
@@ -606,15 +2140,14 @@ async def memory_command(update, bot, text):
         keyboard.append([InlineKeyboardButton("🗑 清除全部", callback_data="memclear")])
         await bot.send_message(chat_id=update.effective_chat.id, text=mt, reply_markup=InlineKeyboardMarkup(keyboard))
     elif parts[1] == "clear":
-        user["memories"] = []
-        save_user(uid, user)
+        await update_user(uid, {"memories": []})
         await bot.send_message(chat_id=update.effective_chat.id, text="记忆已全部清除 🧹")
     elif parts[1] == "delete" and len(parts) >= 3:
         try:
             idx = int(parts[2]) - 1
             if 0 <= idx < len(user.get("memories", [])):
-                deleted = user["memories"].pop(idx)
-                save_user(uid, user)
+                deleted = user["memories"][idx]
+                await remove_memory(uid, deleted)
                 await bot.send_message(chat_id=update.effective_chat.id, text=f"已删除: {deleted['content'][:30]}...")
             else:
                 await bot.send_message(chat_id=update.effective_chat.id, text="编号不存在！")
@@ -623,21 +2156,19 @@ async def memory_command(update, bot, text):
 
 async def name_command(update, bot, text):
     uid = update.effective_user.id
-    user = get_user(uid)
+    user = await get_user(uid)
     parts = text.split()
     if len(parts) == 1:
         await bot.send_message(chat_id=update.effective_chat.id, text=f"当前名字：\n用户: {user.get('user_name','用户')}\nAI: {user.get('ai_name','AI')}\n\n修改: /name <用户名> <AI名>")
     elif len(parts) >= 3:
-        user["user_name"] = parts[1]
-        user["ai_name"] = parts[2]
-        save_user(uid, user)
+        await update_user(uid, {"user_name": parts[1], "ai_name": parts[2]})
         await bot.send_message(chat_id=update.effective_chat.id, text=f"已更新！✅\n用户: {parts[1]}\nAI: {parts[2]}")
     else:
         await bot.send_message(chat_id=update.effective_chat.id, text="用法: /name <用户名> <AI名>")
 
 async def context_command(update, bot, text):
     uid = update.effective_user.id
-    user = get_user(uid)
+    user = await get_user(uid)
     models = get_models()
     parts = text.split()
     if len(parts) == 1:
@@ -646,62 +2177,106 @@ async def context_command(update, bot, text):
         rl = user.get("context_round_limit") or "无限制"
         await bot.send_message(chat_id=update.effective_chat.id, text=f"Token上限: {tl:,}\n轮数上限: {rl}\n\n/context token <数字>\n/context round <数字>\n/context reset")
     elif parts[1] == "reset":
-        user["context_token_limit"] = None
-        user["context_round_limit"] = None
-        save_user(uid, user)
+        await update_user(uid, {"context_token_limit": None, "context_round_limit": None})
         await bot.send_message(chat_id=update.effective_chat.id, text="已重置! 🔄")
     elif len(parts) >= 3:
         try:
             val = int(parts[2])
             if parts[1] == "token":
-                user["context_token_limit"] = val
+                await update_user(uid, {"context_token_limit": val})
             elif parts[1] == "round":
-                user["context_round_limit"] = val
-            save_user(uid, user)
+                await update_user(uid, {"context_round_limit": val})
             await bot.send_message(chat_id=update.effective_chat.id, text=f"已设置为 {val}! ✅")
         except:
             await bot.send_message(chat_id=update.effective_chat.id, text="用法: /context token/round <数字>")
 
+# 导出：按页读聊天记录，边格式化边写进 SpooledTemporaryFile（超过 EXPORT_SPOOL_BYTES 落盘），
+# 超过 EXPORT_PART_BYTES 就先发出去再开下一个文件（Telegram 机器人上传上限 50MB）
+EXPORT_FORMATS = ("txt", "jsonl", "html")
+EXPORT_PART_BYTES = int(os.environ.get("EXPORT_PART_MB", "45")) * 1024 * 1024
+EXPORT_SPOOL_BYTES = 8 * 1024 * 1024
+EXPORT_HTML_HEAD = ('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>聊天记录</title><style>'
+                    'body{font-family:sans-serif;max-width:800px;margin:auto}.msg{margin:4px 0;white-space:pre-wrap}'
+                    '.meta{color:#888}.assistant .name{color:#06c}</style></head><body>\n<h2>聊天记录</h2>\n')
+
+def export_records(msg, uname, aname):
+    """一条聊天记录拆成导出的若干行"""
+    role = msg["role"]
+    record = {"time": None, "role": role, "name": uname if role == "user" else aname, "model": None}
+    if "timestamp" in msg:
+        record["time"] = datetime.fromtimestamp(msg["timestamp"], CN_TIMEZONE).strftime('%Y-%m-%d %H:%M')
+    if msg.get("model") and role == "assistant":
+        record["model"] = msg["model"]
+    content = msg.get("content") or ""
+    if role == "assistant":
+        content = scan_reply(content)["reply"].strip()
+    texts = [p.strip() for p in content.split("|||") if p.strip()] + ["[图片]"] * len(msg.get("image_ids", []))
+    for text in texts or [""]:
+        yield dict(record, text=text)
+
+def format_record(fmt, r):
+    if fmt == "jsonl":
+        return json.dumps(r, ensure_ascii=False) + "\n"
+    time_str = f"[{r['time']}] " if r["time"] else ""
+    model_str = f"({r['model']})" if r["model"] else ""
+    if fmt == "html":
+        return (f'<div class="msg {r["role"]}"><span class="meta">{html.escape(time_str)}</span>'
+                f'<span class="name">{html.escape(r["name"] + model_str)}</span>: {html.escape(r["text"])}</div>\n')
+    return f"{time_str}{r['name']}{model_str}: {r['text']}\n"
+
+def export_header(fmt):
+    return {"txt": "=== 聊天记录 ===\n\n", "html": EXPORT_HTML_HEAD}.get(fmt, "")
+
+def export_footer(fmt):
+    return "</body></html>\n" if fmt == "html" else ""
+
 async def export_command(update, bot):
     uid = update.effective_user.id
-    user = get_user(uid)
-    if not user.get("history"):
-        await bot.send_message(chat_id=update.effective_chat.id, text="没有聊天记录！")
+    cid = update.effective_chat.id
+    args = (update.message.text or "").split()[1:]
+    fmt = next((a.lower() for a in args if a.lower() in EXPORT_FORMATS), "txt")
+    gz = any(a.lower() in ("gz", "gzip") for a in args)
+    user = await get_user(uid)
+    if not await has_history(uid):
+        await bot.send_message(chat_id=cid, text="没有聊天记录！")
         return
     uname = user.get("user_name", "用户")
     aname = user.get("ai_name", "AI")
-    export_text = "=== 聊天记录 ===\n\n"
-    for msg in user["history"]:
-        role_name = uname if msg["role"] == "user" else aname
-        time_str = ""
-        if "timestamp" in msg:
-            t = datetime.fromtimestamp(msg["timestamp"], CN_TIMEZONE)
-            time_str = f"[{t.strftime('%Y-%m-%d %H:%M')}] "
-        model_str = ""
-        if msg.get("model") and msg["role"] == "assistant":
-            model_str = f"({msg['model']})"
-        content = msg.get("content", "")
-        if msg["role"] == "assistant":
-            content = re.sub(r'\[\[记忆\]\]\s*.+?(?=\[\[|$)', '', content, flags=re.DOTALL)
-            content = re.sub(r'\s*\[\[追(?:\s+\d+分钟)?\]\].*?(?=\[\[|$)', '', content, flags=re.DOTALL)
-            content = re.sub(r'\[\[定时\s+(?:(?:\d{4}-\d{1,2}-\d{1,2}|\d{1,2}-\d{1,2})\s+)?\d{1,2}:\d{2}\s+.+?\]\]', '', content)
-            content = re.sub(r'\[\[想念\s+(?:\d{1,2}:\d{2}|\d+小时后)\s+.+?\]\]', '', content)
-            content = re.sub(r'\[\[不发\]\]', '', content)
-            content = clean_ai_time_tags(content)
-            content = content.strip()
-        has_imgs = msg.get("image_ids", [])
-        parts = content.split("|||") if content else []
-        for part in parts:
-            part = part.strip()
-            if part:
-                export_text += f"{time_str}{role_name}{model_str}: {part}\n"
-        for _ in has_imgs:
-            export_text += f"{time_str}{role_name}{model_str}: [图片]\n"
-        if not parts and not has_imgs:
-            export_text += f"{time_str}{role_name}{model_str}: \n"
-    fb = export_text.encode('utf-8')
-    fn = f"chat_{uid}_{get_cn_time().strftime('%Y%m%d_%H%M%S')}.txt"
-    await bot.send_document(chat_id=update.effective_chat.id, document=io.BytesIO(fb), filename=fn, caption="聊天记录导出完成！📄")
+    name = f"chat_{uid}_{get_cn_time().strftime('%Y%m%d_%H%M%S')}"
+    ext = fmt + (".gz" if gz else "")
+    part = {"no": 0, "spool": None, "out": None}
+
+    def open_part():
+        part["no"] += 1
+        part["spool"] = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+        part["out"] = gzip.GzipFile(fileobj=part["spool"], mode="wb") if gz else part["spool"]
+        part["out"].write(export_header(fmt).encode("utf-8"))
+
+    async def send_part(last):
+        part["out"].write(export_footer(fmt).encode("utf-8"))
+        if gz:
+            part["out"].close()  # 只结束 gzip 流，不会关掉底下的 spool
+        spool = part["spool"]
+        spool.seek(0)
+        no = part["no"]
+        fn = f"{name}.{ext}" if no == 1 and last else f"{name}_{no}.{ext}"
+        caption = "聊天记录导出完成！📄" if last else f"聊天记录第 {no} 部分 📄"
+        if last and no > 1:
+            caption += f"（共 {no} 部分）"
+        try:
+            await bot.send_document(chat_id=cid, document=spool, filename=fn, caption=caption)
+        finally:
+            spool.close()
+
+    open_part()
+    async for page in history_pages(uid):
+        # 写下一页之前才切分，最后一个文件不会是空的
+        if part["spool"].tell() >= EXPORT_PART_BYTES:
+            await send_part(last=False)
+            open_part()
+        chunk = "".join(format_record(fmt, r) for msg in page for r in export_records(msg, uname, aname))
+        part["out"].write(chunk.encode("utf-8"))
+    await send_part(last=True)
 
 async def model_command(update, bot):
     uid = update.effective_user.id
@@ -720,7 +2295,7 @@ async def model_command(update, bot):
                 row = []
     if row:
         keyboard.append(row)
-    user = get_user(uid)
+    user = await get_user(uid)
     await bot.send_message(chat_id=update.effective_chat.id, text=f"当前: {user['model']}\n\n选择API:", reply_markup=InlineKeyboardMarkup(keyboard))
 
 # ============== 管理员命令 ==============
@@ -793,6 +2368,49 @@ async def listapis_command(update, bot):
         text += f"• {name} (显示: {c.get('display_user', name)})\n  URL: {c.get('url','未设置')}\n  Key: {'✅' if c.get('key') else '❌'}\n\n"
     await bot.send_message(chat_id=update.effective_chat.id, text=text)
 
+async def gcimages_command(update, bot, text):
+    if not is_admin(update.effective_user.id):
+        return
+    dry_run = "run" not in text.split()[1:]
+    report = await run_db(sweep_images, dry_run)
+    mb = (report["image_bytes"] + report["file_bytes"]) / 1024 / 1024
+    head = "🔍 预览（/gcimages run 执行删除）" if dry_run else "🧹 已清理"
+    await bot.send_message(chat_id=update.effective_chat.id, text=f"{head}\n\n无引用图片: {report['images']} 张\nGridFS 孤儿文件: {report['files']} 个\n可回收: {mb:.1f}MB")
+
+async def stats_command(update, bot):
+    if not is_admin(update.effective_user.id):
+        return
+    cs = config_stats
+    total = cs["hits"] + cs["misses"]
+    rate = f"{cs['hits'] / total:.1%}" if total else "-"
+    text = "📊 运行状态：\n\n"
+    text += f"实例: {INSTANCE_ID}，持有用户租约 {len(held_leases)}\n"
+    text += f"任务队列: {pending_jobs()} 排队 / {len(user_workers)} 用户在处理\n"
+    us = update_stats
+    text += f"Update: 队列 {update_queue.qsize()}/{UPDATE_QUEUE_SIZE}，收到 {us['received']} / 重复 {us['duplicates']} / 拒绝 {us['rejected']}\n"
+    waiting = await run_db(jobs_col.count_documents, {"status": "pending"})
+    running = await run_db(jobs_col.count_documents, {"status": "running"})
+    text += f"延迟任务: {waiting} 等待 / {running} 执行中\n"
+    text += f"配置缓存: 命中 {cs['hits']} / 未命中 {cs['misses']} / 版本检查 {cs['checks']} (命中率 {rate})\n"
+    ic = image_cache_stats
+    total = ic["hits"] + ic["misses"]
+    rate = f"{ic['hits'] / total:.1%}" if total else "-"
+    text += f"图片缓存: {len(image_cache)} 张 / {ic['bytes'] / 1024 / 1024:.1f}MB，命中 {ic['hits']} / 未命中 {ic['misses']} (命中率 {rate})\n"
+    text += f"上下文缓存: {len(context_cache)} 用户 / {context_cache_bytes() / 1024 / 1024:.1f}MB\n"
+    text += f"文档索引: {len(doc_indexes)} 用户在内存\n"
+    fc = file_cache_stats
+    total = fc["doc_hits"] + fc["doc_misses"]
+    rate = f"{fc['doc_hits'] / total:.1%}" if total else "-"
+    text += f"文件缓存: 文档命中 {fc['doc_hits']} / 未命中 {fc['doc_misses']} (命中率 {rate})，图片复用 {fc['image_hits']} / 新存 {fc['image_misses']}，省下 {fc['bytes_saved'] / 1024 / 1024:.1f}MB\n"
+    for name, h in api_health.items():
+        latency = f"{h['latency']:.1f}s" if h["latency"] is not None else "-"
+        state = " ⛔熔断" if circuit_open(name) else ""
+        text += f"上游 {name}: {h['calls']} 次，延迟 {latency}，错误率 {h['error_rate']:.0%}{state}\n"
+    for name, lim in upstream_limiters.items():
+        waiting = sum(len(q) for q in lim["waiters"].values())
+        text += f"限流 {name}: 在途 {lim['active']}/{lim['max_concurrent']}，排队 {waiting} ({len(lim['waiters'])} 用户)\n"
+    await bot.send_message(chat_id=update.effective_chat.id, text=text)
+
 # ============== Wizard 处理 ==============
 
 async def handle_wizard(update, bot, uid, text):
@@ -827,7 +2445,7 @@ async def handle_addapi_wizard(bot, uid, text, state, cid):
         apis = get_apis()
         name = state["data"]["name"]
         apis[name] = {"url": state["data"]["url"], "key": state["data"]["key"], "display_user": state["data"]["display_user"]}
-        save_apis(apis)
+        await save_apis(apis)
         del wizard_states[uid]
         await bot.send_message(chat_id=cid, text=f"✅ 已添加API「{name}」\nURL: {state['data']['url']}\n显示名: {state['data']['display_user']}")
     return True
@@ -875,7 +2493,7 @@ async def handle_addmodel_wizard(bot, uid, text, state, cid):
             "vision": state["data"]["vision"], "admin_only": state["data"]["admin_only"],
             "cost": state["data"].get("cost", 0), "max_tokens": state["data"]["max_tokens"]
         }
-        save_models(models)
+        await save_models(models)
         del wizard_states[uid]
         s = f"✅ 已添加模型「{name}」\nAPI: {state['data']['api']}\n模型ID: {state['data']['model']}\nAI名: {state['data']['ai_name']}\n模型名: {state['data']['model_name']}\n看图: {'是' if state['data']['vision'] else '否'}\n仅管理员: {'是' if state['data']['admin_only'] else '否'}"
         if not state['data']['admin_only']:
@@ -945,10 +2563,10 @@ async def callback_handler(update, bot):
     if data.startswith("memdel_"):
         try:
             idx = int(data[7:])
-            user = get_user(uid)
+            user = await get_user(uid)
             if 0 <= idx < len(user.get("memories", [])):
-                deleted = user["memories"].pop(idx)
-                save_user(uid, user)
+                deleted = user["memories"][idx]
+                await remove_memory(uid, deleted)
                 await bot.edit_message_text(chat_id=cid, message_id=mid, text=f"已删除记忆: {deleted['content'][:30]}... ✅")
             else:
                 await bot.edit_message_text(chat_id=cid, message_id=mid, text="记忆不存在！")
@@ -956,9 +2574,7 @@ async def callback_handler(update, bot):
             pass
         return
     if data == "memclear":
-        user = get_user(uid)
-        user["memories"] = []
-        save_user(uid, user)
+        await update_user(uid, {"memories": []})
         await bot.edit_message_text(chat_id=cid, message_id=mid, text="记忆已全部清除 🧹")
         return
 
@@ -970,7 +2586,7 @@ async def callback_handler(update, bot):
         name = data[7:]
         if name in models:
             del models[name]
-            save_models(models)
+            await save_models(models)
             await bot.edit_message_text(chat_id=cid, message_id=mid, text=f"已删除模型: {name} ✅")
         else:
             await bot.edit_message_text(chat_id=cid, message_id=mid, text=f"模型 {name} 不存在！")
@@ -984,7 +2600,7 @@ async def callback_handler(update, bot):
         name = data[5:]
         if name in apis:
             del apis[name]
-            save_apis(apis)
+            await save_apis(apis)
             await bot.edit_message_text(chat_id=cid, message_id=mid, text=f"已删除API: {name} ✅")
         else:
             await bot.edit_message_text(chat_id=cid, message_id=mid, text=f"API {name} 不存在！")
@@ -1010,9 +2626,8 @@ async def callback_handler(update, bot):
 
     elif data.startswith("model_"):
         mk = data[6:]
-        user = get_user(uid)
-        user["model"] = mk
-        save_user(uid, user)
+        await get_user(uid)  # 确保用户文档存在
+        await update_user(uid, {"model": mk})
         print(f"[Model] User {uid} -> {mk}")
         await bot.edit_message_text(chat_id=cid, message_id=mid, text=f"已切换: {mk} ✅")
 
@@ -1029,30 +2644,141 @@ async def callback_handler(update, bot):
                     row = []
         if row:
             keyboard.append(row)
-        user = get_user(uid)
+        user = await get_user(uid)
         await bot.edit_message_text(chat_id=cid, message_id=mid, text=f"当前: {user['model']}\n\n选择API:", reply_markup=InlineKeyboardMarkup(keyboard))
 
 # ============== 消息处理 ==============
 
-async def message_handler(update, bot, content_type="text", content=None):
+async def message_handler(update, bot, content_type="text", content=None, doc_id=None):
     uid = update.effective_user.id
     cid = update.effective_chat.id
     ts = get_cn_time().timestamp()
-    if uid in pending_responses:
-        del pending_responses[uid]
-    if uid not in message_buffers:
-        message_buffers[uid] = {"messages": []}
-    message_buffers[uid]["messages"].append({"type": content_type, "content": content or update.message.text, "timestamp": ts})
-    message_buffers[uid]["last_time"] = ts
-    message_buffers[uid]["chat_id"] = cid
-    message_buffers[uid]["wait_until"] = ts + 10
+    msg = {"type": content_type, "content": content or update.message.text, "timestamp": ts}
+    if doc_id:
+        msg["doc_id"] = doc_id
+    await cancel_chase(uid)
+    await buffer_messages(uid, cid, [msg])
+
+async def handle_update(bot, update):
+    try:
+        if update.message:
+            uid = update.effective_user.id
+            if uid in wizard_states and update.message.text:
+                txt = update.message.text
+                if not txt.startswith("/") or txt == "/cancel":
+                    handled = await handle_wizard(update, bot, uid, txt)
+                    if handled:
+                        return
+            if update.message.document:
+                fn = update.message.document.file_name or "file"
+                ext = fn.lower().split('.')[-1] if '.' in fn else ''
+                if ext in ['txt','md','doc','docx','xls','xlsx','ppt','pptx','pdf']:
+                    doc = update.message.document
+                    content = await extract_file_content(bot, doc.file_id, fn, doc.file_size, doc.file_unique_id)
+                    cap = update.message.caption or ""
+                    doc_id = None
+                    if len(content) > DOC_INLINE_CHARS:
+                        doc_id, count = await index_document(uid, fn, content)
+                        fc = f"[文件: {fn}]（共 {count} 段，已建索引，每轮会附上和消息相关的段落）\n{content[:DOC_PREVIEW_CHARS]}…"
+                    else:
+                        fc = f"[文件: {fn}]\n{content}"
+                    if cap:
+                        fc = f"{cap}\n\n{fc}"
+                    await message_handler(update, bot, "text", fc, doc_id)
+                return
+            if update.message.photo:
+                photo = update.message.photo[-1]
+                img_id = f"img_{photo.file_unique_id}"
+                known = await run_db(reuse_image, img_id)
+                if known:
+                    w, h, size = known
+                    file_cache_stats["image_hits"] += 1
+                    file_cache_stats["bytes_saved"] += (photo.file_size or 0) + size
+                else:
+                    file_cache_stats["image_misses"] += 1
+                    file = await bot.get_file(photo.file_id)
+                    fb = await file.download_as_bytearray()
+                    data, mime, w, h = await asyncio.get_running_loop().run_in_executor(None, prepare_image, bytes(fb))
+                    await save_image(img_id, data, mime, w, h)
+                cid = update.effective_chat.id
+                ts = get_cn_time().timestamp()
+                await cancel_chase(uid)
+                msgs = []
+                cap = update.message.caption or ""
+                if cap:
+                    msgs.append({"type": "text", "content": cap, "timestamp": ts})
+                msgs.append({"type": "photo", "content": "[图片]", "image_id": img_id, "tokens": image_tokens(w or photo.width, h or photo.height), "timestamp": ts})
+                await buffer_messages(uid, cid, msgs)
+                return
+            text = update.message.text or ""
+            if text.startswith("/start"): await start_command(update, bot)
+            elif text.startswith("/help"): await help_command(update, bot)
+            elif text.startswith("/points"): await points_command(update, bot)
+            elif text.startswith("/reset"): await reset_command(update, bot)
+            elif text.startswith("/memory"): await memory_command(update, bot, text)
+            elif text.startswith("/name"): await name_command(update, bot, text)
+            elif text.startswith("/context"): await context_command(update, bot, text)
+            elif text.startswith("/model"): await model_command(update, bot)
+            elif text.startswith("/export"): await export_command(update, bot)
+            elif text.startswith("/addmodel"): await addmodel_command(update, bot)
+            elif text.startswith("/addapi"): await addapi_command(update, bot)
+            elif text.startswith("/delmodel"): await delmodel_command(update, bot)
+            elif text.startswith("/delapi"): await delapi_command(update, bot)
+            elif text.startswith("/listmodels"): await listmodels_command(update, bot)
+            elif text.startswith("/listapis"): await listapis_command(update, bot)
+            elif text.startswith("/stats"): await stats_command(update, bot)
+            elif text.startswith("/gcimages"): await gcimages_command(update, bot, text)
+            elif not text.startswith("/"): await message_handler(update, bot)
+        elif update.callback_query:
+            await callback_handler(update, bot)
+    except Exception as e:
+        print(f"[Handle] Error: {e}")
 
 # ============== Flask ==============
 
 from flask import Flask, request as flask_request, jsonify
 
 flask_app = Flask(__name__)
-update_queue = queue.Queue()
+
+# webhook 线程只做校验，然后 call_soon_threadsafe 把 update 交给事件循环里的有界队列，立刻唤醒消费者。
+# WEBHOOK_SECRET 要和 setWebhook 时的 secret_token 一致。
+# 队列名额在回 200 之前就在 webhook 线程里占好（update_slots），占不到回 429，Telegram 会稍后重发；
+# 名额在消费者取出（或去重丢弃）时归还，所以回过 200 的 update 一定能入队
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_DEDUP_SIZE = 5000
+update_queue = None
+update_slots = threading.BoundedSemaphore(UPDATE_QUEUE_SIZE)
+seen_updates = OrderedDict()
+update_stats = {"received": 0, "duplicates": 0, "rejected": 0}
+
+def enqueue_update(data):
+    """在事件循环线程里执行：按 update_id 去重后入队"""
+    update_id = data.get("update_id")
+    if update_id is not None:
+        if update_id in seen_updates:
+            update_stats["duplicates"] += 1
+            update_slots.release()
+            return
+        seen_updates[update_id] = True
+        if len(seen_updates) > UPDATE_DEDUP_SIZE:
+            seen_updates.popitem(last=False)
+    update_queue.put_nowait(data)
+    update_stats["received"] += 1
+
+async def consume_updates(bot):
+    while True:
+        data = await update_queue.get()
+        update_slots.release()
+        # 任务队列积压时先不分发，让 update 留在队列里，满了由 webhook 回 429
+        while pending_jobs() >= MAX_PENDING_JOBS:
+            await asyncio.sleep(0.05)
+        try:
+            update = Update.de_json(data, bot)
+            uid = update.effective_user.id if update.effective_user else 0
+            dispatch(uid, partial(handle_update, bot, update))
+        except Exception as e:
+            print(f"[Update] Error: {e}")
 
 @flask_app.route("/")
 def home():
@@ -1064,196 +2790,281 @@ def health():
 
 @flask_app.route("/webhook", methods=["POST"])
 def webhook():
+    if WEBHOOK_SECRET and flask_request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return jsonify({"ok": False}), 403
+    if update_queue is None or not bot_loop or not bot_loop.is_running():
+        return jsonify({"ok": False}), 503
+    if not update_slots.acquire(blocking=False):
+        update_stats["rejected"] += 1
+        return jsonify({"ok": False}), 429
     try:
-        if flask_request.is_json:
-            update_queue.put(flask_request.get_json())
+        data = flask_request.get_json(silent=True)
+        if isinstance(data, dict):
+            bot_loop.call_soon_threadsafe(enqueue_update, data)
+        else:
+            update_slots.release()
         return jsonify({"ok": True})
     except Exception as e:
+        update_slots.release()
         print(f"[Webhook] Error: {e}")
         return jsonify({"ok": True})
 
+# ============== 定时任务 ==============
+
+# 定时/想念统一存 due_at（UTC）。内存里用最小堆放接下来 SCHEDULE_WINDOW 秒内要触发的任务，
+# 到点就触发；每个窗口结束时重新按索引查一次，已经过点没发的也一并补发。
+# 补发只针对存进来以后才过点的（卡住或停机期间）：新建时时间已经过了的直接丢掉。
+# 领取时写 claimed_by + lease_until，发完才删；实例挂了租约过期，下个窗口由别的实例补发
+SCHEDULE_WINDOW = 300
+schedule_heap = []
+schedule_window_end = 0
+schedule_wakeup = None
+
+def schedule_due_at(date_str, time_str):
+    local = datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M").replace(tzinfo=CN_TIMEZONE)
+    return local.astimezone(timezone.utc)
+
+def utc_ts(dt):
+    # pymongo 读出来的是不带时区的 UTC 时间
+    return dt.replace(tzinfo=timezone.utc).timestamp() if dt.tzinfo is None else dt.timestamp()
+
+async def add_schedule(sched):
+    try:
+        sched["due_at"] = schedule_due_at(sched["date"], sched["time"])
+    except ValueError:
+        print(f"[Schedule] Bad time: {sched.get('date')} {sched.get('time')}")
+        return
+    # 同一分钟内的算没过（HH:MM 精确到分钟）
+    if sched["due_at"].timestamp() < time.time() - 60:
+        print(f"[Schedule] Past time dropped: {sched['date']} {sched['time']}")
+        return
+    await run_db(schedules_col.insert_one, sched)
+    due = utc_ts(sched["due_at"])
+    if due < schedule_window_end:
+        heapq.heappush(schedule_heap, (due, sched["_id"]))
+        if schedule_wakeup:
+            schedule_wakeup.set()
+
+def migrate_schedules():
+    for sched in schedules_col.find({"due_at": {"$exists": False}}):
+        try:
+            due = schedule_due_at(sched["date"], sched["time"])
+        except (KeyError, ValueError):
+            schedules_col.delete_one({"_id": sched["_id"]})
+            continue
+        schedules_col.update_one({"_id": sched["_id"]}, {"$set": {"due_at": due}})
+
+async def load_schedule_window():
+    global schedule_heap, schedule_window_end
+    window_end = time.time() + SCHEDULE_WINDOW
+    end = datetime.fromtimestamp(window_end, timezone.utc)
+    docs = await run_db(find_all, schedules_col, {"due_at": {"$lt": end}}, {"due_at": 1})
+    heap = [(utc_ts(s["due_at"]), s["_id"]) for s in docs]
+    heapq.heapify(heap)
+    schedule_heap = heap
+    schedule_window_end = window_end
+
+async def run_scheduler(bot):
+    while True:
+        try:
+            now = time.time()
+            if now >= schedule_window_end:
+                await load_schedule_window()
+            while schedule_heap and schedule_heap[0][0] <= now and pending_jobs() < MAX_PENDING_JOBS:
+                _, sid = heapq.heappop(schedule_heap)
+                # 没人领或者租约已过期才能领到，避免多个实例重复触发
+                sched = await run_db(
+                    schedules_col.find_one_and_update,
+                    {"_id": sid, "$or": [{"claimed_by": {"$exists": False}}, {"lease_until": {"$lt": datetime.now(timezone.utc)}}]},
+                    {"$set": {"claimed_by": INSTANCE_ID, "lease_until": lease_deadline()}}
+                )
+                if not sched:
+                    continue
+                if not sched.get("user_id"):
+                    await run_db(schedules_col.delete_one, {"_id": sid})
+                    continue
+                if not dispatch(int(sched["user_id"]), partial(run_schedule, bot, sched), heavy=True):
+                    # 领取期间队列满了：放掉领取，留在堆里稍后再试
+                    await run_db(schedules_col.update_one, {"_id": sid, "claimed_by": INSTANCE_ID}, {"$unset": {"claimed_by": "", "lease_until": ""}})
+                    heapq.heappush(schedule_heap, (utc_ts(sched["due_at"]), sid))
+            wake_at = schedule_window_end
+            if schedule_heap:
+                wake_at = min(wake_at, schedule_heap[0][0])
+            timeout = max(wake_at - time.time(), 1 if schedule_heap and pending_jobs() >= MAX_PENDING_JOBS else 0)
+            try:
+                await asyncio.wait_for(schedule_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            schedule_wakeup.clear()
+        except Exception as e:
+            print(f"[Scheduler] Error: {e}")
+            await asyncio.sleep(5)
+
+async def run_schedule(bot, sched):
+    try:
+        await fire_schedule(bot, sched)
+    finally:
+        await run_db(schedules_col.delete_one, {"_id": sched["_id"], "claimed_by": INSTANCE_ID})
+
+async def send_chase(bot, uid, job):
+    now = get_cn_time().timestamp()
+    done = dict(job)
+    if not done.get("sent"):
+        await mark_job(job, sent=True)
+        await bot.send_message(chat_id=job["chat_id"], text=job["chase"])
+    if not done.get("recorded"):
+        await mark_job(job, recorded=True)
+        user = await get_user(uid)
+        await append_messages(uid, [{"role": "assistant", "content": job["chase"], "timestamp": now, "model": user["model"]}])
+
+async def fire_schedule(bot, sched):
+    now = get_cn_time().timestamp()
+    uid_str = sched["user_id"]
+    user = await get_user(int(uid_str))
+    chat_id = sched.get("chat_id") or user.get("chat_id")
+    if not chat_id:
+        return
+    if sched.get("type") == "想念":
+        if now - (user.get("last_activity") or 0) < 300:
+            return
+    prompt = f"你之前设定了一个{sched.get('type','定时')}消息，提示是：{sched.get('hint','')}\n现在时间到了，你想发什么？（可以设追问）\n不想发就回复 [[不发]]"
+    messages = (await get_context_messages(user)) + [{"role": "user", "content": prompt}]
+    try:
+        response = await call_main_model(user["model"], messages, user)
+        parsed = parse_response(response, user)
+        if not parsed["suppress"]:
+            if parsed["reply"]:
+                await send_messages(bot, chat_id, parsed["reply"])
+                await append_messages(uid_str, [{"role": "assistant", "content": parsed["raw"], "timestamp": now, "model": user["model"]}])
+                if parsed["chase"]:
+                    await schedule_chase(int(uid_str), chat_id, parsed["chase"], parsed["chase_delay"])
+                if parsed["schedules"]:
+                    for ns in parsed["schedules"]:
+                        ns["chat_id"] = chat_id
+                        ns["user_id"] = uid_str
+                        await add_schedule(ns)
+    except Exception as e:
+        print(f"[Schedule] Error: {e}")
+
+async def fire_miss(bot, uid, chat_id, hours):
+    now = get_cn_time().timestamp()
+    user = await get_user(uid)
+    prompt = f"你已经{int(hours)}小时没和用户聊天了。想主动找用户吗？（可以设追问）\n不想就回复 [[不发]]"
+    messages = (await get_context_messages(user)) + [{"role": "user", "content": prompt}]
+    try:
+        response = await call_main_model(user["model"], messages, user)
+        parsed = parse_response(response, user)
+        if not parsed["suppress"]:
+            if parsed["reply"]:
+                await send_messages(bot, chat_id, parsed["reply"])
+                await append_messages(uid, [{"role": "assistant", "content": parsed["raw"], "timestamp": now, "model": user["model"]}])
+                if parsed["chase"]:
+                    await schedule_chase(uid, chat_id, parsed["chase"], parsed["chase_delay"])
+    except Exception as e:
+        print(f"[Miss] Error: {e}")
+
 # ============== Bot 主循环 ==============
 
+bot_loop = None
+
 def run_bot():
+    global reply_slots, bot_loop, schedule_wakeup, job_wakeup, update_queue, extract_slots
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+    bot_loop = loop
+    reply_slots = asyncio.Semaphore(MAX_CONCURRENT_REPLIES)
+    extract_slots = asyncio.Semaphore(EXTRACT_WORKERS)
+    update_queue = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE)
+    schedule_wakeup = asyncio.Event()
+    job_wakeup = asyncio.Event()
     bot_request = HTTPXRequest(connection_pool_size=20, read_timeout=30, write_timeout=30, connect_timeout=30, pool_timeout=30)
     bot = Bot(token=BOT_TOKEN, request=bot_request)
 
-    async def handle_update(data):
-        try:
-            update = Update.de_json(data, bot)
-            if update.message:
-                uid = update.effective_user.id
-                if uid in wizard_states and update.message.text:
-                    txt = update.message.text
-                    if not txt.startswith("/") or txt == "/cancel":
-                        handled = await handle_wizard(update, bot, uid, txt)
-                        if handled:
-                            return
-                if update.message.document:
-                    fn = update.message.document.file_name or "file"
-                    ext = fn.lower().split('.')[-1] if '.' in fn else ''
-                    if ext in ['txt','md','doc','docx','xls','xlsx','ppt','pptx','pdf']:
-                        content = await extract_file_content(bot, update.message.document.file_id, fn)
-                        cap = update.message.caption or ""
-                        fc = f"[文件: {fn}]\n{content}"
-                        if cap:
-                            fc = f"{cap}\n\n{fc}"
-                        await message_handler(update, bot, "text", fc)
-                    return
-                if update.message.photo:
-                    photo = update.message.photo[-1]
-                    file = await bot.get_file(photo.file_id)
-                    fb = await file.download_as_bytearray()
-                    ib64 = base64.b64encode(bytes(fb)).decode('utf-8')
-                    img_id = f"img_{uid}_{int(get_cn_time().timestamp()*1000)}"
-                    save_image(img_id, ib64)
-                    cid = update.effective_chat.id
-                    ts = get_cn_time().timestamp()
-                    if uid in pending_responses:
-                        del pending_responses[uid]
-                    if uid not in message_buffers:
-                        message_buffers[uid] = {"messages": []}
-                    cap = update.message.caption or ""
-                    if cap:
-                        message_buffers[uid]["messages"].append({"type": "text", "content": cap, "timestamp": ts})
-                    message_buffers[uid]["messages"].append({"type": "photo", "content": "[图片]", "image_id": img_id, "timestamp": ts})
-                    message_buffers[uid]["last_time"] = ts
-                    message_buffers[uid]["chat_id"] = cid
-                    message_buffers[uid]["wait_until"] = ts + 10
-                    return
-                text = update.message.text or ""
-                if text.startswith("/start"): await start_command(update, bot)
-                elif text.startswith("/help"): await help_command(update, bot)
-                elif text.startswith("/points"): await points_command(update, bot)
-                elif text.startswith("/reset"): await reset_command(update, bot)
-                elif text.startswith("/memory"): await memory_command(update, bot, text)
-                elif text.startswith("/name"): await name_command(update, bot, text)
-                elif text.startswith("/context"): await context_command(update, bot, text)
-                elif text.startswith("/model"): await model_command(update, bot)
-                elif text.startswith("/export"): await export_command(update, bot)
-                elif text.startswith("/addmodel"): await addmodel_command(update, bot)
-                elif text.startswith("/addapi"): await addapi_command(update, bot)
-                elif text.startswith("/delmodel"): await delmodel_command(update, bot)
-                elif text.startswith("/delapi"): await delapi_command(update, bot)
-                elif text.startswith("/listmodels"): await listmodels_command(update, bot)
-                elif text.startswith("/listapis"): await listapis_command(update, bot)
-                elif not text.startswith("/"): await message_handler(update, bot)
-            elif update.callback_query:
-                await callback_handler(update, bot)
-        except Exception as e:
-            print(f"[Handle] Error: {e}")
+    async def sweep_images_periodically():
+        while True:
+            await asyncio.sleep(IMAGE_SWEEP_INTERVAL)
+            try:
+                report = await run_db(sweep_images, False)
+                print(f"[ImageGC] {report}")
+            except Exception as e:
+                print(f"[ImageGC] Error: {e}")
+
+    async def trim_extract_cache_periodically():
+        while True:
+            await asyncio.sleep(EXTRACT_TRIM_INTERVAL)
+            try:
+                removed = await run_db(trim_extract_cache)
+                if removed:
+                    print(f"[ExtractCache] Trimmed {removed}")
+            except Exception as e:
+                print(f"[ExtractCache] Error: {e}")
+
+    async def refresh_config_periodically():
+        while True:
+            await asyncio.sleep(CONFIG_CHECK_INTERVAL)
+            try:
+                await run_db(refresh_config)
+            except Exception as e:
+                print(f"[Config] Refresh error: {e}")
 
     async def main_loop():
-        last_schedule_check = 0
+        loop.create_task(consume_updates(bot))
+        loop.create_task(heartbeat())
+        loop.create_task(refresh_config_periodically())
+        loop.create_task(sweep_images_periodically())
+        loop.create_task(trim_extract_cache_periodically())
+        loop.create_task(run_scheduler(bot))
+        loop.create_task(run_jobs(bot))
         while True:
             try:
                 now = get_cn_time().timestamp()
-                now_time = get_cn_time()
-                current_time_str = now_time.strftime("%H:%M")
-                current_date_str = now_time.strftime("%Y-%m-%d")
-                today = current_date_str
-                while not update_queue.empty():
-                    try:
-                        await handle_update(update_queue.get_nowait())
-                    except Exception as e:
-                        print(f"[Update] Error: {e}")
-                for uid, buffer in list(message_buffers.items()):
-                    if buffer.get("messages") and buffer.get("wait_until"):
-                        if now >= buffer["wait_until"]:
-                            await process_and_reply(bot, uid, buffer["chat_id"])
-                for uid, pending in list(pending_responses.items()):
-                    delay = pending.get("delay", 300)
-                    if now - pending["time"] >= delay:
-                        try:
-                            await bot.send_message(chat_id=pending["chat_id"], text=pending["chase"])
-                            user = get_user(uid)
-                            user["history"].append({"role": "assistant", "content": pending["chase"], "timestamp": now, "model": user["model"]})
-                            save_user(uid, user)
-                        except Exception as e:
-                            print(f"[Chase] Error: {e}")
-                        del pending_responses[uid]
-                if now - last_schedule_check >= 30:
-                    last_schedule_check = now
-                    matching = list(schedules_col.find({"date": current_date_str, "time": current_time_str}))
-                    for sched in matching:
-                        uid_str = sched.get("user_id")
-                        if not uid_str:
-                            schedules_col.delete_one({"_id": sched["_id"]})
-                            continue
-                        user = get_user(int(uid_str))
-                        chat_id = sched.get("chat_id") or user.get("chat_id")
-                        if not chat_id:
-                            schedules_col.delete_one({"_id": sched["_id"]})
-                            continue
-                        if sched.get("type") == "想念":
-                            if now - user.get("last_activity", 0) < 300:
-                                continue
-                        prompt = f"你之前设定了一个{sched.get('type','定时')}消息，提示是：{sched.get('hint','')}\n现在时间到了，你想发什么？（可以设追问）\n不想发就回复 [[不发]]"
-                        messages = get_context_messages(user) + [{"role": "user", "content": prompt}]
-                        try:
-                            response = await call_main_model(user["model"], messages, user)
-                            if "[[不发]]" not in response:
-                                parsed = parse_response(response, user)
-                                if parsed["reply"]:
-                                    await send_messages(bot, chat_id, parsed["reply"])
-                                    user["history"].append({"role": "assistant", "content": parsed["raw"], "timestamp": now, "model": user["model"]})
-                                    if parsed["chase"]:
-                                        pending_responses[int(uid_str)] = {"chase": parsed["chase"], "time": now, "delay": parsed["chase_delay"], "chat_id": chat_id}
-                                    if parsed["schedules"]:
-                                        for ns in parsed["schedules"]:
-                                            ns["chat_id"] = chat_id
-                                            ns["user_id"] = uid_str
-                                            schedules_col.insert_one(ns)
-                                    save_user(int(uid_str), user)
-                        except Exception as e:
-                            print(f"[Schedule] Error: {e}")
-                        schedules_col.delete_one({"_id": sched["_id"]})
-                    schedules_col.delete_many({"date": {"$lt": current_date_str}})
-                    for user_doc in users_col.find({"last_activity": {"$exists": True, "$ne": None}}):
-                        uid_str = user_doc["_id"]
-                        la = user_doc.get("last_activity", 0)
-                        if not la:
-                            continue
-                        hs = (now - la) / 3600
-                        chat_id = user_doc.get("chat_id")
-                        if not chat_id:
-                            continue
-                        if 4 <= hs <= 6:
-                            if user_doc.get("last_miss_trigger") == today:
-                                continue
-                            if random.random() < 0.7:
-                                user = get_user(int(uid_str))
-                                prompt = f"你已经{int(hs)}小时没和用户聊天了。想主动找用户吗？（可以设追问）\n不想就回复 [[不发]]"
-                                messages = get_context_messages(user) + [{"role": "user", "content": prompt}]
-                                try:
-                                    response = await call_main_model(user["model"], messages, user)
-                                    if "[[不发]]" not in response:
-                                        parsed = parse_response(response, user)
-                                        if parsed["reply"]:
-                                            await send_messages(bot, chat_id, parsed["reply"])
-                                            user["history"].append({"role": "assistant", "content": parsed["raw"], "timestamp": now, "model": user["model"]})
-                                            if parsed["chase"]:
-                                                pending_responses[int(uid_str)] = {"chase": parsed["chase"], "time": now, "delay": parsed["chase_delay"], "chat_id": chat_id}
-                                            user["last_miss_trigger"] = today
-                                            save_user(int(uid_str), user)
-                                except Exception as e:
-                                    print(f"[Miss] Error: {e}")
+                today = get_cn_time().strftime("%Y-%m-%d")
+                # 只查 4~6 小时前活跃过的用户，走 last_activity 索引
+                candidates = await run_db(
+                    find_all, users_col,
+                    {"last_activity": {"$gte": now - 6 * 3600, "$lte": now - 4 * 3600}, "last_miss_trigger": {"$ne": today}},
+                    {"_id": 1, "chat_id": 1, "last_activity": 1, "last_miss_trigger": 1}
+                )
+                for user_doc in candidates:
+                    uid_str = user_doc["_id"]
+                    hs = (now - user_doc["last_activity"]) / 3600
+                    chat_id = user_doc.get("chat_id")
+                    if not chat_id:
+                        continue
+                    # 该用户还有任务在跑就先不触发，避免重复
+                    if int(uid_str) in user_workers:
+                        continue
+                    if random.random() < 0.7:
+                        # 先把当天的名额占下来，多个实例只有一个能占到
+                        res = await run_db(users_col.update_one, {"_id": uid_str, "last_miss_trigger": {"$ne": today}}, {"$set": {"last_miss_trigger": today}})
+                        if res.modified_count and not dispatch(int(uid_str), partial(fire_miss, bot, int(uid_str), chat_id, hs), heavy=True):
+                            # 队列满了没分发出去：把当天的名额还回去，下一轮再试
+                            prev = user_doc.get("last_miss_trigger")
+                            undo = {"$set": {"last_miss_trigger": prev}} if prev else {"$unset": {"last_miss_trigger": ""}}
+                            await run_db(users_col.update_one, {"_id": uid_str, "last_miss_trigger": today}, undo)
             except Exception as e:
                 print(f"[MainLoop] Error: {e}")
-            await asyncio.sleep(1)
+            await asyncio.sleep(30)
 
     print("Bot loop started")
     loop.run_until_complete(main_loop())
 
 # ============== 启动 ==============
 
-init_db()
-bot_thread = threading.Thread(target=run_bot, daemon=True)
-bot_thread.start()
-print("Bot thread started")
+def shutdown():
+    if bot_loop and bot_loop.is_running():
+        try:
+            asyncio.run_coroutine_threadsafe(close_http_clients(), bot_loop).result(timeout=5)
+        except Exception as e:
+            print(f"[Shutdown] Error: {e}")
 
 if __name__ == "__main__":
+    atexit.register(shutdown)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    start_extract_pool()
+    init_db()
+    bot_thread = threading.Thread(target=run_bot, daemon=True)
+    bot_thread.start()
+    print("Bot thread started")
     port = int(os.environ.get("PORT", 10000))
     flask_app.run(host="0.0.0.0", port=port)